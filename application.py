@@ -0,0 +1,256 @@
+"""
+The bot application: session and dispatcher factories, polling and webhook modes.
+
+Started through bot.py, which sets up logging first; the load test builds
+its bot and dispatcher from the factories here.
+"""
+import asyncio
+import logging
+import signal
+import time
+from typing import Any, Dict, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from handlers import register_handlers, backfill_phashes
+from config import (
+    TELEGRAM_TOKEN,
+    BOT_MODE,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_DRAIN_TIMEOUT,
+)
+from rate_limiter import TelegramRateLimiter
+from state_storage import create_fsm_storage
+from temp_artifacts import temp_artifacts
+from capture_queue import capture_queue
+from metrics import HandlerMetricsMiddleware, TelegramMetricsMiddleware, start_metrics_server
+from tracing import UpdateTracingMiddleware, HandlerTracingMiddleware, TelegramTracingMiddleware, span_exporter
+from scheduler import scheduler, load_chat_schedules
+from storage import screenshot_storage
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler that finishes already accepted updates before closing the session.
+
+    Updates are fed in background tasks tracked here, so draining relies only
+    on aiogram's public handler and dispatcher API.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._feed_tasks: Set[asyncio.Task] = set()
+
+    async def _feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=bot, result=result)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        # Telegram сразу получает ответ, обновление обрабатывается в фоне
+        update = await request.json(loads=bot.session.json_loads)
+        task = asyncio.create_task(self._feed_update(bot, update))
+        self._feed_tasks.add(task)
+        task.add_done_callback(self._feed_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        pending = list(self._feed_tasks)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} updates in progress...")
+            done, not_done = await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if not_done:
+                logger.warning(f"{len(not_done)} updates did not finish in {WEBHOOK_DRAIN_TIMEOUT}s")
+        await super().close()
+
+
+def create_bot(token: str = TELEGRAM_TOKEN, session: Optional[BaseSession] = None,
+               rate_limit: bool = True) -> Bot:
+    """Bot with the session middlewares of production; the load test passes a session to a fake API"""
+    bot = Bot(token=token, session=session)
+    if rate_limit:
+        bot.session.middleware(TelegramRateLimiter())
+    # После лимитера: считаются реальные запросы к Bot API, включая повторы после 429
+    bot.session.middleware(TelegramMetricsMiddleware())
+    bot.session.middleware(TelegramTracingMiddleware())
+    return bot
+
+
+def create_dispatcher() -> Dispatcher:
+    """Dispatcher with FSM storage and the metrics and tracing middlewares; handlers are added separately"""
+    dp = Dispatcher(storage=create_fsm_storage())
+    dp.message.middleware(HandlerMetricsMiddleware("message"))
+    dp.callback_query.middleware(HandlerMetricsMiddleware("callback_query"))
+    # Трасса на каждое обновление: обработчик, снимок, обработка и отправка
+    dp.update.outer_middleware(UpdateTracingMiddleware())
+    dp.message.middleware(HandlerTracingMiddleware())
+    dp.callback_query.middleware(HandlerTracingMiddleware())
+    return dp
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """Create aiohttp application that feeds webhook updates into the dispatcher"""
+    app = web.Application()
+    DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_polling(bot: Bot, dp: Dispatcher) -> None:
+    """Serve updates with long polling"""
+    # Снимаем webhook, но сохраняем накопившиеся обновления
+    logger.info("Removing webhook before polling...")
+    await bot.delete_webhook(drop_pending_updates=False)
+    logger.info("Webhook removed")
+
+    logger.info("Starting polling...")
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    """Serve updates with webhook until SIGINT/SIGTERM"""
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL is required in webhook mode")
+
+    app = create_webhook_app(bot, dp)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        webhook_url = WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH
+        # Telegram хранит обновления, пока бот недоступен, поэтому webhook не удаляем при остановке
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False,
+        )
+        logger.info(f"Webhook set to {webhook_url}")
+        await stop_event.wait()
+        logger.info("Stop signal received")
+    finally:
+        logger.info("Stopping webhook server...")
+        await runner.cleanup()
+        logger.info("Webhook server stopped")
+
+
+async def main():
+    """Main function to start the bot."""
+    bot = None
+    dp = None
+    metrics_runner = None
+
+    try:
+        logger.info(f"Starting bot initialization process in {BOT_MODE} mode...")
+
+        # Initialize Bot instance with token
+        bot = create_bot()
+        logger.info("Bot instance created")
+
+        # Create new dispatcher
+        dp = create_dispatcher()
+        logger.info("Dispatcher created")
+
+        metrics_runner = await start_metrics_server()
+
+        # Воркеры очереди снимков запускаются до планировщика и обработчиков
+        capture_queue.start()
+
+        # Расписания чатов добавляются в кучу планировщика до его запуска
+        load_chat_schedules(bot)
+
+        # Start scheduler in background
+        logger.info("Starting scheduler...")
+        scheduler_task = asyncio.create_task(scheduler())
+        logger.info("Scheduler task created")
+
+        # Удаление просроченных временных файлов вне обработчиков
+        sweeper_task = asyncio.create_task(temp_artifacts.run_sweeper())
+        logger.info("Temp file sweeper task created")
+
+        # Perceptual hash для записей архива, сохранённых до появления индекса похожих
+        phash_task = asyncio.create_task(backfill_phashes())
+
+        # Register all handlers
+        register_handlers(dp)
+        logger.info("Handlers registered successfully")
+
+        if BOT_MODE == 'webhook':
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+
+    except Exception as e:
+        logger.error(f"Critical error during bot startup: {e}", exc_info=True)
+        raise
+    finally:
+        # Shutdown
+        if bot:
+            logger.info("Closing bot session...")
+            await bot.session.close()
+            logger.info("Bot session closed")
+        await capture_queue.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        span_exporter.shutdown()
+        if dp:
+            logger.info("Closing dispatcher...")
+            await dp.storage.close()
+            logger.info("Dispatcher storage closed")
+
+async def profile_startup() -> None:
+    """Print import time per module and init time per start-up step, without connecting to Telegram"""
+    from startup_profile import StartupTimer, format_report, profile_imports
+
+    timings, import_wall = await asyncio.to_thread(profile_imports, __name__)
+    timer = StartupTimer()
+    with timer.step("create_bot"):
+        bot = create_bot()
+    with timer.step("create_dispatcher + register_handlers"):
+        dp = create_dispatcher()
+        register_handlers(dp)
+    with timer.step("capture_queue.start"):
+        capture_queue.start()
+    with timer.step("load_chat_schedules"):
+        load_chat_schedules(bot)
+
+    # Архив открывается при первом обращении; после старта это делает backfill_phashes в потоке
+    started = time.perf_counter()
+    await asyncio.to_thread(screenshot_storage.open)
+    records = sum(len(entries) for entries in screenshot_storage.metadata.values())
+    background = (f"archive open ({records} screenshots)", time.perf_counter() - started)
+
+    await capture_queue.stop()
+    await bot.session.close()
+    await dp.storage.close()
+    print(format_report(timings, import_wall, timer, background, __name__))
+
@@ -0,0 +1,192 @@
+"""
+ZIP export of archive selections: a category, a date or a period.
+
+Screenshots are added to the ZIP one at a time, copied in chunks into a
+SpooledTemporaryFile that moves to disk once it outgrows
+EXPORT_SPOOL_MAX_MEMORY, so memory stays bounded whatever the size of the
+selection. Member sizes are known in advance, so the selection is planned
+into parts that fit EXPORT_PART_MAX_BYTES before anything is written; each
+part is built, uploaded as one document and closed before the next one.
+"""
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import zipfile
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+from aiogram.types.input_file import InputFile
+
+from config import (
+    TEMP_DIR,
+    EXPORT_PART_MAX_BYTES,
+    EXPORT_SPOOL_MAX_MEMORY,
+    EXPORT_CHUNK_SIZE,
+    EXPORT_MAX_CONCURRENT,
+)
+
+logger = logging.getLogger(__name__)
+
+ZIP_ENTRY_OVERHEAD = 200  # local header + central directory record + zip64 extras, without the name
+ZIP_END_OVERHEAD = 200  # end of central directory records
+
+DAY_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+MONTH_PATTERN = re.compile(r"^(\d{4})-(\d{2})$")
+RANGE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})\.\.(\d{4}-\d{2}-\d{2})$")
+
+# Сборка частей идёт в потоках; ограничиваем число одновременных выгрузок
+export_semaphore = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+Member = Tuple[Dict, str, int]  # record, name in the ZIP, data size
+
+
+class ExportPart:
+    """Members of one ZIP document"""
+
+    def __init__(self, filename: str, members: List[Member]):
+        self.filename = filename
+        self.members = members
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, _, size in self.members)
+
+
+class SpooledInputFile(InputFile):
+    """Uploads a spooled ZIP part without reading it into memory at once"""
+
+    def __init__(self, file: tempfile.SpooledTemporaryFile, filename: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+
+def _safe_name(text: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", text).strip("_") or "screenshots"
+
+
+def select_export(storage, query: str, user_id: int, chat_id: int) -> Tuple[str, List[Dict]]:
+    """
+    Records for an export query: 'YYYY-MM-DD', 'YYYY-MM', 'YYYY-MM-DD..YYYY-MM-DD'
+    or a category label. Returns (name of the export, records oldest first).
+    """
+    query = query.strip()
+    if match := RANGE_PATTERN.match(query):
+        start, end = (part.replace("-", "") for part in match.groups())
+        records = storage.get_screenshots_in_period(start, end, user_id, chat_id)
+        name = f"{match.group(1)}_{match.group(2)}"
+    elif DAY_PATTERN.match(query) or MONTH_PATTERN.match(query):
+        prefix = query.replace("-", "")
+        records = storage.get_screenshots_in_period(prefix, prefix, user_id, chat_id)
+        name = query
+    else:
+        records = storage.get_screenshots_by_label(query, user_id, chat_id)
+        name = query
+    return _safe_name(name), sorted(records, key=lambda info: info["timestamp"])
+
+
+def _member_size(storage, info: Dict) -> Optional[int]:
+    if info.get("segment"):
+        return info["size"] if storage.screenshot_exists(info) else None
+    try:
+        return os.path.getsize(storage.data_path(info))
+    except OSError:
+        return None
+
+
+def _member_name(info: Dict, used: set) -> str:
+    extension = info.get("tier") or os.path.splitext(info["filepath"])[1].lstrip(".") or "png"
+    stem = f"{info['timestamp']}_{_safe_name(info['label'])}"
+    name = f"{stem}.{extension}"
+    suffix = 1
+    while name in used:
+        name = f"{stem}_{suffix}.{extension}"
+        suffix += 1
+    used.add(name)
+    return name
+
+
+def plan_parts(storage, records: List[Dict], name: str,
+               max_bytes: int = EXPORT_PART_MAX_BYTES) -> Tuple[List[ExportPart], List[Dict]]:
+    """Split records into parts that fit max_bytes; returns (parts, skipped records)"""
+    groups: List[List[Member]] = []
+    skipped: List[Dict] = []
+    used: set = set()
+    current: List[Member] = []
+    current_bytes = ZIP_END_OVERHEAD
+    for info in records:
+        size = _member_size(storage, info)
+        if size is None:
+            skipped.append(info)
+            continue
+        member_name = _member_name(info, used)
+        member_bytes = size + ZIP_ENTRY_OVERHEAD + 2 * len(member_name.encode())
+        if member_bytes + ZIP_END_OVERHEAD > max_bytes:
+            logger.warning(f"Screenshot {info['filepath']} ({size} bytes) does not fit an export part")
+            skipped.append(info)
+            continue
+        if current and current_bytes + member_bytes > max_bytes:
+            groups.append(current)
+            current, current_bytes = [], ZIP_END_OVERHEAD
+        current.append((info, member_name, size))
+        current_bytes += member_bytes
+    if current:
+        groups.append(current)
+
+    if len(groups) == 1:
+        return [ExportPart(f"{name}.zip", groups[0])], skipped
+    return [
+        ExportPart(f"{name}_part{number}of{len(groups)}.zip", members)
+        for number, members in enumerate(groups, start=1)
+    ], skipped
+
+
+def build_part(storage, part: ExportPart) -> tempfile.SpooledTemporaryFile:
+    """Write one part into a spooled file, one screenshot at a time; the caller closes it"""
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_MEMORY, dir=TEMP_DIR, suffix=".zip")
+    try:
+        # PNG и WebP уже сжаты, поэтому файлы кладутся без сжатия
+        with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for info, member_name, size in part.members:
+                try:
+                    source = storage.open_screenshot(info)
+                except (OSError, ValueError) as e:
+                    # Файл могли удалить или перепаковать после планирования
+                    logger.warning(f"Skipping {info['filepath']} in export: {e}")
+                    continue
+                entry = zipfile.ZipInfo(member_name, date_time=_zip_time(info["timestamp"]))
+                entry.file_size = size
+                with source, archive.open(entry, "w") as target:
+                    while chunk := source.read(EXPORT_CHUNK_SIZE):
+                        target.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    logger.info(f"Built export part {part.filename}: {len(part.members)} screenshots, {spool.tell()} bytes")
+    return spool
+
+
+async def part_documents(storage, parts: List[ExportPart]) -> AsyncGenerator[Tuple[ExportPart, InputFile], None]:
+    """Build parts one by one; a part is closed once the caller has sent it and asks for the next"""
+    async with export_semaphore:
+        for part in parts:
+            spool = await asyncio.to_thread(build_part, storage, part)
+            try:
+                yield part, SpooledInputFile(spool, part.filename)
+            finally:
+                spool.close()
+
+
+def _zip_time(timestamp: str) -> Tuple[int, int, int, int, int, int]:
+    """'20250131_235900' -> (2025, 1, 31, 23, 59, 0)"""
+    try:
+        return (int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                int(timestamp[9:11]), int(timestamp[11:13]), int(timestamp[13:15]))
+    except (ValueError, IndexError):
+        return (1980, 1, 1, 0, 0, 0)
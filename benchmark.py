@@ -0,0 +1,270 @@
+"""
+Benchmarks of ScreenshotStorage and ScreenshotStats on synthetic archives.
+
+    python benchmark.py                                   # 10k, 100k and 1M records
+    python benchmark.py --sizes 10000 100000 --output results.json
+    python benchmark.py --save-baseline                   # store the results as the baseline
+    python benchmark.py --threshold 0.25                  # fail on >25% slower than the baseline
+
+Every size gets a fresh archive in a temporary directory: metadata.json with
+records spread over many users and chats, the labels the bot really
+produces and two years of timestamps. Reads are timed against it as is,
+writes go through the public save/delete methods (which rewrite
+metadata.json). Results are JSON; with a baseline the median of every
+operation is compared and the exit code is 1 if one got slower than the
+threshold allows.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_BASELINE = "benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.2  # 20% slower than the baseline median is a regression
+SYSTEM_KEY_SHARE = 0.2  # плановые снимки системного пользователя
+CUSTOM_LABELS = [
+    "Продажи", "Склад", "Итоги недели", "Отчёт для бухгалтерии", "План на месяц",
+    "Остатки", "Касса", "Закупки", "Сверка", "Зарплата",
+]
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.strftime("%Y%m%d_%H%M%S")
+
+
+def _label(rnd: random.Random, moment: datetime, system: bool) -> str:
+    day = moment.strftime("%Y-%m-%d")
+    if system:
+        if moment.day == 1:
+            return f"Начало месяца {day}"
+        if moment.day == 15:
+            return f"Середина месяца {day}"
+        return f"Ежедневный отчет {day}"
+    roll = rnd.random()
+    if roll < 0.5:
+        return rnd.choice(CUSTOM_LABELS)
+    if roll < 0.8:
+        return f"Сохранено вручную {moment.strftime('%Y-%m-%d %H:%M:%S')}"
+    return f"По расписанию {day}"
+
+
+def generate_metadata(size: int, seed: int = 1, now: Optional[datetime] = None) -> Dict[str, List[Dict]]:
+    """Synthetic metadata.json content with `size` records; chat sizes follow a Zipf-like skew"""
+    rnd = random.Random(seed)
+    now = now or datetime(2025, 6, 30, 23, 0)
+    chats = max(10, size // 1000)
+    keys = [(1000 + index, -100000 - index if index % 3 == 0 else 1000 + index) for index in range(chats)]
+    weights = [1 / (rank + 1) for rank in range(chats)]
+    span_seconds = 730 * 24 * 3600
+
+    metadata: Dict[str, List[Dict]] = {}
+    system_count = int(size * SYSTEM_KEY_SHARE)
+    owners = [(0, 0)] * system_count + rnd.choices(keys, weights=weights, k=size - system_count)
+    for user_id, chat_id in owners:
+        moment = now - timedelta(seconds=rnd.randrange(span_seconds))
+        timestamp = _timestamp(moment)
+        metadata.setdefault(f"user_{user_id}_chat_{chat_id}", []).append({
+            "label": _label(rnd, moment, user_id == 0),
+            "timestamp": timestamp,
+            "filepath": os.path.join("screenshots", f"user_{user_id}", f"chat_{chat_id}", moment.strftime("%Y-%m"),
+                                     f"screenshot_{timestamp}.png"),
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "sha256": f"{rnd.getrandbits(256):064x}",
+        })
+    for entries in metadata.values():
+        entries.sort(key=lambda info: info["timestamp"])
+    return metadata
+
+
+def _png(rnd: random.Random) -> bytes:
+    from PIL import Image
+    image = Image.frombytes("RGB", (64, 64), rnd.randbytes(64 * 64 * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def measure(func: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> Dict:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        "runs": repeat,
+        "median_ms": round(statistics.median(times), 3),
+        "min_ms": round(times[0], 3),
+        "mean_ms": round(statistics.fmean(times), 3),
+        "max_ms": round(times[-1], 3),
+    }
+
+
+def run_size(size: int, workdir: str, read_repeat: int, write_repeat: int, seed: int) -> Dict[str, Dict]:
+    """Build a synthetic archive of `size` records in `workdir` and time every operation"""
+    os.makedirs(os.path.join(workdir, "screenshots"), exist_ok=True)
+    os.chdir(workdir)
+    metadata = generate_metadata(size, seed)
+    with open(os.path.join("screenshots", "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    from storage import ScreenshotStorage
+    from utils import screenshot_stats
+
+    results: Dict[str, Dict] = {}
+    # Метаданные читаются при первом обращении к хранилищу - это время открытия архива после старта
+    holder: List[ScreenshotStorage] = []
+
+    def open_storage():
+        holder.append(ScreenshotStorage())
+        holder[-1].open()
+
+    results["load_metadata"] = measure(open_storage, min(read_repeat, 3))
+    storage = holder[-1]
+
+    # Самый большой пользовательский чат - худший случай для просмотра архива
+    user_key = max((key for key in storage.metadata if key != "user_0_chat_0"), key=lambda key: len(storage.metadata[key]))
+    user_id, chat_id = (int(part) for part in user_key.replace("user_", "").split("_chat_"))
+    entries = storage.metadata[user_key]
+    rnd = random.Random(seed)
+    label = rnd.choice(CUSTOM_LABELS)
+    date = rnd.choice(entries)["timestamp"][:8]
+    all_screenshots = storage.get_all_screenshots(user_id, chat_id)
+    # Квартал в середине двухлетнего архива: фильтр возвращает заметную часть записей
+    period = ("2025-01-01", "2025-03-31")
+    period_count = len(screenshot_stats.filter_by_period(all_screenshots, *period))
+    if not period_count:
+        raise RuntimeError(f"filter_by_period found nothing in {period} among {len(all_screenshots)} records")
+
+    reads: List[Tuple[str, Callable[[], object]]] = [
+        ("get_screenshots_by_label", lambda: storage.get_screenshots_by_label(label, user_id, chat_id)),
+        ("get_screenshots_by_date", lambda: storage.get_screenshots_by_date(date, user_id, chat_id)),
+        ("get_all_screenshots", lambda: storage.get_all_screenshots(user_id, chat_id)),
+        ("get_all_labels", lambda: storage.get_all_labels(user_id, chat_id)),
+        ("search_by_label", lambda: storage.search_by_label("отч", user_id, chat_id)),
+        ("filter_by_period", lambda: screenshot_stats.filter_by_period(all_screenshots, *period)),
+        ("get_total_monthly_stats", lambda: screenshot_stats.get_total_monthly_stats(all_screenshots)),
+    ]
+    for name, func in reads:
+        results[name] = measure(func, read_repeat)
+
+    images = [_png(rnd) for _ in range(write_repeat)]
+    saved: List[str] = []
+
+    def save():
+        data = images[len(saved) % len(images)]
+        saved.append(storage.save_screenshot(data, rnd.choice(CUSTOM_LABELS), user_id, chat_id,
+                                             sha256=hashlib.sha256(data).hexdigest()))
+
+    results["save_screenshot"] = measure(save, write_repeat)
+    results["delete_screenshot"] = measure(
+        lambda: storage.delete_screenshot(os.path.basename(saved.pop()), user_id, chat_id), write_repeat)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Dict]], baseline: Dict[str, Dict[str, Dict]],
+            threshold: float) -> List[str]:
+    """Operations whose median is more than `threshold` slower than in the baseline"""
+    regressions = []
+    for size, operations in results.items():
+        for name, current in operations.items():
+            previous = baseline.get(size, {}).get(name)
+            if not previous or not previous["median_ms"]:
+                continue
+            ratio = current["median_ms"] / previous["median_ms"]
+            current["baseline_median_ms"] = previous["median_ms"]
+            current["ratio"] = round(ratio, 3)
+            if ratio > 1 + threshold:
+                regressions.append(f"{name} @ {size}: {previous['median_ms']:.2f} -> {current['median_ms']:.2f} ms "
+                                   f"(x{ratio:.2f})")
+    return regressions
+
+
+def print_table(results: Dict[str, Dict[str, Dict]]) -> None:
+    for size, operations in results.items():
+        print(f"\n{int(size):,} records")
+        for name, result in operations.items():
+            ratio = f"  x{result['ratio']:.2f}" if "ratio" in result else ""
+            print(f"  {name:<26} median {result['median_ms']:>10.3f} ms  min {result['min_ms']:>10.3f} ms{ratio}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ScreenshotStorage and ScreenshotStats")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="records in the archive")
+    parser.add_argument("--read-repeat", type=int, default=20, help="runs of every read operation")
+    parser.add_argument("--write-repeat", type=int, default=5, help="runs of save and delete")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here (default: stdout only)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="results to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown of the median, 0.2 = 20%%")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    baseline_path = os.path.abspath(args.baseline)
+    output_path = os.path.abspath(args.output) if args.output else None
+    # Модули бота работают с относительной папкой screenshots, поэтому каждый архив - в своём каталоге
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    root = tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.chdir(root)
+    from logging_setup import setup_logging
+    setup_logging(level="WARNING", log_file=None)
+
+    results: Dict[str, Dict[str, Dict]] = {}
+    try:
+        for size in args.sizes:
+            print(f"Benchmarking {size:,} records...", file=sys.stderr)
+            results[str(size)] = run_size(size, os.path.join(root, str(size)), args.read_repeat,
+                                          args.write_repeat, args.seed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+    regressions: List[str] = []
+    if not args.save_baseline and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "threshold": args.threshold,
+        },
+        "results": results,
+        "regressions": regressions,
+    }
+    print_table(results)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+    if regressions:
+        print("\nRegressions:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
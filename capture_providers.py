@@ -0,0 +1,212 @@
+import hashlib
+import io
+import logging
+import random
+import time
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from config import (
+    APIFLASH_KEY,
+    APIFLASH_ENDPOINT,
+    APIFLASH_RESPONSE_TYPE,
+    CAPTURE_MAX_BYTES,
+    CAPTURE_CHUNK_SIZE,
+    CAPTURE_PROVIDER,
+    CAPTURE_CONNECT_TIMEOUT,
+    CAPTURE_READ_TIMEOUT,
+    SCREENSHOT_WIDTH,
+    SCREENSHOT_HEIGHT,
+    SCREENSHOT_QUALITY,
+    FAKE_CAPTURE_LATENCY,
+    FAKE_CAPTURE_WIDTH,
+    FAKE_CAPTURE_HEIGHT,
+    FAKE_CAPTURE_ERROR_RATE,
+)
+from metrics import capture_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureTooLargeError(ValueError):
+    """Raised when a capture exceeds CAPTURE_MAX_BYTES"""
+
+
+class CaptureResult:
+    """Captured image with its SHA-256 digest (hex)"""
+
+    def __init__(self, data: bytes, sha256: str):
+        self.data = data
+        self.sha256 = sha256
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CaptureResult":
+        return cls(data, hashlib.sha256(data).hexdigest())
+
+
+def read_stream(response: requests.Response, max_bytes: int = CAPTURE_MAX_BYTES) -> CaptureResult:
+    """
+    Read a streamed response chunk by chunk into memory.
+
+    The size limit is enforced while data arrives and the digest is
+    computed on the fly, so an oversized body is dropped early.
+    """
+    declared = response.headers.get("Content-Length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise CaptureTooLargeError(f"Capture is {declared} bytes, limit is {max_bytes}")
+
+    digest = hashlib.sha256()
+    # Снимок всё равно нужен целиком в памяти, поэтому сразу собираем его в bytearray
+    buffer = bytearray()
+    for chunk in response.iter_content(chunk_size=CAPTURE_CHUNK_SIZE):
+        if len(buffer) + len(chunk) > max_bytes:
+            raise CaptureTooLargeError(f"Capture exceeded {max_bytes} bytes")
+        digest.update(chunk)
+        buffer += chunk
+    return CaptureResult(bytes(buffer), digest.hexdigest())
+
+
+def attempt_timeout(timeout: Tuple[float, float], remaining: Optional[float]) -> Tuple[float, float]:
+    """(connect, read) timeout cut down to the seconds left before the retry deadline"""
+    if remaining is None:
+        return timeout
+    return min(timeout[0], remaining), min(timeout[1], remaining)
+
+
+class CaptureProvider(ABC):
+    """Backend that turns a sheet URL into an image"""
+
+    name = "base"
+    counts_quota = False  # True if every call is billed against the APIFlash quota
+
+    @abstractmethod
+    def capture(self, url: str, timeout: Optional[float] = None) -> CaptureResult:
+        """Capture `url` within `timeout` seconds if given; raise on any error (runs in a worker thread)"""
+
+
+APIFLASH_HOST = "api.apiflash.com"
+
+
+class APIFlashProvider(CaptureProvider):
+    """Screenshots through the APIFlash urltoimage API"""
+
+    name = "apiflash"
+    counts_quota = True
+
+    def __init__(self, endpoint: str = APIFLASH_ENDPOINT, access_key: str = APIFLASH_KEY,
+                 response_type: str = APIFLASH_RESPONSE_TYPE):
+        self.endpoint = endpoint
+        self.access_key = access_key
+        self.response_type = response_type
+        self.timeout = (CAPTURE_CONNECT_TIMEOUT, CAPTURE_READ_TIMEOUT)
+        # Квоту списывает только настоящий APIFlash; fake_apiflash.py и другие заглушки её не тратят
+        self.counts_quota = urlparse(endpoint).hostname == APIFLASH_HOST
+
+    def capture(self, url: str, timeout: Optional[float] = None) -> CaptureResult:
+        request_timeout = attempt_timeout(self.timeout, timeout)
+        params = {
+            'access_key': self.access_key,
+            'url': url,
+            'width': SCREENSHOT_WIDTH,
+            'height': SCREENSHOT_HEIGHT,
+            'quality': SCREENSHOT_QUALITY,
+            'full_page': True,
+            'response_type': self.response_type
+        }
+
+        if self.response_type == 'image':
+            # Картинка приходит в ответе на сам запрос - без второго запроса за файлом.
+            # Заголовки ответа приходят после рендера, поэтому до них - рендер, дальше - загрузка
+            with capture_seconds.time(provider=self.name, stage="render"):
+                response = requests.get(self.endpoint, params=params, timeout=request_timeout, stream=True)
+            with response:
+                response.raise_for_status()
+                with capture_seconds.time(provider=self.name, stage="download"):
+                    return read_stream(response)
+
+        with capture_seconds.time(provider=self.name, stage="render"):
+            response = requests.get(self.endpoint, params=params, timeout=request_timeout)
+            response.raise_for_status()
+
+        # Get the screenshot URL from the JSON response
+        screenshot_url = response.json().get('url')
+        if not screenshot_url:
+            raise ValueError("No screenshot URL in response")
+
+        # Download the actual screenshot
+        with capture_seconds.time(provider=self.name, stage="download"):
+            with requests.get(screenshot_url, timeout=request_timeout, stream=True) as screenshot_response:
+                screenshot_response.raise_for_status()
+                return read_stream(screenshot_response)
+
+
+def render_synthetic_sheet(width: int, height: int, seed: Optional[int] = None) -> bytes:
+    """Draw a spreadsheet-like PNG: header row, grid lines and random numbers"""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+
+    row_height = 24
+    column_width = 110
+    header_color = (232, 240, 254)
+    grid_color = (218, 220, 224)
+
+    draw.rectangle([0, 0, width, row_height], fill=header_color)
+    for x in range(0, width, column_width):
+        draw.line([(x, 0), (x, height)], fill=grid_color)
+    for y in range(0, height, row_height):
+        draw.line([(0, y), (width, y)], fill=grid_color)
+
+    for column, x in enumerate(range(0, width, column_width)):
+        draw.text((x + 6, 6), f"Колонка {column + 1}", fill=(60, 64, 67))
+        for y in range(row_height, height, row_height):
+            if rnd.random() < 0.7:
+                draw.text((x + 6, y + 6), f"{rnd.uniform(0, 10000):.2f}", fill=(32, 33, 36))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeCaptureProvider(CaptureProvider):
+    """Offline provider with synthetic images, configurable latency, size and error rate"""
+
+    name = "fake"
+    counts_quota = False
+
+    def __init__(self, latency: float = FAKE_CAPTURE_LATENCY, width: int = FAKE_CAPTURE_WIDTH,
+                 height: int = FAKE_CAPTURE_HEIGHT, error_rate: float = FAKE_CAPTURE_ERROR_RATE,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.width = width
+        self.height = height
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    def capture(self, url: str, timeout: Optional[float] = None) -> CaptureResult:
+        # Задержка с разбросом ±50%, как у настоящего рендера страницы
+        time.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.error_rate:
+            # ConnectionError считается временной ошибкой, как и сбой сети у APIFlash
+            raise requests.ConnectionError("Synthetic capture failure")
+        data = render_synthetic_sheet(self.width, self.height, self._random.randrange(2 ** 32))
+        return CaptureResult.from_bytes(data)
+
+
+CAPTURE_ENGINES = ("apiflash", "fake", "local")
+
+
+def get_capture_provider(name: str = CAPTURE_PROVIDER) -> CaptureProvider:
+    """Create capture provider by name"""
+    if name == "apiflash":
+        return APIFlashProvider()
+    if name == "fake":
+        return FakeCaptureProvider()
+    if name == "local":
+        from sheet_renderer import LocalSheetProvider
+        return LocalSheetProvider()
+    raise ValueError(f"Unknown capture provider: {name}")
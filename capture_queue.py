@@ -0,0 +1,217 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import SHEET_URL, CAPTURE_WORKERS, CAPTURE_QUEUE_MAX_DEPTH, CAPTURE_FALLBACK_URLS
+from quota import QuotaExceededError
+from resilience import CircuitOpenError
+from storage import screenshot_storage
+from utils import take_screenshot
+from metrics import registry, capture_queue_wait_seconds, capture_fallbacks
+from tracing import current_span, span
+
+logger = logging.getLogger(__name__)
+
+# Меньше - раньше. Плановые отчёты всегда идут впереди интерактивных запросов
+PRIORITY_SCHEDULED = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2  # расписания чатов: после интерактивных, квота как у интерактивных
+
+JobCallback = Callable[["CaptureJob"], Optional[Awaitable[None]]]
+
+
+class QueueFullError(Exception):
+    """Raised when an interactive or background capture is submitted to a full queue"""
+
+
+# Ссылки на задачи подписчиков, чтобы их не собрал сборщик мусора до завершения
+_subscriber_tasks: set = set()
+
+
+class CaptureJob:
+    """Single capture request; handlers can await it or subscribe to status changes"""
+
+    def __init__(self, job_id: int, url: str, priority: int, engine: Optional[str] = None):
+        self.id = job_id
+        self.url = url
+        self.priority = priority
+        self.engine = engine  # capture engine, None - CAPTURE_PROVIDER
+        self.status = "queued"  # queued -> running -> done | failed
+        self.result: Optional[bytes] = None
+        self.sha256: Optional[str] = None  # digest of the captured bytes
+        # 'cache' или 'archive', если отдан старый снимок вместо нового
+        self.fallback: Optional[str] = None
+        self.fallback_reason: Optional[str] = None  # 'quota' или 'outage'
+        self.created_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._done = asyncio.Event()
+        self._subscribers: List[JobCallback] = []
+        # Воркер продолжает трассу того, кто поставил снимок в очередь
+        self.trace_parent = current_span()
+
+    def subscribe(self, callback: JobCallback) -> None:
+        """Call `callback(job)` on every status change (sync or async callable)"""
+        self._subscribers.append(callback)
+
+    def _set_status(self, status: str) -> None:
+        """Notify subscribers; coroutines run as tasks so the worker never waits for Telegram"""
+        self.status = status
+        for callback in self._subscribers:
+            try:
+                result = callback(self)
+                if asyncio.iscoroutine(result):
+                    task = asyncio.create_task(result)
+                    _subscriber_tasks.add(task)
+                    task.add_done_callback(self._subscriber_done)
+            except Exception as e:
+                logger.warning(f"Capture job {self.id} subscriber failed: {e}")
+
+    def _subscriber_done(self, task: asyncio.Task) -> None:
+        _subscriber_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Capture job {self.id} subscriber failed: {task.exception()}")
+
+    async def wait(self) -> Optional[bytes]:
+        """Wait for the job to finish and return screenshot data (None on failure)"""
+        await self._done.wait()
+        return self.result
+
+
+class CaptureQueue:
+    """Priority queue of captures served by a fixed number of workers"""
+
+    def __init__(self, workers: int = CAPTURE_WORKERS, max_depth: int = CAPTURE_QUEUE_MAX_DEPTH,
+                 fallback_urls: int = CAPTURE_FALLBACK_URLS):
+        self.workers = workers
+        self.max_depth = max_depth
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._counter = itertools.count()
+        self._pending: List[CaptureJob] = []
+        self._tasks: List[asyncio.Task] = []
+        # url -> last successful capture; LRU, since chats can schedule any number of sheets
+        self.last_capture: "OrderedDict[str, bytes]" = OrderedDict()
+        self.fallback_urls = fallback_urls
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        return len(self._pending)
+
+    def position(self, job: CaptureJob) -> int:
+        """1-based place of a queued job in line, 0 if it is not waiting"""
+        ahead = sorted(self._pending, key=lambda j: (j.priority, j.id))
+        for index, pending_job in enumerate(ahead):
+            if pending_job is job:
+                return index + 1
+        return 0
+
+    def start(self) -> None:
+        """Start worker tasks (call from a running event loop)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        for pending_job in self._pending:
+            self._queue.put_nowait((pending_job.priority, pending_job.id, pending_job))
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logger.info(f"Capture queue started with {self.workers} workers, max depth {self.max_depth}")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, url: str = SHEET_URL, priority: int = PRIORITY_INTERACTIVE,
+               engine: Optional[str] = None) -> CaptureJob:
+        """Enqueue a capture; all but scheduled jobs are rejected when the queue is full"""
+        if priority != PRIORITY_SCHEDULED and self.depth >= self.max_depth:
+            logger.warning(f"Capture queue is full ({self.depth}), rejecting job with priority {priority}")
+            raise QueueFullError(f"Capture queue is full ({self.depth} jobs waiting)")
+
+        job = CaptureJob(next(self._counter), url, priority, engine)
+        self._pending.append(job)
+        if self._queue is not None:
+            self._queue.put_nowait((job.priority, job.id, job))
+        logger.info(f"Capture job {job.id} queued with priority {priority}, depth {self.depth}")
+        return job
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                self._pending.remove(job)
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"Capture worker {number} failed on job {job.id}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: CaptureJob) -> None:
+        job.started_at = time.monotonic()
+        capture_queue_wait_seconds.observe(job.started_at - job.created_at, priority=job.priority)
+        with span("capture_job", parent=job.trace_parent, job_id=job.id, priority=job.priority,
+                  queue_wait_ms=round((job.started_at - job.created_at) * 1000, 1)):
+            await self._capture(job)
+
+    async def _capture(self, job: CaptureJob) -> None:
+        job._set_status("running")
+        try:
+            # requests блокирует поток, поэтому снимок делается вне event loop
+            capture = await asyncio.to_thread(
+                take_screenshot, job.url, job.priority == PRIORITY_SCHEDULED, job.engine
+            )
+            if capture is not None:
+                job.result, job.sha256 = capture.data, capture.sha256
+                self._remember(job.url, job.result)
+        except QuotaExceededError:
+            job.fallback_reason = "quota"
+            job.result = await asyncio.to_thread(self._fallback, job)
+        except CircuitOpenError:
+            # APIFlash недоступен: не ждём таймаутов, сразу отдаём последний снимок
+            job.fallback_reason = "outage"
+            job.result = await asyncio.to_thread(self._fallback, job)
+        except Exception as e:
+            logger.error(f"Capture job {job.id} raised: {e}")
+            job.result = None
+        job.finished_at = time.monotonic()
+        if job.fallback:
+            capture_fallbacks.inc(source=job.fallback, reason=job.fallback_reason)
+        logger.info(
+            f"Capture job {job.id} finished in {job.finished_at - job.started_at:.1f}s "
+            f"after waiting {job.started_at - job.created_at:.1f}s"
+        )
+        job._set_status("done" if job.result is not None else "failed")
+        job._done.set()
+
+    def _remember(self, url: str, data: bytes) -> None:
+        self.last_capture[url] = data
+        self.last_capture.move_to_end(url)
+        while len(self.last_capture) > self.fallback_urls:
+            self.last_capture.popitem(last=False)
+
+    def _fallback(self, job: CaptureJob) -> Optional[bytes]:
+        """Last capture of this URL, otherwise its latest archived screenshot; never another sheet"""
+        if job.url in self.last_capture:
+            job.fallback = "cache"
+            logger.info(f"Capture job {job.id} served from cache: {job.fallback_reason}")
+            return self.last_capture[job.url]
+
+        latest = screenshot_storage.get_latest_screenshot(job.url)
+        if latest:
+            data = screenshot_storage.read_screenshot(latest)
+            if data is not None:
+                job.fallback = "archive"
+                logger.info(f"Capture job {job.id} served from archive {latest['filepath']}: {job.fallback_reason}")
+                return data
+        logger.warning(f"Capture job {job.id} has no fallback image of its sheet: {job.fallback_reason}")
+        return None
+
+
+capture_queue = CaptureQueue()
+
+registry.add_collector("bot_capture_queue_depth", "gauge", "Capture jobs waiting for a worker",
+                       lambda: [({}, capture_queue.depth)])
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import secrets
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pytz
+
+from config import CHAT_SCHEDULES_FILE, CHAT_SCHEDULES_MAX_PER_CHAT, CHAT_SCHEDULE_MIN_INTERVAL
+from cron import CronError, CronExpression
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleLimitError(Exception):
+    """Raised when a chat already has CHAT_SCHEDULES_MAX_PER_CHAT schedules"""
+
+
+class ChatSchedule:
+    """Cron schedule registered by a chat for one sheet"""
+
+    def __init__(self, schedule_id: str, chat_id: int, user_id: int, cron: str, sheet_url: str,
+                 label: Optional[str] = None, engine: Optional[str] = None, created_at: Optional[str] = None):
+        self.id = schedule_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.cron = cron
+        self.sheet_url = sheet_url
+        self.label = label  # None - "По расписанию <дата>"
+        self.engine = engine  # capture engine, None - CAPTURE_PROVIDER
+        self.created_at = created_at or datetime.now(pytz.UTC).isoformat()
+
+    @property
+    def job_name(self) -> str:
+        return f"chat_{self.chat_id}_{self.id}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "cron": self.cron,
+            "sheet_url": self.sheet_url,
+            "label": self.label,
+            "engine": self.engine,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ChatSchedule":
+        return cls(data["id"], data["chat_id"], data["user_id"], data["cron"], data["sheet_url"],
+                   data.get("label"), data.get("engine"), data.get("created_at"))
+
+
+class ChatScheduleStore:
+    """Schedules of all chats, persisted to a JSON file and indexed by chat"""
+
+    def __init__(self, path: str = CHAT_SCHEDULES_FILE, max_per_chat: int = CHAT_SCHEDULES_MAX_PER_CHAT,
+                 min_interval: int = CHAT_SCHEDULE_MIN_INTERVAL):
+        self.path = path
+        self.max_per_chat = max_per_chat
+        self.min_interval = min_interval  # minutes
+        self.by_chat: Dict[int, Dict[str, ChatSchedule]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f).get("schedules", [])
+        except Exception as e:
+            logger.error(f"Error loading chat schedules: {e}")
+            return
+        for item in items:
+            schedule = ChatSchedule.from_dict(item)
+            self.by_chat.setdefault(schedule.chat_id, {})[schedule.id] = schedule
+        logger.info(f"Loaded {len(items)} chat schedules")
+
+    def _save(self) -> None:
+        """Write schedules atomically so a crash never leaves a truncated file"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"schedules": [schedule.to_dict() for schedule in self.all()]}, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def all(self) -> List[ChatSchedule]:
+        return [schedule for schedules in self.by_chat.values() for schedule in schedules.values()]
+
+    def for_chat(self, chat_id: int) -> List[ChatSchedule]:
+        return sorted(self.by_chat.get(chat_id, {}).values(), key=lambda schedule: schedule.created_at)
+
+    def get(self, chat_id: int, schedule_id: str) -> Optional[ChatSchedule]:
+        return self.by_chat.get(chat_id, {}).get(schedule_id)
+
+    def add(self, chat_id: int, user_id: int, cron: str, sheet_url: str,
+            label: Optional[str] = None, engine: Optional[str] = None) -> ChatSchedule:
+        """Validate and store a new schedule; raises CronError or ScheduleLimitError"""
+        expression = CronExpression(cron)
+        # Каждый запуск тратит квоту APIFlash, поэтому чаще раза в min_interval минут снимать нельзя
+        if expression.min_interval < self.min_interval:
+            raise CronError(f"Runs {expression.min_interval} min apart, at least {self.min_interval} min required")
+        # '0 0 30 2 *' разбирается, но никогда не срабатывает: такое расписание только заняло бы место
+        expression.next_after(datetime.now())
+        cron = str(expression)
+        chat_schedules = self.by_chat.setdefault(chat_id, {})
+        if len(chat_schedules) >= self.max_per_chat:
+            raise ScheduleLimitError(f"Chat {chat_id} already has {len(chat_schedules)} schedules")
+        schedule_id = secrets.token_hex(3)
+        while schedule_id in chat_schedules:
+            schedule_id = secrets.token_hex(3)
+        schedule = ChatSchedule(schedule_id, chat_id, user_id, cron, sheet_url, label, engine)
+        chat_schedules[schedule_id] = schedule
+        self._save()
+        logger.info(f"Added schedule {schedule_id} '{cron}' for chat {chat_id}")
+        return schedule
+
+    def remove(self, chat_id: int, schedule_id: str) -> Optional[ChatSchedule]:
+        schedule = self.by_chat.get(chat_id, {}).pop(schedule_id, None)
+        if schedule is None:
+            return None
+        if not self.by_chat[chat_id]:
+            del self.by_chat[chat_id]
+        self._save()
+        logger.info(f"Removed schedule {schedule_id} of chat {chat_id}")
+        return schedule
+
+
+chat_schedule_store = ChatScheduleStore()
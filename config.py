@@ -23,4 +23,148 @@ SCREENSHOT_QUALITY = 100
 CACHE_DURATION = 3600  # 1 hour in seconds
 
 # Supported image formats
-SUPPORTED_FORMATS = ['PNG', 'JPEG', 'WEBP']
\ No newline at end of file
+SUPPORTED_FORMATS = ['PNG', 'JPEG', 'WEBP']
+
+# Telegram Bot API rate limits
+TELEGRAM_GLOBAL_RATE = 30  # messages per second across all chats
+TELEGRAM_CHAT_RATE = 1  # messages per second in a private chat
+TELEGRAM_GROUP_RATE_PER_MINUTE = 20  # messages per minute in a group
+TELEGRAM_CHAT_BURST = 4  # messages a private chat may send at once before the rate applies
+TELEGRAM_GROUP_BURST = 3  # same for groups
+TELEGRAM_MAX_RETRIES = 3  # retries after 429 Too Many Requests
+TELEGRAM_MAX_TRACKED_CHATS = 10000  # per-chat buckets kept in memory
+
+# Update delivery: 'polling' or 'webhook'
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook settings (used when BOT_MODE is 'webhook')
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # public https URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_DRAIN_TIMEOUT = 30  # seconds to finish accepted updates on shutdown
+
+# Conversation state (FSM) storage: 'memory', 'sqlite' or 'redis'
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "screenshots/fsm.sqlite3")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # fakeredis:// for a local stand-in
+FSM_STATE_TTL = 24 * 3600  # seconds a user's state and data live after the last change
+
+# Temporary screenshots waiting to be archived
+TEMP_DIR = os.path.join("screenshots", "temp")
+TEMP_FILE_TTL = 3600  # 1 hour in seconds
+TEMP_SWEEP_INTERVAL = 60  # seconds between sweeps of expired temp files
+
+# Capture job queue
+CAPTURE_WORKERS = int(os.getenv("CAPTURE_WORKERS", "2"))  # concurrent APIFlash requests
+CAPTURE_QUEUE_MAX_DEPTH = int(os.getenv("CAPTURE_QUEUE_MAX_DEPTH", "10"))  # waiting interactive jobs before rejecting
+CAPTURE_FALLBACK_URLS = int(os.getenv("CAPTURE_FALLBACK_URLS", "16"))  # sheet URLs whose last capture is kept in memory for fallbacks
+
+# APIFlash quota
+APIFLASH_MONTHLY_LIMIT = int(os.getenv("APIFLASH_MONTHLY_LIMIT", "100"))  # captures included in the plan
+APIFLASH_RESERVE_MARGIN = 2  # extra calls kept for scheduled retries on top of the computed reserve
+QUOTA_FILE = os.path.join("screenshots", "quota.json")
+
+# Capture backend resilience
+CAPTURE_CONNECT_TIMEOUT = 5  # seconds to connect to APIFlash
+CAPTURE_READ_TIMEOUT = 60  # seconds to wait for a rendered page
+CAPTURE_RETRY_ATTEMPTS = 3  # attempts per capture for transient errors
+CAPTURE_RETRY_BASE_DELAY = 1.0  # first backoff delay, doubled on every retry
+CAPTURE_RETRY_MAX_DELAY = 10.0  # cap for a single backoff delay
+CAPTURE_RETRY_DEADLINE = 90  # seconds a capture may spend on all attempts
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive transient failures that open the circuit
+BREAKER_RESET_TIMEOUT = 60  # seconds before a trial request is let through
+
+# Capture provider: 'apiflash' or 'fake' (synthetic images, no quota used)
+CAPTURE_PROVIDER = os.getenv("CAPTURE_PROVIDER", "apiflash")
+APIFLASH_ENDPOINT = os.getenv("APIFLASH_ENDPOINT", "https://api.apiflash.com/v1/urltoimage")  # point at fake_apiflash.py for offline runs
+FAKE_CAPTURE_LATENCY = float(os.getenv("FAKE_CAPTURE_LATENCY", "0.5"))  # seconds per capture
+FAKE_CAPTURE_WIDTH = int(os.getenv("FAKE_CAPTURE_WIDTH", "1220"))
+FAKE_CAPTURE_HEIGHT = int(os.getenv("FAKE_CAPTURE_HEIGHT", "1000"))
+FAKE_CAPTURE_ERROR_RATE = float(os.getenv("FAKE_CAPTURE_ERROR_RATE", "0"))  # share of captures failing with a transient error
+
+# Capture download
+APIFLASH_RESPONSE_TYPE = os.getenv("APIFLASH_RESPONSE_TYPE", "image")  # 'image' streams in one request, 'json' adds a second download
+CAPTURE_MAX_BYTES = 10 * 1024 * 1024  # Telegram photo upload limit
+CAPTURE_CHUNK_SIZE = 64 * 1024
+
+# Local sheet renderer (capture engine 'local'): renders the CSV/XLSX export with Pillow
+LOCAL_RENDER_EXPORT_FORMAT = os.getenv("LOCAL_RENDER_EXPORT_FORMAT", "csv")  # 'csv' (uses gid) or 'xlsx' (first sheet)
+LOCAL_RENDER_SOURCE = os.getenv("LOCAL_RENDER_SOURCE", "")  # local export file to render instead of downloading
+LOCAL_RENDER_FONT = os.getenv("LOCAL_RENDER_FONT", "DejaVuSans.ttf")
+LOCAL_RENDER_BOLD_FONT = os.getenv("LOCAL_RENDER_BOLD_FONT", "DejaVuSans-Bold.ttf")
+LOCAL_RENDER_FONT_SIZE = 14
+LOCAL_RENDER_MAX_ROWS = 500
+LOCAL_RENDER_MAX_COLUMNS = 50
+LOCAL_RENDER_MAX_COLUMN_WIDTH = 400  # pixels; longer cell text is cut with an ellipsis
+
+# Capture engine for scheduled reports; empty means CAPTURE_PROVIDER
+SCHEDULE_CAPTURE_ENGINE = os.getenv("SCHEDULE_CAPTURE_ENGINE", "")
+
+# Perceptual-hash duplicate suppression for scheduled captures
+PHASH_DUPLICATE_THRESHOLD = int(os.getenv("PHASH_DUPLICATE_THRESHOLD", "0"))  # max differing bits; larger values may hide small edits in the sheet
+
+# Visual diff between two screenshots
+DIFF_PIXEL_THRESHOLD = 24  # grayscale difference (0-255) that counts as a changed pixel
+DIFF_BLOCK_SIZE = 16  # pixels per side of a diff block
+DIFF_STRIP_HEIGHT = 512  # rows compared at once; bounds NumPy memory for tall captures
+
+# Scheduler
+SCHEDULE_TIMEZONE = os.getenv("SCHEDULE_TIMEZONE", "UTC")
+DAILY_CHECK_TIME = "00:01"  # start/middle/end of month check
+DAILY_REPORT_TIME = "23:00"  # daily report
+SCHEDULER_STATE_FILE = os.path.join("screenshots", "scheduler_state.json")  # last-run markers
+SCHEDULER_RESTART_DELAY = 60  # seconds before the supervisor restarts a crashed scheduler loop
+SCHEDULER_MAX_SLEEP = 3600  # re-check the heap at least this often (clock jumps, DST)
+
+# Chat schedules
+CHAT_SCHEDULES_FILE = os.path.join("screenshots", "chat_schedules.json")
+CHAT_SCHEDULES_MAX_PER_CHAT = int(os.getenv("CHAT_SCHEDULES_MAX_PER_CHAT", "5"))
+CHAT_SCHEDULE_JITTER = int(os.getenv("CHAT_SCHEDULE_JITTER", "300"))  # max seconds a run is shifted to spread captures
+CHAT_SCHEDULE_MIN_INTERVAL = int(os.getenv("CHAT_SCHEDULE_MIN_INTERVAL", "60"))  # minutes between runs of one schedule
+
+# Archive segments
+SEGMENT_PACK_TIME = "03:30"  # daily packing of closed months into segment files
+SEGMENT_READER_CACHE = 32  # segments kept memory-mapped at once
+
+# Tiering of cold screenshots
+TIERING_FORMAT = os.getenv("TIERING_FORMAT", "webp")  # webp or avif (avif needs Pillow with AVIF support)
+TIERING_AGE_DAYS = int(os.getenv("TIERING_AGE_DAYS", "30"))  # screenshots older than this are recompressed
+TIERING_QUALITY = int(os.getenv("TIERING_QUALITY", "80"))
+TIERING_TIME = "04:00"  # daily tiering run
+TIERING_WORKERS = 2  # processes recompressing images
+TIERING_BATCH_SIZE = 8  # images held in memory per batch
+TIERING_MIN_SAVING = 0.1  # keep the original unless the result is at least 10% smaller
+TIERING_MAX_MEAN_ERROR = 2.0  # verification: mean grayscale difference (0-255) between original and result
+ARCHIVE_DISK_BUDGET_MB = int(os.getenv("ARCHIVE_DISK_BUDGET_MB", "0"))  # 0 - no budget
+TIERING_PRESSURE_AGE_DAYS = 3  # minimal age when the archive is over budget
+TIERING_PRESSURE_QUALITY = 60  # quality when the archive is over budget
+
+# ZIP export of archive selections
+EXPORT_PART_MAX_BYTES = 48 * 1000 * 1000  # one document per part, below Telegram's 50 MB upload limit for bots
+EXPORT_SPOOL_MAX_MEMORY = 4 * 1024 * 1024  # a part bigger than this is spooled to a temp file in TEMP_DIR
+EXPORT_CHUNK_SIZE = 256 * 1024  # copy and upload chunk
+EXPORT_MAX_CONCURRENT = 2  # exports built at the same time
+
+# Metrics endpoint (Prometheus text format)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the endpoint
+
+# Tracing of updates (spans per handler, capture, processing and delivery)
+TRACE_SINK = os.getenv("TRACE_SINK", "jsonl")  # jsonl, otlp or none
+TRACE_FILE = os.path.join("logs", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")  # OTLP/HTTP JSON
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # share of traces recorded
+TRACE_SERVICE_NAME = "sheet-screenshot-bot"
+TRACE_EXPORT_INTERVAL = 1.0  # seconds between batches written by the exporter thread
+TRACE_EXPORT_BATCH = 512  # spans per batch
+
+# Logging (see logging_setup.py)
+LOG_FILE = os.path.join("logs", "telegram_bot.log")
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiohttp.access=WARNING")  # per-module levels: "storage=DEBUG,aiogram=WARNING"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate the log file at this size
+LOG_BACKUP_COUNT = 5  # rotated files kept
+LOG_SAMPLE_EVERY = 100  # per-record debug lines: the first and every N-th of each message are written
@@ -0,0 +1,110 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Set
+
+logger = logging.getLogger(__name__)
+
+ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+# minute, hour, day of month, month, day of week (0 and 7 are Sunday)
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+FIELD_NAMES = ["minute", "hour", "day of month", "month", "day of week"]
+
+MAX_ITERATIONS = 10000  # field jumps before giving up on an expression that never fires
+
+
+class CronError(ValueError):
+    """Invalid cron expression"""
+
+
+def _parse_field(text: str, low: int, high: int, name: str) -> Set[int]:
+    values: Set[int] = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            if not step_text.isdigit() or int(step_text) == 0:
+                raise CronError(f"Bad step in {name}: {step_text}")
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            if not start_text.isdigit() or not end_text.isdigit():
+                raise CronError(f"Bad range in {name}: {part}")
+            start, end = int(start_text), int(end_text)
+        elif part.isdigit():
+            start = int(part)
+            end = high if step > 1 else start
+        else:
+            raise CronError(f"Bad value in {name}: {part}")
+        if start < low or end > high or start > end:
+            raise CronError(f"{name} must be within {low}-{high}: {part}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    """
+    Standard five-field cron expression (minute hour day month weekday).
+
+    Supports *, lists, ranges, steps and @hourly/@daily/@weekly/@monthly/@yearly.
+    As in cron, when both day fields are restricted a day matches either of them.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = " ".join(expression.split())
+        fields = ALIASES.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise CronError("Cron expression needs 5 fields: minute hour day month weekday")
+        parsed = [_parse_field(text, low, high, name)
+                  for text, (low, high), name in zip(fields, FIELD_RANGES, FIELD_NAMES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        self.day_restricted = fields[2] != "*"
+        self.weekday_restricted = fields[4] != "*"
+
+    def __str__(self) -> str:
+        return self.expression
+
+    @property
+    def min_interval(self) -> int:
+        """Shortest gap in minutes between two runs, counting the wrap from one day to the next"""
+        times = sorted(hour * 60 + minute for hour in self.hours for minute in self.minutes)
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        gaps.append(times[0] + 24 * 60 - times[-1])
+        return min(gaps)
+
+    def _day_matches(self, moment: datetime) -> bool:
+        in_days = moment.day in self.days
+        # datetime: понедельник = 0, cron: воскресенье = 0
+        in_weekdays = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.day_restricted and self.weekday_restricted:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """First matching minute strictly after the naive wall-clock `moment`"""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Перескакиваем сразу на следующий месяц/день/час, а не перебираем минуты
+        for _ in range(MAX_ITERATIONS):
+            if candidate.month not in self.months:
+                year, month = divmod(candidate.month, 12)
+                candidate = candidate.replace(year=candidate.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise CronError(f"Cron expression never fires: {self.expression}")
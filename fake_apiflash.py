@@ -0,0 +1,89 @@
+"""
+Local stand-in for the APIFlash urltoimage API.
+
+    python fake_apiflash.py --port 8900 --latency 0.5 --error-rate 0.05
+    APIFLASH_ENDPOINT=http://127.0.0.1:8900/v1/urltoimage python bot.py
+
+Answers like the real API (response_type json or image) with synthetic
+sheet images, so the whole HTTP pipeline can be load-tested. Captures are
+charged to screenshots/quota.json only when the endpoint is api.apiflash.com,
+so runs against this server leave the quota ledger alone. To test without
+any HTTP at all use CAPTURE_PROVIDER=fake instead.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import secrets
+from collections import OrderedDict
+
+from aiohttp import web
+
+from capture_providers import render_synthetic_sheet
+from config import FAKE_CAPTURE_LATENCY, FAKE_CAPTURE_WIDTH, FAKE_CAPTURE_HEIGHT, FAKE_CAPTURE_ERROR_RATE
+
+logger = logging.getLogger(__name__)
+
+MAX_STORED_IMAGES = 100  # images kept for the json flow before the oldest is dropped
+
+
+def create_app(latency: float = FAKE_CAPTURE_LATENCY, width: int = FAKE_CAPTURE_WIDTH,
+               height: int = FAKE_CAPTURE_HEIGHT, error_rate: float = FAKE_CAPTURE_ERROR_RATE) -> web.Application:
+    images: "OrderedDict[str, bytes]" = OrderedDict()
+    stats = {"requests": 0, "errors": 0}
+
+    async def urltoimage(request: web.Request) -> web.Response:
+        stats["requests"] += 1
+        if not request.query.get("access_key") or not request.query.get("url"):
+            return web.json_response({"error": "access_key and url are required"}, status=400)
+
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response({"error": "Synthetic failure"}, status=503)
+
+        data = await asyncio.to_thread(render_synthetic_sheet, width, height)
+        if request.query.get("response_type", "image") == "image":
+            return web.Response(body=data, content_type="image/png")
+
+        image_id = secrets.token_hex(8)
+        images[image_id] = data
+        while len(images) > MAX_STORED_IMAGES:
+            images.popitem(last=False)
+        image_url = f"{request.scheme}://{request.host}/images/{image_id}.png"
+        return web.json_response({"url": image_url})
+
+    async def image(request: web.Request) -> web.Response:
+        data = images.get(request.match_info["image_id"])
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/png")
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response({**stats, "stored_images": len(images)})
+
+    app = web.Application()
+    app.router.add_get("/v1/urltoimage", urltoimage)
+    app.router.add_get("/images/{image_id}.png", image)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake APIFlash server with synthetic sheet images")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=FAKE_CAPTURE_LATENCY, help="mean seconds per capture")
+    parser.add_argument("--width", type=int, default=FAKE_CAPTURE_WIDTH)
+    parser.add_argument("--height", type=int, default=FAKE_CAPTURE_HEIGHT)
+    parser.add_argument("--error-rate", type=float, default=FAKE_CAPTURE_ERROR_RATE, help="share of 503 answers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info(f"Fake APIFlash on http://{args.host}:{args.port}/v1/urltoimage")
+    app = create_app(args.latency, args.width, args.height, args.error_rate)
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
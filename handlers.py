@@ -1,27 +1,32 @@
 import logging
 import asyncio
 import os
+import re
 import tempfile
 from datetime import datetime, timedelta
 from typing import List, Dict, Set
-from collections import defaultdict
+from urllib.parse import urlparse
 import pytz
 
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram import types, Dispatcher
 
-from storage import ScreenshotStorage
+from storage import screenshot_storage
 from config import SHEET_URL
-from utils import take_screenshot, screenshot_stats
-from image_processor import ImageProcessor
-
-# Initialize storage and state variables
-screenshot_storage = ScreenshotStorage()
-temp_files: Dict[str, str] = {}  # Map of file_id to filepath
-selected_screenshots: Dict[str, Set[str]] = defaultdict(set)  # Map of user_key to set of selected filenames
+from utils import screenshot_stats
+from capture_queue import capture_queue, QueueFullError, PRIORITY_INTERACTIVE
+from chat_schedules import chat_schedule_store, ScheduleLimitError
+from cron import CronError
+from capture_providers import CAPTURE_ENGINES
+from scheduler import schedule_chat_job, unschedule_chat_job
+from temp_artifacts import temp_artifacts
+from archive_export import select_export, plan_parts, part_documents
+from tracing import span, traced
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -37,6 +42,38 @@ def log_action(action: str, details: str = None):
 
 router = Router()
 
+class ArchiveStates(StatesGroup):
+    """Conversation states that wait for a text message from the user"""
+    waiting_search_query = State()
+    waiting_custom_label = State()
+
+# Состояние диалога хранится в FSM-хранилище диспетчера (см. state_storage.py):
+# data["selected"] - выбранные для удаления файлы,
+# data["labeling_file_id"] - временный файл, для которого ожидается метка
+
+async def get_selected(state: FSMContext) -> Set[str]:
+    """Get filenames selected by the user for deletion"""
+    data = await state.get_data()
+    return set(data.get("selected", []))
+
+async def save_selected(state: FSMContext, selected: Set[str]) -> None:
+    """Store filenames selected by the user for deletion"""
+    await state.update_data(selected=sorted(selected))
+
+def screenshot_input_file(info: Dict):
+    """Telegram input file for an archived screenshot, loose or packed, original or tiered"""
+    filename = os.path.basename(info["filepath"])
+    if info.get("tier"):
+        filename = f"{os.path.splitext(filename)[0]}.{info['tier']}"
+    if info.get("tier") == "avif":
+        # Telegram не принимает AVIF как фото
+        from image_processor import ImageProcessor
+        data = ImageProcessor.convert_format(screenshot_storage.read_screenshot(info), "PNG")
+        return BufferedInputFile(data, filename=f"{os.path.splitext(filename)[0]}.png")
+    if info.get("segment"):
+        return BufferedInputFile(screenshot_storage.read_screenshot(info), filename=filename)
+    return FSInputFile(screenshot_storage.data_path(info))
+
 def register_handlers(dp: Dispatcher):
     """Register all handlers"""
     try:
@@ -90,6 +127,7 @@ async def handle_start(message: Message):
         logger.error(f"Error in start handler: {e}")
         await message.answer("Произошла ошибка при запуске бота. Пожалуйста, попробуйте позже.")
 
+@traced()
 async def show_main_menu(message: Message):
     """Show main menu with animated buttons"""
     keyboard = [
@@ -98,6 +136,7 @@ async def show_main_menu(message: Message):
             create_animated_button("⚙️ Пресеты", "presets_menu")
         ],
         [
+            create_animated_button("⚡ Быстрый снимок", "take_screenshot_local"),
             create_animated_button("📂 Архив", "view_archive")
         ],
         [
@@ -119,7 +158,7 @@ async def show_main_menu(message: Message):
         "Я - бот для создания скриншотов Google таблиц.\n\n"
         "📊 Статистика за месяц:\n"
         f"• Создано скриншотов: {monthly_stats['total_this_month']}\n"
-        f"• Осталось: {monthly_stats['remaining_limit']} из 100\n"
+        f"• Осталось: {monthly_stats['remaining_limit']} из {monthly_stats['monthly_limit']}\n"
         f"• Использовано: {monthly_stats['usage_percent']:.1f}%\n\n"
         "Возможности:\n"
         "• Создание качественных скриншотов\n"
@@ -193,42 +232,47 @@ async def handle_presets_menu(message: Message):
 
 
 # Добавляем расширенное логирование для обработчика скриншотов
-async def handle_screenshot(message: Message, preset: str = None):
-    """Take and process screenshot with animated progress"""
+async def handle_screenshot(message: Message, preset: str = None, engine: str = None):
+    """Take and process screenshot with animated progress (engine: capture engine, None - default)"""
     status_message = None
-    tmp_filename = None
-    
-    try:
-        # Create the screenshots directory if it doesn't exist
-        screenshots_dir = 'screenshots'
-        temp_dir = os.path.join(screenshots_dir, 'temp')
-        os.makedirs(screenshots_dir, exist_ok=True)
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Ensure cleanup of old temp files
-        for f in os.listdir(temp_dir):
-            if f.startswith('screenshot_'):
-                try:
-                    file_path = os.path.join(temp_dir, f)
-                    file_age = datetime.now() - datetime.fromtimestamp(os.path.getctime(file_path))
-                    if file_age > timedelta(hours=1):
-                        os.unlink(file_path)
-                        logger.info(f"Cleaned up old temp file: {f}")
-                except Exception as e:
-                    logger.warning(f"Failed to cleanup temp file {f}: {e}")
+    file_id = None
+    photo_sent = False
+
+    try:
+        # Старые временные файлы удаляет фоновый sweeper (temp_artifacts.py)
         log_action("screenshot_start", f"Starting screenshot process with preset: {preset}")
 
+        # Ставим снимок в очередь сразу, чтобы он делался параллельно с анимацией
+        try:
+            job = capture_queue.submit(SHEET_URL, PRIORITY_INTERACTIVE, engine)
+        except QueueFullError:
+            log_action("queue_full", "Capture queue is full, request rejected")
+            await message.answer(
+                "⏳ Сейчас создаётся слишком много скриншотов. Пожалуйста, попробуйте через минуту."
+            )
+            return
+
         # Начальное сообщение о статусе
         status_message = await message.answer("🔄 Начинаю создание скриншота...")
         log_action("progress_bar_start", "Showing animated progress bar")
 
-        # Показываем анимированный прогресс-бар
-        await animated_progress_bar(status_message)
+        # Показываем анимированный прогресс-бар; локальный рендер быстрее самой анимации
+        if engine != "local":
+            await animated_progress_bar(status_message)
 
         # Уведомление о запросе к APIFlash
-        await status_message.edit_text("📸 Получаю скриншот таблицы...")
-        log_action("apiflash_request", "Requesting screenshot from APIFlash")
-        screenshot_data = take_screenshot(SHEET_URL)
+        position = capture_queue.position(job)
+        if position:
+            await status_message.edit_text(f"⏳ Скриншот в очереди, позиция: {position}")
+            job.subscribe(
+                lambda j: status_message.edit_text("📸 Получаю скриншот таблицы...")
+                if j.status == "running" else None
+            )
+        elif job.status == "running":
+            await status_message.edit_text("📸 Получаю скриншот таблицы...")
+        log_action("apiflash_request", f"Waiting for capture job {job.id}")
+        with span("capture_wait", job_id=job.id):
+            screenshot_data = await job.wait()
 
         if screenshot_data is None:
             log_action("screenshot_error", "Failed to take screenshot")
@@ -242,28 +286,18 @@ async def handle_screenshot(message: Message, preset: str = None):
             # Уведомление о применении пресета
             await status_message.edit_text(f"✨ Применяю пресет улучшения: {preset}...")
             await animated_progress_bar(status_message, total_steps=3)
-            screenshot_data = ImageProcessor.process_image(screenshot_data, preset)
+            with span("process_image", preset=preset):
+                from image_processor import ImageProcessor
+                screenshot_data = ImageProcessor.process_image(screenshot_data, preset)
 
         # Уведомление о сохранении и отправке
         await status_message.edit_text("💾 Сохраняю результат...")
         log_action("save_result", "Saving processed screenshot")
 
-        # Создаем временный файл в директории screenshots
+        # Создаем временный файл с уникальным идентификатором
         try:
-            # Create temporary directory in the project root
-            temp_dir = os.path.join('screenshots', 'temp')
-            os.makedirs(temp_dir, exist_ok=True)
-            tmp_filename = os.path.join(temp_dir, f'screenshot_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            logger.info(f"Saving temporary file to: {tmp_filename}")
-
-            try:
-                with open(tmp_filename, 'wb') as tmp_file:
-                    tmp_file.write(screenshot_data)
-                logger.info(f"Screenshot saved successfully to {tmp_filename}")
-            except Exception as e:
-                logger.error(f"Failed to save screenshot: {e}")
-                raise
-
+            with span("temp_write", size=len(screenshot_data)):
+                file_id, tmp_filename = temp_artifacts.create(screenshot_data)
             logger.info(f"Temporary file created successfully at: {tmp_filename}")
         except Exception as e:
             logger.error(f"Error creating temporary file: {e}")
@@ -283,29 +317,32 @@ async def handle_screenshot(message: Message, preset: str = None):
             await status_message.edit_text("✅ Скриншот готов! Отправляю...")
 
             caption = "📸 Скриншот таблицы"
+            if engine == "local":
+                caption = "⚡ Таблица из выгрузки"
             if preset:
                 caption += f" ✨ (Пресет: {preset_names.get(preset, preset)})"
-
-            photo = FSInputFile(tmp_filename)
-            # Создаем короткий идентификатор для временного файла
-            file_id = datetime.now().strftime("%H%M%S")
+            if job.fallback_reason == "quota":
+                # Лимит APIFlash на месяц почти исчерпан, остаток оставлен плановым отчётам
+                caption += "\n⚠️ Лимит скриншотов на месяц исчерпан, показан последний сохранённый снимок"
+            elif job.fallback_reason == "outage":
+                caption += "\n⚠️ Сервис скриншотов временно недоступен, показан последний сохранённый снимок"
+
+            # Отправляем из памяти, не перечитывая временный файл
+            photo = BufferedInputFile(screenshot_data, filename=os.path.basename(tmp_filename))
             keyboard = [[
                 InlineKeyboardButton(text="📥 Добавить в архив", callback_data=f"archive_{file_id}")
             ]]
-            # Сохраняем путь к файлу во временное хранилище
-            temp_files[file_id] = tmp_filename
-            await message.answer_photo(
-                photo=photo,
-                caption=caption,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
+            with span("deliver", size=len(screenshot_data)):
+                await message.answer_photo(
+                    photo=photo,
+                    caption=caption,
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+                )
+            photo_sent = True
             await status_message.delete()
             log_action("process_complete", "Screenshot process completed successfully")
         except Exception as e:
             logger.error(f"Error in sending photo: {e}")
-            # Clean up temporary file only on error
-            if os.path.exists(tmp_filename):
-                os.unlink(tmp_filename)
             raise
 
         # Автоматически показываем главное меню
@@ -329,13 +366,9 @@ async def handle_screenshot(message: Message, preset: str = None):
                 except Exception as e3:
                     logger.error(f"Failed to send error message: {e3}")
         
-        # Cleanup any temporary files
-        if tmp_filename and os.path.exists(tmp_filename):
-            try:
-                os.unlink(tmp_filename)
-                logger.info(f"Cleaned up temporary file after error: {tmp_filename}")
-            except Exception as e4:
-                logger.error(f"Failed to cleanup temp file: {e4}")
+        # После отправки фото файл нужен кнопке "Добавить в архив", его удалит sweeper по сроку
+        if file_id and not photo_sent:
+            temp_artifacts.discard(file_id)
 
 @router.message(F.text == "❓ Помощь")
 async def handle_help_button(message: Message):
@@ -344,7 +377,10 @@ async def handle_help_button(message: Message):
         help_text = (
             "📋 Доступные команды:\n\n"
             "/start - Запустить бота и открыть главное меню\n"
-            "/help - Показать это сообщение\n\n"
+            "/help - Показать это сообщение\n"
+            "/schedule <cron> [ссылка] [engine=движок] [метка] - Снимать таблицу по расписанию\n"
+            "/schedules - Расписания этого чата\n"
+            "/export <метка | дата | месяц | период> - Скачать скриншоты ZIP-архивом\n\n"
             "🔧 Возможности:\n"
             "• Создание скриншотов Google таблиц\n"
             "• Улучшение качества изображения с разными пресетами:\n"
@@ -398,6 +434,12 @@ async def handle_take_screenshot_callback(callback: CallbackQuery):
     await callback.answer()
     await handle_screenshot_request(callback.message)
 
+@router.callback_query(F.data == "take_screenshot_local")
+async def handle_take_local_screenshot_callback(callback: CallbackQuery):
+    """Render the sheet export locally: faster and does not use the APIFlash quota"""
+    await callback.answer("Рисую таблицу из выгрузки...")
+    await handle_screenshot(callback.message, engine="local")
+
 @router.callback_query(F.data == "presets_menu")
 async def handle_presets_menu_callback(callback: CallbackQuery):
     """Handle presets menu button press from main menu"""
@@ -411,9 +453,10 @@ async def handle_help_menu_callback(callback: CallbackQuery):
     await handle_help_button(callback.message)
 
 @router.callback_query(F.data.startswith("select_"))
-async def handle_screenshot_selection(callback: CallbackQuery):
+async def handle_screenshot_selection(callback: CallbackQuery, state: FSMContext):
     """Handle screenshot selection for multiple deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         filename = callback.data.replace("select_", "")
@@ -421,7 +464,7 @@ async def handle_screenshot_selection(callback: CallbackQuery):
         
         logger.info(f"[SELECTION] Processing selection for file: {filename}")
         logger.info(f"[SELECTION] User key: {user_key}")
-        logger.info(f"[SELECTION] Current selected files: {selected_screenshots.get(user_key, set())}")
+        logger.info(f"[SELECTION] Current selected files: {selected}")
 
         # Get all available screenshots
         screenshots = screenshot_storage.get_all_screenshots(user_id, chat_id)
@@ -433,30 +476,29 @@ async def handle_screenshot_selection(callback: CallbackQuery):
             await callback.answer("❌ Файл не найден")
             return
 
-        # Initialize set if needed
-        if user_key not in selected_screenshots:
-            selected_screenshots[user_key] = set()
-
         # Toggle selection using basename
-        if filename in selected_screenshots[user_key]:
-            selected_screenshots[user_key].remove(filename)
+        if filename in selected:
+            selected.remove(filename)
+            await save_selected(state, selected)
             logger.info(f"[SELECTION] Removed {filename} from selection")
             await callback.answer("❌ Скриншот убран из выбранных")
         else:
-            selected_screenshots[user_key].add(filename)
-            logger.info(f"[SELECTION] Added {filename} to selection. Current selection: {selected_screenshots[user_key]}")
+            selected.add(filename)
+            await save_selected(state, selected)
+            logger.info(f"[SELECTION] Added {filename} to selection. Current selection: {selected}")
             await callback.answer("✅ Скриншот добавлен к выбранным")
 
         # Update interface
-        await update_screenshot_message(callback.message, user_id, chat_id)
+        await update_screenshot_message(callback.message, user_id, chat_id, state)
 
     except Exception as e:
         logger.error(f"[SELECTION] Error in screenshot selection: {e}", exc_info=True)
         await callback.answer("❌ Произошла ошибка при выборе скриншота")
 
-async def update_screenshot_message(message: Message, user_id: int, chat_id: int):
+async def update_screenshot_message(message: Message, user_id: int, chat_id: int, state: FSMContext):
     """Update message with selected screenshots"""
     try:
+        selected = await get_selected(state)
         logger.info("[UPDATE_MESSAGE] Starting message update")
         user_key = f"user_{user_id}"
         
@@ -474,21 +516,17 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
             logger.error("[UPDATE_MESSAGE] Cannot find category in message text")
             return
 
-        # Инициализируем множество, если его еще нет
-        if user_key not in selected_screenshots:
-            selected_screenshots[user_key] = set()
-
         keyboard = []
         
         # Добавляем кнопки действий, если есть выбранные скриншоты
-        if selected_screenshots[user_key]:
+        if selected:
             keyboard.append([
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
-            logger.info(f"[UPDATE_MESSAGE] Added delete selected button for {len(selected_screenshots[user_key])} files")
+            logger.info(f"[UPDATE_MESSAGE] Added delete selected button for {len(selected)} files")
 
         # Добавляем кнопку для удаления всей категории
         if screenshots:
@@ -498,12 +536,15 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
                     callback_data=f"delete_category_{current_label}"
                 )
             ])
+            keyboard.append([
+                InlineKeyboardButton(text="📦 Скачать ZIP", callback_data=f"export_label_{current_label}")
+            ])
             logger.info(f"[UPDATE_MESSAGE] Added delete all button for {len(screenshots)} files")
 
         # Добавляем кнопки для каждого скриншота
         for screenshot in screenshots:
             filename = os.path.basename(screenshot['filepath'])
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([
                 InlineKeyboardButton(
                     text=f"{screenshot['timestamp']} {'✅' if is_selected else ''}",
@@ -596,9 +637,10 @@ async def handle_view_archive(callback: CallbackQuery):
             logger.error(f"Error sending error message: {e2}", exc_info=True)
 
 @router.callback_query(F.data.startswith("label_"))
-async def handle_label_screenshots(callback: CallbackQuery):
+async def handle_label_screenshots(callback: CallbackQuery, state: FSMContext):
     """Handle showing screenshots for selected label"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         label = callback.data.replace("label_", "")
@@ -621,13 +663,16 @@ async def handle_label_screenshots(callback: CallbackQuery):
                 callback_data=f"delete_category_{label}"
             )
         ])
+        keyboard.append([
+            InlineKeyboardButton(text="📦 Скачать ZIP", callback_data=f"export_label_{label}")
+        ])
 
         # Добавляем кнопки для каждого скриншота
         for screenshot in screenshots:
             timestamp = screenshot["timestamp"]
             filename = os.path.basename(screenshot['filepath'])
             user_key = f"user_{user_id}"
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([
                 InlineKeyboardButton(
                     text=f"{timestamp} {'✅' if is_selected else ''}",
@@ -656,17 +701,18 @@ async def handle_label_screenshots(callback: CallbackQuery):
         )
 
 @router.callback_query(F.data == "delete_selected")
-async def handle_delete_selected(callback: CallbackQuery):
+async def handle_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle deletion of selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
         logger.info(f"[DELETE_SELECTED] Starting deletion process for user {user_id}")
-        logger.info(f"[DELETE_SELECTED] Selected screenshots: {selected_screenshots.get(user_key, set())}")
+        logger.info(f"[DELETE_SELECTED] Selected screenshots: {selected}")
 
-        if not selected_screenshots.get(user_key):
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
@@ -681,10 +727,10 @@ async def handle_delete_selected(callback: CallbackQuery):
         screenshots = screenshot_storage.get_screenshots_by_label(current_label, user_id, chat_id) if current_label else []
         available_files = {os.path.basename(s["filepath"]) for s in screenshots}
         
-        logger.info(f"[DELETE_SELECTED] Selected files: {selected_screenshots[user_key]}")
+        logger.info(f"[DELETE_SELECTED] Selected files: {selected}")
         logger.info(f"[DELETE_SELECTED] Available files in category: {available_files}")
         
-        valid_selections = selected_screenshots[user_key].intersection(available_files)
+        valid_selections = selected.intersection(available_files)
         logger.info(f"[DELETE_SELECTED] Valid selections after intersection: {valid_selections}")
 
         if not valid_selections:
@@ -720,21 +766,22 @@ async def handle_delete_selected(callback: CallbackQuery):
             logger.error(f"[DELETE_SELECTED] Error returning to archive: {e2}", exc_info=True)
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of selected screenshots deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots.get(user_key):
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
         # Verify selected files exist before starting deletion
         screenshots = screenshot_storage.get_all_screenshots(user_id, chat_id)
         available_files = {os.path.basename(s["filepath"]) for s in screenshots}
-        valid_selections = selected_screenshots[user_key].intersection(available_files)
+        valid_selections = selected.intersection(available_files)
 
         if not valid_selections:
             await callback.answer("❌ Выбранные скриншоты не найдены")
@@ -757,7 +804,8 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
 
                 if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
                     deleted_count += 1
-                    selected_screenshots[user_key].remove(filename)
+                    selected.remove(filename)
+                    await save_selected(state, selected)
                     logger.info(f"[CONFIRM_DELETE_SELECTED] Successfully deleted: {filename}")
                 else:
                     failed_count += 1
@@ -812,16 +860,17 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
             logger.error(f"[CONFIRM_DELETE_SELECTED] Error returning to archive: {e2}", exc_info=True)
 
 @router.callback_query(F.data == "cancel_delete_selected")
-async def handle_cancel_delete_selected(callback: CallbackQuery):
+async def handle_cancel_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle cancellation of selected screenshots deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
         # Clear selection
-        if user_key in selected_screenshots:
-            selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         await callback.answer("✅ Удаление отменено")
         await handle_view_archive(callback)
@@ -927,10 +976,354 @@ async def handle_confirm_delete_category(callback: CallbackQuery):
         except Exception as e2:
             logger.error(f"[CONFIRM_DELETE] Error returning to archive: {e2}", exc_info=True)
 
+@router.callback_query(F.data.startswith("similar_"))
+async def handle_similar_screenshots(callback: CallbackQuery):
+    """Show archived screenshots that look most like the selected one"""
+    try:
+        user_id = callback.from_user.id
+        chat_id = callback.message.chat.id
+        filename = callback.data.replace("similar_", "")
+
+        screenshot_info = next(
+            (s for s in screenshot_storage.get_all_screenshots(user_id, chat_id)
+             if os.path.basename(s["filepath"]) == filename),
+            None
+        )
+        if not screenshot_info:
+            await callback.answer("Скриншот не найден")
+            return
+
+        if not screenshot_info.get("phash"):
+            # Хэш для старых записей считаем по требованию
+            data = await asyncio.to_thread(screenshot_storage.read_screenshot, screenshot_info)
+            from image_processor import ImageProcessor
+            phash = await asyncio.to_thread(ImageProcessor.perceptual_hash, data) if data else None
+            if phash:
+                screenshot_storage.set_phashes({screenshot_info["filepath"]: phash})
+
+        matches = screenshot_storage.find_similar(screenshot_info["filepath"], user_id, chat_id)
+        await callback.answer()
+        if not matches:
+            await callback.message.answer("Похожих скриншотов не найдено")
+            return
+
+        keyboard = []
+        for distance, info in matches:
+            similarity = 100 - distance * 100 // 64
+            keyboard.append([InlineKeyboardButton(
+                text=f"{similarity}% · {info['label']}",
+                callback_data=f"show_screenshot_{os.path.basename(info['filepath'])}"
+            )])
+        keyboard.append([InlineKeyboardButton(text="🔙 К списку", callback_data="view_archive")])
+
+        await callback.message.answer(
+            f"🔎 Похожие на «{screenshot_info['label']}»:",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+        )
+    except Exception as e:
+        logger.error(f"Error in similar screenshots handler: {e}")
+        await callback.answer("❌ Ошибка при поиске похожих скриншотов")
+
+
+# Дата (и время) в конце метки: 'Ежедневный отчет 2025-01-15', 'Сохранено вручную 2025-01-15 12:00:00'
+LABEL_DATE_SUFFIX = re.compile(r"\s+\d{4}-\d{2}-\d{2}(?:\s+\d{2}:\d{2}(?::\d{2})?)?$")
+
+
+def label_category(label: str) -> str:
+    """Label without its trailing date: the series a screenshot belongs to"""
+    return LABEL_DATE_SUFFIX.sub("", label or "")
+
+
+@router.callback_query(F.data.startswith("diff_"))
+async def handle_diff_screenshot(callback: CallbackQuery):
+    """Compare screenshot with the previous one and highlight changed regions"""
+    try:
+        user_id = callback.from_user.id
+        chat_id = callback.message.chat.id
+        filename = callback.data.replace("diff_", "")
+
+        # get_all_screenshots отсортирован от новых к старым
+        screenshots = screenshot_storage.get_all_screenshots(user_id, chat_id)
+        index = next(
+            (i for i, s in enumerate(screenshots) if os.path.basename(s["filepath"]) == filename),
+            None
+        )
+        if index is None:
+            await callback.answer("Скриншот не найден")
+            return
+        current = screenshots[index]
+        # Сравниваем только внутри одной серии: ежедневный отчёт с ежедневным, а не с другой таблицей
+        category = label_category(current["label"])
+        previous = next(
+            (s for s in screenshots[index + 1:]
+             if label_category(s["label"]) == category
+             and screenshot_storage.screenshot_exists(s) and not screenshot_storage.same_file(s, current)),
+            None
+        )
+        if previous is None:
+            await callback.answer(f"Нет более раннего скриншота «{category}» для сравнения")
+            return
+
+        await callback.answer("Сравниваю скриншоты...")
+        def compare():
+            # numpy и PIL загружаются при первом сравнении, а не при старте бота
+            from image_diff import diff_images
+            # Снимок может лежать в сегменте, поэтому передаём файловые объекты, а не пути
+            with screenshot_storage.open_screenshot(previous) as old, screenshot_storage.open_screenshot(current) as new:
+                return diff_images(old, new)
+
+        result = await asyncio.to_thread(compare)
+
+        if not result.boxes:
+            await callback.message.answer(
+                f"✅ Изменений нет\n{previous['label']} → {current['label']}"
+            )
+            return
+
+        caption = (
+            f"🆚 {previous['label']} → {current['label']}\n"
+            f"Изменённых областей: {len(result.boxes)} ({result.changed_ratio:.1%} площади)"
+        )
+        overlay = BufferedInputFile(result.overlay, filename=f"diff_{filename}")
+        try:
+            await callback.message.answer_photo(photo=overlay, caption=caption)
+        except Exception as e:
+            # Слишком длинные полностраничные снимки Telegram не принимает как фото
+            logger.warning(f"Diff overlay rejected as photo, sending as document: {e}")
+            await callback.message.answer_document(document=overlay, caption=caption)
+    except Exception as e:
+        logger.error(f"Error in diff screenshot handler: {e}")
+        await callback.message.answer("❌ Не удалось сравнить скриншоты")
+
+
+async def backfill_phashes() -> None:
+    """Compute perceptual hashes for records archived before they were stored"""
+    try:
+        # Первое обращение к архиву открывает его; делаем это в потоке, чтобы не блокировать опрос обновлений
+        missing = await asyncio.to_thread(screenshot_storage.missing_phashes)
+        if not missing:
+            return
+        logger.info(f"Computing perceptual hashes for {len(missing)} archived screenshots")
+
+        def compute():
+            from image_processor import ImageProcessor
+            hashes = {}
+            for info in missing:
+                data = screenshot_storage.read_screenshot(info)
+                hashes[info["filepath"]] = ImageProcessor.perceptual_hash(data) if data else None
+            return hashes
+
+        phashes = {path: phash for path, phash in (await asyncio.to_thread(compute)).items() if phash}
+        screenshot_storage.set_phashes(phashes)
+        logger.info(f"Stored {len(phashes)} perceptual hashes")
+    except Exception as e:
+        logger.error(f"Error backfilling perceptual hashes: {e}")
+
+
+SCHEDULE_USAGE = (
+    "Использование: /schedule <cron> [ссылка на таблицу] [engine=движок] [метка]\n\n"
+    "cron - 5 полей: минута час день месяц день_недели\n"
+    f"запуски - не чаще раза в {chat_schedule_store.min_interval} мин\n"
+    f"движок - {', '.join(CAPTURE_ENGINES)}\n"
+    "Примеры:\n"
+    "/schedule 0 9 * * 1-5 - по будням в 9:00\n"
+    "/schedule 30 18 * * * https://docs.google.com/spreadsheets/d/... Вечер\n"
+    "/schedule 0 8 * * * engine=local Утро\n"
+    "/schedule @daily"
+)
+
+
+def is_sheet_url(url: str) -> bool:
+    """Only https links to Google Sheets are captured"""
+    parsed = urlparse(url)
+    return (parsed.scheme == "https" and parsed.netloc == "docs.google.com"
+            and parsed.path.startswith("/spreadsheets/d/"))
+
+
+def parse_schedule_args(text: str):
+    """'/schedule 0 9 * * 1-5 [url] [engine=name] [label]' -> (cron, url, engine, label)"""
+    parts = text.split()[1:]
+    if not parts:
+        raise CronError("empty schedule")
+    field_count = 1 if parts[0].startswith("@") else 5
+    if len(parts) < field_count:
+        raise CronError("Cron expression needs 5 fields: minute hour day month weekday")
+    cron = " ".join(parts[:field_count])
+    rest = parts[field_count:]
+    sheet_url = SHEET_URL
+    if rest and rest[0].startswith("http"):
+        sheet_url = rest.pop(0)
+    engine = None
+    if rest and rest[0].startswith("engine="):
+        engine = rest.pop(0)[len("engine="):]
+    label = " ".join(rest) or None
+    return cron, sheet_url, engine, label
+
+
+@router.message(Command("schedule"))
+async def handle_add_schedule(message: Message):
+    """Register a cron schedule for this chat"""
+    try:
+        try:
+            cron, sheet_url, engine, label = parse_schedule_args(message.text or "")
+        except CronError:
+            await message.answer(SCHEDULE_USAGE)
+            return
+        if not is_sheet_url(sheet_url):
+            await message.answer("❌ Ссылка должна вести на Google таблицу (https://docs.google.com/spreadsheets/d/...)")
+            return
+        if engine is not None and engine not in CAPTURE_ENGINES:
+            await message.answer(f"❌ Неизвестный движок: {engine}\n\n{SCHEDULE_USAGE}")
+            return
+
+        try:
+            schedule = chat_schedule_store.add(message.chat.id, message.from_user.id, cron, sheet_url, label, engine)
+        except CronError as e:
+            await message.answer(f"❌ Неверное расписание: {e}\n\n{SCHEDULE_USAGE}")
+            return
+        except ScheduleLimitError:
+            await message.answer(
+                f"❌ В чате уже {chat_schedule_store.max_per_chat} расписаний. "
+                "Удалите лишние через /schedules"
+            )
+            return
+
+        schedule_chat_job(schedule)
+        log_action("schedule_added", f"chat={message.chat.id}, cron={schedule.cron}, engine={schedule.engine}")
+        await message.answer(
+            f"✅ Расписание {schedule.id} добавлено: {schedule.cron}\n"
+            f"Метка: {schedule.label or 'По расписанию <дата>'}"
+            + (f"\nДвижок: {schedule.engine}" if schedule.engine else "")
+        )
+    except Exception as e:
+        logger.error(f"Error adding schedule: {e}", exc_info=True)
+        await message.answer("❌ Не удалось добавить расписание")
+
+
+def schedules_keyboard(chat_id: int) -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text=f"❌ {schedule.id}: {schedule.cron}", callback_data=f"unschedule_{schedule.id}")]
+        for schedule in chat_schedule_store.for_chat(chat_id)
+    ]
+    keyboard.append([InlineKeyboardButton(text="◀️ Вернуться в меню", callback_data='back_to_main')])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def schedules_text(chat_id: int) -> str:
+    schedules = chat_schedule_store.for_chat(chat_id)
+    if not schedules:
+        return "🕒 В этом чате нет расписаний.\n\n" + SCHEDULE_USAGE
+    lines = ["🕒 Расписания чата (нажмите, чтобы удалить):\n"]
+    for schedule in schedules:
+        sheet = "основная таблица" if schedule.sheet_url == SHEET_URL else schedule.sheet_url
+        engine = f", {schedule.engine}" if schedule.engine else ""
+        lines.append(f"{schedule.id}: {schedule.cron} - {schedule.label or 'По расписанию'} ({sheet}{engine})")
+    return "\n".join(lines)
+
+
+@router.message(Command("schedules"))
+async def handle_list_schedules(message: Message):
+    """Show schedules of this chat with delete buttons"""
+    try:
+        await message.answer(schedules_text(message.chat.id), reply_markup=schedules_keyboard(message.chat.id),
+                             disable_web_page_preview=True)
+    except Exception as e:
+        logger.error(f"Error listing schedules: {e}", exc_info=True)
+        await message.answer("❌ Не удалось получить расписания")
+
+
+@router.callback_query(F.data.startswith("unschedule_"))
+async def handle_remove_schedule(callback: CallbackQuery):
+    """Delete a schedule of the chat the button belongs to"""
+    try:
+        chat_id = callback.message.chat.id
+        schedule = chat_schedule_store.remove(chat_id, callback.data.replace("unschedule_", ""))
+        if schedule is None:
+            await callback.answer("Расписание уже удалено")
+            return
+        unschedule_chat_job(schedule)
+        log_action("schedule_removed", f"chat={chat_id}, id={schedule.id}")
+        await callback.message.edit_text(schedules_text(chat_id), reply_markup=schedules_keyboard(chat_id),
+                                         disable_web_page_preview=True)
+        await callback.answer("🗑 Расписание удалено")
+    except Exception as e:
+        logger.error(f"Error removing schedule: {e}", exc_info=True)
+        await callback.answer("❌ Произошла ошибка")
+
+
+EXPORT_USAGE = (
+    "Использование: /export <метка | дата | месяц | период>\n\n"
+    "Примеры:\n"
+    "/export Начало месяца\n"
+    "/export 2025-01-15\n"
+    "/export 2025-01\n"
+    "/export 2025-01-01..2025-03-31"
+)
+
+
+async def send_export(message: Message, name: str, records: List[Dict]):
+    """Send records as ZIP documents, one part at a time"""
+    if not records:
+        await message.answer("❌ Нет скриншотов для выгрузки")
+        return
+    parts, skipped = await asyncio.to_thread(plan_parts, screenshot_storage, records, name)
+    if not parts:
+        await message.answer("❌ Файлы скриншотов не найдены")
+        return
+    await message.answer(f"📦 Собираю архив: {len(records) - len(skipped)} скриншотов, частей: {len(parts)}")
+    async for part, document in part_documents(screenshot_storage, parts):
+        await message.answer_document(document=document, caption=f"📦 {part.filename}: {len(part.members)} скриншотов")
+    if skipped:
+        await message.answer(f"⚠️ Пропущено скриншотов: {len(skipped)} (файл не найден или слишком большой)")
+    log_action("export", f"chat={message.chat.id}, name={name}, parts={len(parts)}, skipped={len(skipped)}")
+
+
+@router.message(Command("export"))
+async def handle_export_command(message: Message):
+    """Export a category, date or period as ZIP"""
+    try:
+        query = (message.text or "").partition(" ")[2].strip()
+        if not query:
+            await message.answer(EXPORT_USAGE)
+            return
+        name, records = select_export(screenshot_storage, query, message.from_user.id, message.chat.id)
+        await send_export(message, name, records)
+    except Exception as e:
+        logger.error(f"Error exporting archive: {e}", exc_info=True)
+        await message.answer("❌ Не удалось выгрузить архив")
+
+
+@router.callback_query(F.data.startswith("export_label_"))
+async def handle_export_label(callback: CallbackQuery):
+    """Export the category shown in the message as ZIP"""
+    try:
+        await callback.answer("📦 Готовлю архив...")
+        label = callback.data.replace("export_label_", "", 1)
+        name, records = select_export(screenshot_storage, label, callback.from_user.id, callback.message.chat.id)
+        await send_export(callback.message, name, records)
+    except Exception as e:
+        logger.error(f"Error exporting category: {e}", exc_info=True)
+        await callback.message.answer("❌ Не удалось выгрузить архив")
+
+
+@router.callback_query(F.data.startswith("export_date_"))
+async def handle_export_date(callback: CallbackQuery):
+    """Export screenshots of the date shown in the message as ZIP"""
+    try:
+        await callback.answer("📦 Готовлю архив...")
+        date = callback.data.replace("export_date_", "", 1)
+        records = screenshot_storage.get_screenshots_by_date(date, callback.from_user.id, callback.message.chat.id)
+        await send_export(callback.message, date, sorted(records, key=lambda info: info["timestamp"]))
+    except Exception as e:
+        logger.error(f"Error exporting date: {e}", exc_info=True)
+        await callback.message.answer("❌ Не удалось выгрузить архив")
+
+
 @router.callback_query(F.data.startswith("show_screenshot_"))
-async def handle_show_screenshot(callback: CallbackQuery):
+async def handle_show_screenshot(callback: CallbackQuery, state: FSMContext):
     """Handle showing specific screenshot"""
     try:
+        selected = await get_selected(state)
         logger.info(f"Showing screenshot: {callback.data}")
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
@@ -945,12 +1338,12 @@ async def handle_show_screenshot(callback: CallbackQuery):
                 screenshot_info = screenshot
                 break
 
-        if screenshot_info and os.path.exists(screenshot_info["filepath"]):
-            photo = FSInputFile(screenshot_info["filepath"])
+        if screenshot_info and screenshot_storage.screenshot_exists(screenshot_info):
+            photo = screenshot_input_file(screenshot_info)
 
             # Добавляем кнопку выбора и навигации
             date = screenshot_info["timestamp"].split()[0]
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
 
             keyboard = [
                 [
@@ -963,6 +1356,16 @@ async def handle_show_screenshot(callback: CallbackQuery):
                         callback_data=f"delete_{filename}"
                     )
                 ],
+                [
+                    InlineKeyboardButton(
+                        text="🔎 Похожие",
+                        callback_data=f"similar_{filename}"
+                    ),
+                    InlineKeyboardButton(
+                        text="🆚 Что изменилось",
+                        callback_data=f"diff_{filename}"
+                    )
+                ],
                 [
                     InlineKeyboardButton(
                         text="🔙 К списку",
@@ -972,10 +1375,10 @@ async def handle_show_screenshot(callback: CallbackQuery):
             ]
 
             # Добавляем кнопку удаления выбранных, если есть выбранные скриншоты
-            if len(selected_screenshots[user_key]) > 0:
+            if len(selected) > 0:
                 keyboard.insert(0, [
                     InlineKeyboardButton(
-                        text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                        text=f"🗑 Удалить выбранные ({len(selected)})",
                         callback_data="delete_selected"
                     )
                 ])
@@ -1195,14 +1598,15 @@ async def handle_confirm_delete_category(callback: CallbackQuery):
             logger.error(f"[CONFIRM_DELETE] Error returning to archive: {e2}", exc_info=True)
 
 @router.callback_query(F.data == "delete_selected")
-async def handle_delete_selected(callback: CallbackQuery):
+async def handle_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle deletion of selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
@@ -1221,7 +1625,7 @@ async def handle_delete_selected(callback: CallbackQuery):
         ]
 
         await callback.message.edit_text(
-            f"⚠️ Вы уверены, что хотите удалить {len(selected_screenshots[user_key])} выбранных скриншотов?\n"
+            f"⚠️ Вы уверены, что хотите удалить {len(selected)} выбранных скриншотов?\n"
             "Это действие нельзя отменить.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
         )
@@ -1231,19 +1635,20 @@ async def handle_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка")
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of selected screenshots deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        logger.info(f"[CONFIRM_DELETE_SELECTED] Starting deletion of {len(selected_screenshots[user_key])} screenshots")
+        logger.info(f"[CONFIRM_DELETE_SELECTED] Starting deletion of {len(selected)} screenshots")
 
         # Показываем статус удаления
         status_message = await callback.message.edit_text(
             "🗑 Удаление выбранных скриншотов...\n"
-            f"Всего файлов: {len(selected_screenshots[user_key])}\n"
+            f"Всего файлов: {len(selected)}\n"
             "⏳ Пожалуйста, подождите..."
         )
 
@@ -1251,13 +1656,14 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         failed_count = 0
         failed_files = []
 
-        for filename in list(selected_screenshots[user_key]):  # Создаем копию списка
+        for filename in list(selected):  # Создаем копию списка
             try:
                 logger.info(f"[CONFIRM_DELETE_SELECTED] Processing file: {filename}")
 
                 if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
                     deleted_count += 1
-                    selected_screenshots[user_key].remove(filename)  # Удаляем из выбранных
+                    selected.remove(filename)  # Удаляем из выбранных
+                    await save_selected(state, selected)
                     logger.info(f"[CONFIRM_DELETE_SELECTED] Successfully deleted: {filename}")
                 else:
                     failed_count += 1
@@ -1268,7 +1674,7 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
                 if (deleted_count + failed_count) % 5 == 0:
                     await status_message.edit_text(
                         "🗑 Удаление выбранных скриншотов...\n"
-                        f"Обработано: {deleted_count + failed_count} из {len(selected_screenshots[user_key])}\n"
+                        f"Обработано: {deleted_count + failed_count} из {len(selected)}\n"
                         f"✅ Успешно: {deleted_count}\n"
                         f"❌ Ошибок: {failed_count}"
                     )
@@ -1407,21 +1813,22 @@ async def handle_confirm_delete_category(callback: CallbackQuery):
             logger.error(f"[CONFIRM_DELETE] Error returning to archive: {e2}", exc_info=True)
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of selected screenshots deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
         # Показываем статус удаления
         status_message = await callback.message.edit_text(
             "🗑 Удаление выбранных скриншотов...\n"
-            f"Всего файлов: {len(selected_screenshots[user_key])}\n"
+            f"Всего файлов: {len(selected)}\n"
             "⏳ Пожалуйста, подождите..."
         )
 
@@ -1429,12 +1836,13 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         failed_count = 0
         failed_files = []
 
-        for filename in list(selected_screenshots[user_key]):  # Создаем копию списка
+        for filename in list(selected):  # Создаем копию списка
             try:
                 logger.info(f"Attempting to delete selected screenshot: {filename}")
                 if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
                     deleted_count += 1
-                    selected_screenshots[user_key].remove(filename)  # Удаляем из выбранных
+                    selected.remove(filename)  # Удаляем из выбранных
+                    await save_selected(state, selected)
                     logger.info(f"Successfully deleted selected screenshot: {filename}")
                 else:
                     failed_count += 1
@@ -1445,7 +1853,7 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
                 if (deleted_count + failed_count) % 5 == 0:
                     await status_message.edit_text(
                         "🗑 Удаление выбранных скриншотов...\n"
-                        f"Обработано: {deleted_count + failed_count} из {len(selected_screenshots[user_key])}\n"
+                        f"Обработано: {deleted_count + failed_count} из {len(selected)}\n"
                         f"✅ Успешно: {deleted_count}\n"
                         f"❌ Ошибок: {failed_count}"
                     )
@@ -1487,9 +1895,10 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
             logger.error(f"Error returning to archive: {e2}", exc_info=True)
 
 # Update screenshot message function
-async def update_screenshot_message(message: Message, user_id: int, chat_id: int):
+async def update_screenshot_message(message: Message, user_id: int, chat_id: int, state: FSMContext):
     """Update message with selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_key = f"user_{user_id}"
         # Текущая метка из сообщения
         if not message.text:
@@ -1507,10 +1916,10 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         keyboard = []
         
         # Добавляем кнопки действий, если есть выбранные скриншоты
-        if selected_screenshots[user_key]:
+        if selected:
             keyboard.append([
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
@@ -1526,7 +1935,7 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         # Добавляем кнопки для каждого скриншота
         for screenshot in screenshots:
             filename = os.path.basename(screenshot['filepath'])
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([
                 InlineKeyboardButton(
                     text=f"{screenshot['timestamp']} {'✅' if is_selected else ''}",
@@ -1547,7 +1956,7 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
     except Exception as e:
         logger.error(f"Error updating screenshot message: {e}", exc_info=True)
 @router.callback_query(F.data == "search_labels")
-async def handle_search_request(callback: CallbackQuery):
+async def handle_search_request(callback: CallbackQuery, state: FSMContext):
     """Handle label search request"""
     await callback.message.edit_text(
         "🔍 Отправьте текст для поиска по меткам:",
@@ -1556,13 +1965,13 @@ async def handle_search_request(callback: CallbackQuery):
         ])
     )
     # Store state for next message
-    temp_files[f"search_{callback.from_user.id}"] = True
+    await state.set_state(ArchiveStates.waiting_search_query)
 
-@router.message(lambda msg: f"search_{msg.from_user.id}" in temp_files)
-async def handle_search_query(message: Message):
+@router.message(ArchiveStates.waiting_search_query)
+async def handle_search_query(message: Message, state: FSMContext):
     """Handle search query"""
     try:
-        del temp_files[f"search_{message.from_user.id}"]
+        await state.set_state(None)
         screenshots = screenshot_storage.search_by_label(message.text)
 
         if not screenshots:
@@ -1582,8 +1991,8 @@ async def handle_search_query(message: Message):
         )
 
         for screenshot in screenshots:
-            if os.path.exists(screenshot["filepath"]):
-                photo = FSInputFile(screenshot["filepath"])
+            if screenshot_storage.screenshot_exists(screenshot):
+                photo = screenshot_input_file(screenshot)
                 keyboard = [[InlineKeyboardButton(
                     text="🗑 Удалить",
                     callback_data=f"delete_{os.path.basename(screenshot['filepath'])}"
@@ -1625,16 +2034,16 @@ async def handle_about_callback(callback: CallbackQuery):
         await callback.message.edit_text("Произошла ошибка")
 
 @router.callback_query(F.data.startswith("archive_"))
-async def handle_archive_screenshot(callback: CallbackQuery):
+async def handle_archive_screenshot(callback: CallbackQuery, state: FSMContext):
     """Handle archiving a screenshot sent by bot"""
     try:
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         file_id = callback.data.replace("archive_", "")
-        filepath = temp_files.get(file_id)
+        filepath = temp_artifacts.get(file_id)
 
         if not filepath:
-            logger.error(f"File not found in temp_files for ID: {file_id}")
+            logger.error(f"File not found in temp files for ID: {file_id}")
             await callback.answer("❌ Файл не найден")
             return
 
@@ -1661,27 +2070,30 @@ async def handle_archive_screenshot(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("autosave_"))
-async def handle_autosave(callback: CallbackQuery):
+async def handle_autosave(callback: CallbackQuery, state: FSMContext):
     """Handle automatic saving with timestamp"""
     try:
         file_id= callback.data.replace("autosave_", "")
-        filepath = temp_files.get(file_id)
+        filepath = temp_artifacts.get(file_id)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
 
+        if not filepath:
+            await callback.answer("❌ Файл не найден")
+            return
+
         timestamp = datetime.now(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S")
         label = f"Сохранено вручную {timestamp}"
 
-        with open(filepath, 'rb') as f:
-            screenshot_data = f.read()
-
-        saved_path = screenshot_storage.save_screenshot(
-            screenshot_data, label, user_id, chat_id
+        from image_processor import ImageProcessor
+        phash = await asyncio.to_thread(ImageProcessor.perceptual_hash_file, filepath)
+        saved_path = screenshot_storage.save_screenshot_file(
+            filepath, label, user_id, chat_id, phash=phash, sheet_url=SHEET_URL
         )
 
         if saved_path:
             await callback.answer("✅ Скриншот сохранен в архив")
-            await cleanup_temp_file(filepath, file_id)
+            temp_artifacts.discard(file_id)
         else:
             await callback.answer("❌ Ошибка при сохранении")
 
@@ -1690,12 +2102,13 @@ async def handle_autosave(callback: CallbackQuery):
         await callback.answer("❌ Ошибка при сохранении")
 
 @router.callback_query(F.data.startswith("customlabel_"))
-async def handle_custom_label_request(callback: CallbackQuery):
+async def handle_custom_label_request(callback: CallbackQuery, state: FSMContext):
     """Handle request for custom label"""
     try:
         file_id = callback.data.replace("customlabel_", "")
-        # Сохраняем ID файла во временном хранилище
-        temp_files[f"labeling_{callback.from_user.id}"] = file_id
+        # Сохраняем ID файла и ждём метку следующим сообщением
+        await state.set_state(ArchiveStates.waiting_custom_label)
+        await state.update_data(labeling_file_id=file_id)
 
         await callback.message.reply(
             "📝 Введите метку для сохранения скриншота:"
@@ -1704,12 +2117,14 @@ async def handle_custom_label_request(callback: CallbackQuery):
         logger.error(f"Error in custom label handler: {e}")
         await callback.answer("❌ Ошибка при обработке запроса")
 
-@router.message(lambda msg: f"labeling_{msg.from_user.id}" in temp_files)
-async def handle_custom_label(message: Message):
+@router.message(ArchiveStates.waiting_custom_label)
+async def handle_custom_label(message: Message, state: FSMContext):
     """Handle custom label input"""
     try:
-        file_id = temp_files.pop(f"labeling_{message.from_user.id}")
-        filepath = temp_files.get(file_id)
+        data = await state.get_data()
+        file_id = data.get("labeling_file_id")
+        await state.set_state(None)
+        filepath = temp_artifacts.get(file_id) if file_id else None
         user_id = message.from_user.id
         chat_id = message.chat.id
 
@@ -1717,16 +2132,15 @@ async def handle_custom_label(message: Message):
             await message.reply("❌ Скриншот не найден")
             return
 
-        with open(filepath, 'rb') as f:
-            screenshot_data = f.read()
-
-        saved_path = screenshot_storage.save_screenshot(
-            screenshot_data, message.text, user_id, chat_id
+        from image_processor import ImageProcessor
+        phash = await asyncio.to_thread(ImageProcessor.perceptual_hash_file, filepath)
+        saved_path = screenshot_storage.save_screenshot_file(
+            filepath, message.text, user_id, chat_id, phash=phash, sheet_url=SHEET_URL
         )
 
         if saved_path:
             await message.reply("✅ Скриншот сохранен с указанной меткой")
-            await cleanup_temp_file(filepath, file_id)
+            temp_artifacts.discard(file_id)
         else:
             await message.reply("❌ Ошибка при сохранении")
 
@@ -1734,15 +2148,6 @@ async def handle_custom_label(message: Message):
         logger.error(f"Error saving with custom label: {e}")
         await message.reply("❌ Произошла ошибка")
 
-async def cleanup_temp_file(filepath: str, file_id: str):
-    """Clean up temporary file and its reference"""
-    try:
-        os.remove(filepath)
-        del temp_files[file_id]
-        logger.info(f"Temporary file removed: {filepath}")
-    except Exception as e:
-        logger.error(f"Error removing temporary file: {e}")
-
 @router.callback_query(F.data == "cancel_archive")
 async def handle_cancel_archive(callback: CallbackQuery):
     """Handle archive cancellation"""
@@ -1750,9 +2155,10 @@ async def handle_cancel_archive(callback: CallbackQuery):
     await callback.message.delete()
 
 @router.callback_query(F.data.startswith("date_"))
-async def handle_date_screenshots(callback: CallbackQuery):
+async def handle_date_screenshots(callback: CallbackQuery, state: FSMContext):
     """Handle showing screenshots for selected date"""
     try:
+        selected = await get_selected(state)
         logger.info(f"Processing date screenshots request: {callback.data}")
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
@@ -1784,12 +2190,13 @@ async def handle_date_screenshots(callback: CallbackQuery):
 
             filename = os.path.basename(screenshot['filepath'])
             user_key = f"user_{user_id}"
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([InlineKeyboardButton(
                 text=f"{screenshot['label']} ({time_part}) {'✅' if is_selected else ''}",
                 callback_data=f"show_screenshot_{filename}"
             )])
 
+        keyboard.append([InlineKeyboardButton(text="📦 Скачать ZIP", callback_data=f"export_date_{date}")])
         keyboard.append([InlineKeyboardButton(text="🔙 К архиву", callback_data="view_archive")])
 
         await callback.message.edit_text(
@@ -1831,7 +2238,7 @@ async def handle_delete_screenshot(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка при удалении")
 
 @router.callback_query(F.data == "search_labels")
-async def handle_search_request(callback: CallbackQuery):
+async def handle_search_request(callback: CallbackQuery, state: FSMContext):
     """Handle label search request"""
     await callback.message.edit_text(
         "🔍 Отправьте текст для поиска по меткам:",
@@ -1840,13 +2247,13 @@ async def handle_search_request(callback: CallbackQuery):
         ])
     )
     # Store state for next message
-    temp_files[f"search_{callback.from_user.id}"] = True
+    await state.set_state(ArchiveStates.waiting_search_query)
 
-@router.message(lambda msg: f"search_{msg.from_user.id}" in temp_files)
-async def handle_search_query(message: Message):
+@router.message(ArchiveStates.waiting_search_query)
+async def handle_search_query(message: Message, state: FSMContext):
     """Handle search query"""
     try:
-        del temp_files[f"search_{message.from_user.id}"]
+        await state.set_state(None)
         screenshots = screenshot_storage.search_by_label(message.text)
 
         if not screenshots:
@@ -1866,8 +2273,8 @@ async def handle_search_query(message: Message):
         )
 
         for screenshot in screenshots:
-            if os.path.exists(screenshot["filepath"]):
-                photo = FSInputFile(screenshot["filepath"])
+            if screenshot_storage.screenshot_exists(screenshot):
+                photo = screenshot_input_file(screenshot)
                 keyboard = [[InlineKeyboardButton(
                     text="🗑 Удалить",
                     callback_data=f"delete_{os.path.basename(screenshot['filepath'])}"
@@ -1909,16 +2316,16 @@ async def handle_about_callback(callback: CallbackQuery):
         await callback.message.edit_text("Произошла ошибка")
 
 @router.callback_query(F.data.startswith("archive_"))
-async def handle_archive_screenshot(callback: CallbackQuery):
+async def handle_archive_screenshot(callback: CallbackQuery, state: FSMContext):
     """Handle archiving a screenshot sent by bot"""
     try:
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         file_id = callback.data.replace("archive_", "")
-        filepath = temp_files.get(file_id)
+        filepath = temp_artifacts.get(file_id)
 
         if not filepath:
-            logger.error(f"File not found in temp_files for ID: {file_id}")
+            logger.error(f"File not found in temp files for ID: {file_id}")
             await callback.answer("❌ Файл не найден")
             return
 
@@ -1945,27 +2352,30 @@ async def handle_archive_screenshot(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("autosave_"))
-async def handle_autosave(callback: CallbackQuery):
+async def handle_autosave(callback: CallbackQuery, state: FSMContext):
     """Handle automatic saving with timestamp"""
     try:
         file_id= callback.data.replace("autosave_", "")
-        filepath = temp_files.get(file_id)
+        filepath = temp_artifacts.get(file_id)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
 
+        if not filepath:
+            await callback.answer("❌ Файл не найден")
+            return
+
         timestamp = datetime.now(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S")
         label = f"Сохранено вручную {timestamp}"
 
-        with open(filepath, 'rb') as f:
-            screenshot_data = f.read()
-
-        saved_path = screenshot_storage.save_screenshot(
-            screenshot_data, label, user_id, chat_id
+        from image_processor import ImageProcessor
+        phash = await asyncio.to_thread(ImageProcessor.perceptual_hash_file, filepath)
+        saved_path = screenshot_storage.save_screenshot_file(
+            filepath, label, user_id, chat_id, phash=phash, sheet_url=SHEET_URL
         )
 
         if saved_path:
             await callback.answer("✅ Скриншот сохранен в архив")
-            await cleanup_temp_file(filepath, file_id)
+            temp_artifacts.discard(file_id)
         else:
             await callback.answer("❌ Ошибка при сохранении")
 
@@ -1974,12 +2384,13 @@ async def handle_autosave(callback: CallbackQuery):
         await callback.answer("❌ Ошибка при сохранении")
 
 @router.callback_query(F.data.startswith("customlabel_"))
-async def handle_custom_label_request(callback: CallbackQuery):
+async def handle_custom_label_request(callback: CallbackQuery, state: FSMContext):
     """Handle request for custom label"""
     try:
         file_id = callback.data.replace("customlabel_", "")
-        # Сохраняем ID файла во временном хранилище
-        temp_files[f"labeling_{callback.from_user.id}"] = file_id
+        # Сохраняем ID файла и ждём метку следующим сообщением
+        await state.set_state(ArchiveStates.waiting_custom_label)
+        await state.update_data(labeling_file_id=file_id)
 
         await callback.message.reply(
             "📝 Введите метку для сохранения скриншота:"
@@ -1988,12 +2399,14 @@ async def handle_custom_label_request(callback: CallbackQuery):
         logger.error(f"Error in custom label handler: {e}")
         await callback.answer("❌ Ошибка при обработке запроса")
 
-@router.message(lambda msg: f"labeling_{msg.from_user.id}" in temp_files)
-async def handle_custom_label(message: Message):
+@router.message(ArchiveStates.waiting_custom_label)
+async def handle_custom_label(message: Message, state: FSMContext):
     """Handle custom label input"""
     try:
-        file_id = temp_files.pop(f"labeling_{message.from_user.id}")
-        filepath = temp_files.get(file_id)
+        data = await state.get_data()
+        file_id = data.get("labeling_file_id")
+        await state.set_state(None)
+        filepath = temp_artifacts.get(file_id) if file_id else None
         user_id = message.from_user.id
         chat_id = message.chat.id
 
@@ -2001,16 +2414,15 @@ async def handle_custom_label(message: Message):
             await message.reply("❌ Скриншот не найден")
             return
 
-        with open(filepath, 'rb') as f:
-            screenshot_data = f.read()
-
-        saved_path = screenshot_storage.save_screenshot(
-            screenshot_data, message.text, user_id, chat_id
+        from image_processor import ImageProcessor
+        phash = await asyncio.to_thread(ImageProcessor.perceptual_hash_file, filepath)
+        saved_path = screenshot_storage.save_screenshot_file(
+            filepath, message.text, user_id, chat_id, phash=phash, sheet_url=SHEET_URL
         )
 
         if saved_path:
             await message.reply("✅ Скриншот сохранен с указанной меткой")
-            await cleanup_temp_file(filepath, file_id)
+            temp_artifacts.discard(file_id)
         else:
             await message.reply("❌ Ошибка при сохранении")
 
@@ -2193,32 +2605,36 @@ async def handle_view_by_date(callback: CallbackQuery):
         )
 
 @router.callback_query(F.data.startswith("select_"))
-async def handle_screenshot_selection(callback: CallbackQuery):
+async def handle_screenshot_selection(callback: CallbackQuery, state: FSMContext):
     """Handle screenshot selection for multiple deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         filename = callback.data.replace("select_", "")
         user_key = f"user_{user_id}"
 
-        if filename in selected_screenshots[user_key]:
-            selected_screenshots[user_key].remove(filename)
+        if filename in selected:
+            selected.remove(filename)
+            await save_selected(state, selected)
             await callback.answer("❌ Скриншот убран из выбранных")
         else:
-            selected_screenshots[user_key].add(filename)
+            selected.add(filename)
+            await save_selected(state, selected)
             await callback.answer("✅ Скриншот выбран")
 
         # Обновляем сообщение с обновленным статусом выбора
-        await update_screenshot_message(callback.message, filename, user_id)
+        await update_screenshot_message(callback.message, filename, user_id, state)
 
     except Exception as e:
         logger.error(f"Error in screenshot selection: {e}", exc_info=True)
         await callback.answer("❌ Ошибка при выборе скриншота")
 
-async def update_screenshot_message(message: Message, filename: str, user_id: int):
+async def update_screenshot_message(message: Message, filename: str, user_id: int, state: FSMContext):
     """Update message with selection status"""
     try:
+        selected = await get_selected(state)
         user_key = f"user_{user_id}"
-        is_selected = filename in selected_screenshots[user_key]
+        is_selected = filename in selected
 
         keyboard = [
             [
@@ -2234,10 +2650,10 @@ async def update_screenshot_message(message: Message, filename: str, user_id: in
             [InlineKeyboardButton(text="🔙 Назад", callback_data="view_archive")]
         ]
 
-        if len(selected_screenshots[user_key]) > 0:
+        if len(selected) > 0:
             keyboard.insert(0, [
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
@@ -2249,14 +2665,15 @@ async def update_screenshot_message(message: Message, filename: str, user_id: in
         logger.error(f"Error updating screenshot message: {e}", exc_info=True)
 
 @router.callback_query(F.data == "delete_selected")
-async def handle_delete_selected(callback: CallbackQuery):
+async def handle_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle deletion of multiple selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
@@ -2275,7 +2692,7 @@ async def handle_delete_selected(callback: CallbackQuery):
         ]
 
         await callback.message.edit_text(
-            f"🗑 Удалить выбранные скриншоты ({len(selected_screenshots[user_key])})?\n"
+            f"🗑 Удалить выбранные скриншоты ({len(selected)})?\n"
             "Это действие нельзя отменить.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
         )
@@ -2285,28 +2702,30 @@ async def handle_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка")
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of multiple screenshot deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
         deleted_count = 0
         failed_count = 0
 
-        for filename in selected_screenshots[user_key]:
+        for filename in selected:
             if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
                 deleted_count += 1
             else:
                 failed_count += 1
 
         # Очищаем выбранные скриншоты
-        selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         # Показываем результат
         result_text = (
@@ -2328,14 +2747,16 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка при удалении")
 
 @router.callback_query(F.data == "cancel_delete_selected")
-async def handle_cancel_delete_selected(callback: CallbackQuery):
+async def handle_cancel_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle cancellation of multiple screenshot deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         user_key = f"user_{user_id}"
 
         # Очищаем выбранные скриншоты
-        selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         await callback.answer("✅ Удаление отменено")
         # Возвращаемся в архив
@@ -2497,7 +2918,7 @@ async def handle_view_stats(callback: CallbackQuery):
             "📊 Статистика скриншотов\n\n"
             f"📈 Всего скриншотов: {len(all_screenshots)}\n"
             f"🗓 В этом месяце: {monthly_stats['total_this_month']}\n"
-            f"💫 Доступно: {monthly_stats['remaining_limit']} из 100\n"
+            f"💫 Доступно: {monthly_stats['remaining_limit']} из {monthly_stats['monthly_limit']}\n"
             f"📊 Использовано: {monthly_stats['usage_percent']:.1f}%\n\n"
             "📁 По категориям:\n"
         )
@@ -2630,32 +3051,36 @@ async def handle_period_selection(callback: CallbackQuery):
 
 # Добавляем новые обработчики
 @router.callback_query(F.data.startswith("select_"))
-async def handle_screenshot_selection(callback: CallbackQuery):
+async def handle_screenshot_selection(callback: CallbackQuery, state: FSMContext):
     """Handle screenshot selection for multiple deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         filename = callback.data.replace("select_", "")
         user_key = f"user_{user_id}"
 
-        if filename in selected_screenshots[user_key]:
-            selected_screenshots[user_key].remove(filename)
+        if filename in selected:
+            selected.remove(filename)
+            await save_selected(state, selected)
             await callback.answer("❌ Скриншот убран из выбранных")
         else:
-            selected_screenshots[user_key].add(filename)
+            selected.add(filename)
+            await save_selected(state, selected)
             await callback.answer("✅ Скриншот выбран")
 
         # Обновляем сообщение с обновленным статусом выбора
-        await update_screenshot_message(callback.message, filename, user_id)
+        await update_screenshot_message(callback.message, filename, user_id, state)
 
     except Exception as e:
         logger.error(f"Error in screenshot selection: {e}", exc_info=True)
         await callback.answer("❌ Ошибка при выборе скриншота")
 
-async def update_screenshot_message(message: Message, filename: str, user_id: int):
+async def update_screenshot_message(message: Message, filename: str, user_id: int, state: FSMContext):
     """Update message with selection status"""
     try:
+        selected = await get_selected(state)
         user_key = f"user_{user_id}"
-        is_selected = filename in selected_screenshots[user_key]
+        is_selected = filename in selected
 
         keyboard = [
             [
@@ -2671,10 +3096,10 @@ async def update_screenshot_message(message: Message, filename: str, user_id: in
             [InlineKeyboardButton(text="🔙 Назад", callback_data="view_archive")]
         ]
 
-        if len(selected_screenshots[user_key]) > 0:
+        if len(selected) > 0:
             keyboard.insert(0, [
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
@@ -2686,14 +3111,15 @@ async def update_screenshot_message(message: Message, filename: str, user_id: in
         logger.error(f"Error updating screenshot message: {e}", exc_info=True)
 
 @router.callback_query(F.data == "delete_selected")
-async def handle_delete_selected(callback: CallbackQuery):
+async def handle_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle deletion of multiple selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
@@ -2712,7 +3138,7 @@ async def handle_delete_selected(callback: CallbackQuery):
         ]
 
         await callback.message.edit_text(
-            f"🗑 Удалить выбранные скриншоты ({len(selected_screenshots[user_key])})?\n"
+            f"🗑 Удалить выбранные скриншоты ({len(selected)})?\n"
             "Это действие нельзя отменить.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
         )
@@ -2722,28 +3148,30 @@ async def handle_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка")
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of multiple screenshot deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
         deleted_count = 0
         failed_count = 0
 
-        for filename in selected_screenshots[user_key]:
+        for filename in selected:
             if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
                 deleted_count += 1
             else:
                 failed_count += 1
 
         # Очищаем выбранные скриншоты
-        selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         # Показываем результат
         result_text = (
@@ -2765,14 +3193,16 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка при удалении")
 
 @router.callback_query(F.data == "cancel_delete_selected")
-async def handle_cancel_delete_selected(callback: CallbackQuery):
+async def handle_cancel_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle cancellation of multiple screenshot deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         user_key = f"user_{user_id}"
 
         # Очищаем выбранные скриншоты
-        selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         await callback.answer("✅ Удаление отменено")
         # Возвращаемся в архив
@@ -2934,7 +3364,7 @@ async def handle_view_stats(callback: CallbackQuery):
             "📊 Статистика скриншотов\n\n"
             f"📈 Всего скриншотов: {len(all_screenshots)}\n"
             f"🗓 В этом месяце: {monthly_stats['total_this_month']}\n"
-            f"💫 Доступно: {monthly_stats['remaining_limit']} из 100\n"
+            f"💫 Доступно: {monthly_stats['remaining_limit']} из {monthly_stats['monthly_limit']}\n"
             f"📊 Использовано: {monthly_stats['usage_percent']:.1f}%\n\n"
             "📁 По категориям:\n"
         )
@@ -3066,31 +3496,35 @@ async def handle_period_selection(callback: CallbackQuery):
         await callback.message.edit_text("Произошла ошибка при фильтрации")
 
 @router.callback_query(F.data.startswith("select_"))
-async def handle_screenshot_selection(callback: CallbackQuery):
+async def handle_screenshot_selection(callback: CallbackQuery, state: FSMContext):
     """Handle screenshot selection for multiple deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         filename = callback.data.replace("select_", "")
         user_key = f"user_{user_id}"
 
-        if filename in selected_screenshots[user_key]:
-            selected_screenshots[user_key].remove(filename)
+        if filename in selected:
+            selected.remove(filename)
+            await save_selected(state, selected)
             await callback.answer("❌ Скриншот убран из выбранных")
         else:
-            selected_screenshots[user_key].add(filename)
+            selected.add(filename)
+            await save_selected(state, selected)
             await callback.answer("✅ Скриншот добавлен к выбранным")
 
         # Обновляем интерфейс
-        await update_screenshot_message(callback.message, user_id, chat_id)
+        await update_screenshot_message(callback.message, user_id, chat_id, state)
 
     except Exception as e:
         logger.error(f"Error in screenshot selection: {e}", exc_info=True)
         await callback.answer("❌ Произошла ошибка")
 
-async def update_screenshot_message(message: Message, user_id: int, chat_id: int):
+async def update_screenshot_message(message: Message, user_id: int, chat_id: int, state: FSMContext):
     """Update message with selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_key = f"user_{user_id}"
         current_label = None
 
@@ -3104,10 +3538,10 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         keyboard = []
         
         # Добавляем кнопки действий, если есть выбранные скриншоты
-        if selected_screenshots[user_key]:
+        if selected:
             keyboard.append([
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
@@ -3123,7 +3557,7 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         # Добавляем кнопки для каждого скриншота
         for screenshot in screenshots:
             filename = os.path.basename(screenshot['filepath'])
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([
                 InlineKeyboardButton(
                     text=f"{screenshot['timestamp']} {'✅' if is_selected else ''}",
@@ -3145,14 +3579,15 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         logger.error(f"Error updating screenshot message: {e}", exc_info=True)
 
 @router.callback_query(F.data == "delete_selected")
-async def handle_delete_selected(callback: CallbackQuery):
+async def handle_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle deletion of selected screenshots"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
 
-        if not selected_screenshots[user_key]:
+        if not selected:
             await callback.answer("❌ Нет выбранных скриншотов")
             return
 
@@ -3171,7 +3606,7 @@ async def handle_delete_selected(callback: CallbackQuery):
         ]
 
         await callback.message.edit_text(
-            f"⚠️ Вы уверены, что хотите удалить {len(selected_screenshots[user_key])} выбранных скриншотов?\n"
+            f"⚠️ Вы уверены, что хотите удалить {len(selected)} выбранных скриншотов?\n"
             "Это действие нельзя отменить.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
         )
@@ -3181,9 +3616,10 @@ async def handle_delete_selected(callback: CallbackQuery):
         await callback.answer("❌ Произошла ошибка")
 
 @router.callback_query(F.data == "confirm_delete_selected")
-async def handle_confirm_delete_selected(callback: CallbackQuery):
+async def handle_confirm_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle confirmation of selected screenshots deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         user_key = f"user_{user_id}"
@@ -3191,7 +3627,7 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         # Показываем статус удаления
         status_message = await callback.message.edit_text(
             "🗑 Удаление выбранных скриншотов...\n"
-            f"Всего файлов: {len(selected_screenshots[user_key])}\n"
+            f"Всего файлов: {len(selected)}\n"
             "⏳ Пожалуйста, подождите..."
         )
 
@@ -3199,7 +3635,7 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
         failed_count = 0
         failed_files = []
 
-        for filename in selected_screenshots[user_key]:
+        for filename in selected:
             try:
                 logger.info(f"Attempting to delete selected screenshot: {filename}")
                 if screenshot_storage.delete_screenshot(filename, user_id, chat_id):
@@ -3214,7 +3650,7 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
                 if (deleted_count + failed_count) % 5 == 0:
                     await status_message.edit_text(
                         "🗑 Удаление выбранных скриншотов...\n"
-                        f"Обработано: {deleted_count + failed_count} из {len(selected_screenshots[user_key])}\n"
+                        f"Обработано: {deleted_count + failed_count} из {len(selected)}\n"
                         f"✅ Успешно: {deleted_count}\n"
                         f"❌ Ошибок: {failed_count}"
                     )
@@ -3225,7 +3661,8 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
                 logger.error(f"Error deleting selected screenshot {filename}: {e}", exc_info=True)
 
         # Очищаем выбранные скриншоты
-        selected_screenshots[user_key].clear()
+        selected.clear()
+        await save_selected(state, selected)
 
         # Формируем отчет
         result_text = [
@@ -3259,13 +3696,13 @@ async def handle_confirm_delete_selected(callback: CallbackQuery):
             logger.error(f"Error returning to archive: {e2}", exc_info=True)
 
 @router.callback_query(F.data == "cancel_delete_selected")
-async def handle_cancel_delete_selected(callback: CallbackQuery):
+async def handle_cancel_delete_selected(callback: CallbackQuery, state: FSMContext):
     """Handle cancellation of selected screenshots deletion"""
     try:
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         # Возвращаемся к просмотру выбранных скриншотов
-        await update_screenshot_message(callback.message, user_id, chat_id)
+        await update_screenshot_message(callback.message, user_id, chat_id, state)
         await callback.answer("❌ Удаление отменено")
     except Exception as e:
         logger.error(f"Error in cancel delete selected: {e}", exc_info=True)
@@ -3282,9 +3719,10 @@ def register_handlers(dp: Dispatcher):
         raise
 
 @router.callback_query(F.data.startswith("select_"))
-async def handle_screenshot_selection(callback: CallbackQuery):
+async def handle_screenshot_selection(callback: CallbackQuery, state: FSMContext):
     """Handle screenshot selection for multiple deletion"""
     try:
+        selected = await get_selected(state)
         user_id = callback.from_user.id
         chat_id = callback.message.chat.id
         filename = callback.data.replace("select_", "")
@@ -3292,27 +3730,30 @@ async def handle_screenshot_selection(callback: CallbackQuery):
         
         logger.info(f"[SELECTION] Processing selection for file: {filename}")
         logger.info(f"[SELECTION] User key: {user_key}")
-        logger.info(f"[SELECTION] Current selected files: {selected_screenshots[user_key]}")
+        logger.info(f"[SELECTION] Current selected files: {selected}")
 
-        if filename in selected_screenshots[user_key]:
-            selected_screenshots[user_key].remove(filename)
+        if filename in selected:
+            selected.remove(filename)
+            await save_selected(state, selected)
             logger.info(f"[SELECTION] Removed {filename} from selection")
             await callback.answer("❌ Скриншот убран из выбранных")
         else:
-            selected_screenshots[user_key].add(filename)
+            selected.add(filename)
+            await save_selected(state, selected)
             logger.info(f"[SELECTION] Added {filename} to selection")
             await callback.answer("✅ Скриншот добавлен к выбранным")
 
         # Обновляем интерфейс
-        await update_screenshot_message(callback.message, user_id, chat_id)
+        await update_screenshot_message(callback.message, user_id, chat_id, state)
 
     except Exception as e:
         logger.error(f"[SELECTION] Error in screenshot selection: {e}", exc_info=True)
         await callback.answer("❌ Произошла ошибка")
 
-async def update_screenshot_message(message: Message, user_id: int, chat_id: int):
+async def update_screenshot_message(message: Message, user_id: int, chat_id: int, state: FSMContext):
     """Update message with selected screenshots"""
     try:
+        selected = await get_selected(state)
         logger.info("[UPDATE_MESSAGE] Starting message update")
         user_key = f"user_{user_id}"
         
@@ -3333,14 +3774,14 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         keyboard = []
         
         # Добавляем кнопки действий, если есть выбранные скриншоты
-        if selected_screenshots[user_key]:
+        if selected:
             keyboard.append([
                 InlineKeyboardButton(
-                    text=f"🗑 Удалить выбранные ({len(selected_screenshots[user_key])})",
+                    text=f"🗑 Удалить выбранные ({len(selected)})",
                     callback_data="delete_selected"
                 )
             ])
-            logger.info(f"[UPDATE_MESSAGE] Added delete selected button for {len(selected_screenshots[user_key])} files")
+            logger.info(f"[UPDATE_MESSAGE] Added delete selected button for {len(selected)} files")
 
         # Добавляем кнопку для удаления всей категории
         keyboard.append([
@@ -3354,7 +3795,7 @@ async def update_screenshot_message(message: Message, user_id: int, chat_id: int
         # Добавляем кнопки для каждого скриншота
         for screenshot in screenshots:
             filename = os.path.basename(screenshot['filepath'])
-            is_selected = filename in selected_screenshots[user_key]
+            is_selected = filename in selected
             keyboard.append([
                 InlineKeyboardButton(
                     text=f"{screenshot['timestamp']} {'✅' if is_selected else ''}",
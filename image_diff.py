@@ -0,0 +1,126 @@
+import io
+import logging
+from typing import BinaryIO, List, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from config import DIFF_PIXEL_THRESHOLD, DIFF_BLOCK_SIZE, DIFF_STRIP_HEIGHT
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom
+ImageSource = Union[str, BinaryIO]  # path or binary file object
+
+HIGHLIGHT_FILL = (255, 64, 64)
+HIGHLIGHT_ALPHA = 80 / 255  # opacity of the fill over changed blocks
+HIGHLIGHT_OUTLINE = (220, 0, 0)
+
+
+class DiffResult:
+    """Overlay PNG of the newer image with changed regions highlighted"""
+
+    def __init__(self, overlay: bytes, boxes: List[Box], changed_ratio: float, size: Tuple[int, int]):
+        self.overlay = overlay
+        self.boxes = boxes
+        self.changed_ratio = changed_ratio  # share of changed blocks
+        self.size = size
+
+
+def _strip(image: Image.Image, top: int, height: int, width: int) -> np.ndarray:
+    """Grayscale rows [top, top + height) padded with white to `width` and `height`"""
+    strip = np.full((height, width), 255, dtype=np.int16)
+    bottom = min(image.height, top + height)
+    if bottom > top:
+        crop = image.crop((0, top, min(image.width, width), bottom)).convert("L")
+        strip[:bottom - top, :crop.width] = np.asarray(crop, dtype=np.int16)
+    return strip
+
+
+def _changed_blocks(old: Image.Image, new: Image.Image, threshold: int, block: int, strip_height: int) -> np.ndarray:
+    """Boolean grid with one cell per block, True where any pixel differs by more than threshold"""
+    width = max(old.width, new.width)
+    height = max(old.height, new.height)
+    blocks_x = -(-width // block)
+    blocks_y = -(-height // block)
+    padded_width = blocks_x * block
+    # Полоса кратна размеру блока, чтобы блоки не разрезались между полосами
+    strip_height = max(block, strip_height // block * block)
+
+    grid = np.zeros((blocks_y, blocks_x), dtype=bool)
+    for top in range(0, blocks_y * block, strip_height):
+        rows = min(strip_height, blocks_y * block - top)
+        changed = np.abs(_strip(old, top, rows, padded_width) - _strip(new, top, rows, padded_width)) > threshold
+        grid[top // block:(top + rows) // block] = changed.reshape(rows // block, block, blocks_x, block).any(axis=(1, 3))
+    return grid
+
+
+def _bounding_boxes(grid: np.ndarray, block: int, width: int, height: int) -> List[Box]:
+    """Merge 8-connected changed blocks into pixel bounding boxes"""
+    seen = np.zeros_like(grid)
+    boxes: List[Box] = []
+    blocks_y, blocks_x = grid.shape
+    for start_y, start_x in zip(*np.nonzero(grid)):
+        if seen[start_y, start_x]:
+            continue
+        seen[start_y, start_x] = True
+        stack = [(start_y, start_x)]
+        min_y, min_x, max_y, max_x = start_y, start_x, start_y, start_x
+        while stack:
+            y, x = stack.pop()
+            min_y, min_x, max_y, max_x = min(min_y, y), min(min_x, x), max(max_y, y), max(max_x, x)
+            for ny in range(max(0, y - 1), min(blocks_y, y + 2)):
+                for nx in range(max(0, x - 1), min(blocks_x, x + 2)):
+                    if grid[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        stack.append((ny, nx))
+        boxes.append((
+            int(min_x * block), int(min_y * block),
+            int(min((max_x + 1) * block, width)), int(min((max_y + 1) * block, height)),
+        ))
+    boxes.sort(key=lambda box: (box[1], box[0]))
+    return boxes
+
+
+def _draw_strip(canvas: Image.Image, new: Image.Image, grid: np.ndarray, block: int, top: int, rows: int) -> None:
+    """Paste rows [top, top + rows) of `new` onto the RGB canvas and tint the changed blocks in them"""
+    if top < new.height:
+        canvas.paste(new.crop((0, top, new.width, min(new.height, top + rows))).convert("RGB"), (0, top))
+    cells = grid[top // block:-(-(top + rows) // block)]
+    if not cells.any():
+        return
+    mask = np.repeat(np.repeat(cells, block, axis=0), block, axis=1)[:rows, :canvas.width]
+    pixels = np.array(canvas.crop((0, top, canvas.width, top + rows)), dtype=np.float32)
+    pixels[mask] = pixels[mask] * (1 - HIGHLIGHT_ALPHA) + np.array(HIGHLIGHT_FILL, dtype=np.float32) * HIGHLIGHT_ALPHA
+    canvas.paste(Image.fromarray(pixels.astype(np.uint8), "RGB"), (0, top))
+
+
+def diff_images(old_source: ImageSource, new_source: ImageSource, threshold: int = DIFF_PIXEL_THRESHOLD,
+                block: int = DIFF_BLOCK_SIZE, strip_height: int = DIFF_STRIP_HEIGHT) -> DiffResult:
+    """
+    Compare two screenshots and highlight what changed in the newer one.
+
+    Images are aligned at the top-left corner; the part present in only one
+    of them counts as changed. Comparison and highlighting run strip by strip
+    on a single RGB canvas, so no full-size RGBA copies are made and NumPy
+    buffers stay within `strip_height` rows regardless of capture height.
+    """
+    with Image.open(old_source) as old, Image.open(new_source) as new:
+        width, height = max(old.width, new.width), max(old.height, new.height)
+        grid = _changed_blocks(old, new, threshold, block, strip_height)
+        boxes = _bounding_boxes(grid, block, width, height)
+
+        canvas = Image.new("RGB", (width, height), "white")
+        strip_height = max(block, strip_height // block * block)
+        for top in range(0, height, strip_height):
+            _draw_strip(canvas, new, grid, block, top, min(strip_height, height - top))
+
+    draw = ImageDraw.Draw(canvas)
+    for box in boxes:
+        draw.rectangle([box[0], box[1], box[2] - 1, box[3] - 1], outline=HIGHLIGHT_OUTLINE, width=3)
+
+    buffer = io.BytesIO()
+    canvas.save(buffer, format="PNG", compress_level=1)
+    changed_ratio = float(grid.mean()) if grid.size else 0.0
+    logger.info(f"Diff {width}x{height}: {len(boxes)} regions, {changed_ratio:.1%} of blocks changed")
+    return DiffResult(buffer.getvalue(), boxes, changed_ratio, (width, height))
@@ -1,7 +1,10 @@
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageChops, ImageEnhance
 import io
 import logging
-from typing import Dict, Tuple, Optional
+import time
+from typing import BinaryIO, Dict, Tuple, Optional, Union
+
+from metrics import image_process_seconds, image_encode_seconds
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +48,8 @@ class ImageProcessor:
             for preset_name, params in presets.items():
                 preview = ImageProcessor._apply_enhancements(image.copy(), **params)
                 output = io.BytesIO()
-                preview.save(output, format='PNG', optimize=True)
+                with image_encode_seconds.time(format='PNG'):
+                    preview.save(output, format='PNG', optimize=True)
                 preview_dict[preset_name] = output.getvalue()
 
             return preview_dict
@@ -59,9 +63,8 @@ class ImageProcessor:
         """
         Process image with predefined presets
         """
+        started = time.perf_counter()
         try:
-            image = Image.open(io.BytesIO(image_data))
-
             presets = {
                 'none': {'brightness': 1.0, 'contrast': 1.0, 'sharpness': 1.0},
                 'default': {'brightness': 1.1, 'contrast': 1.1, 'sharpness': 1.0},
@@ -75,22 +78,26 @@ class ImageProcessor:
                 logger.warning(f"Unknown preset {preset}, using default")
                 preset = 'default'
 
-            # Для пресета 'none' просто возвращаем оригинальное изображение
+            # Для пресета 'none' возвращаем исходный буфер без декодирования и перекодирования
             if preset == 'none':
-                output = io.BytesIO()
-                image.save(output, format='PNG', optimize=True)
-                return output.getvalue()
+                return image_data
 
+            # BytesIO над bytes использует тот же буфер, копии не создаётся
+            image = Image.open(io.BytesIO(image_data))
             params = presets[preset]
             enhanced = ImageProcessor._apply_enhancements(image, **params)
 
             output = io.BytesIO()
-            enhanced.save(output, format='PNG', optimize=True)
+            with image_encode_seconds.time(format='PNG'):
+                enhanced.save(output, format='PNG', optimize=True)
+            # getvalue() отдаёт внутренний буфер BytesIO без копирования
             return output.getvalue()
 
         except Exception as e:
             logger.error(f"Image processing error: {str(e)}")
             return image_data
+        finally:
+            image_process_seconds.observe(time.perf_counter() - started, preset=preset)
 
     @staticmethod
     def convert_format(image_data: bytes, target_format: str) -> bytes:
@@ -100,8 +107,60 @@ class ImageProcessor:
         try:
             image = Image.open(io.BytesIO(image_data))
             output = io.BytesIO()
-            image.save(output, format=target_format, optimize=True)
+            with image_encode_seconds.time(format=target_format):
+                image.save(output, format=target_format, optimize=True)
             return output.getvalue()
         except Exception as e:
             logger.error(f"Format conversion error: {str(e)}")
-            return image_data
\ No newline at end of file
+            return image_data
+    @staticmethod
+    def perceptual_hash(image_data: bytes) -> Optional[str]:
+        """
+        64-bit difference hash (dHash) as 16 hex digits.
+
+        Similar images get hashes with a small Hamming distance.
+        """
+        try:
+            image = Image.open(io.BytesIO(image_data))
+            # draft() позволяет JPEG декодироваться сразу в уменьшенном виде
+            image.draft('L', (image.width // 8, image.height // 8))
+            small = image.convert('L').resize((9, 8), Image.Resampling.BOX)
+            pixels = list(small.getdata())
+            value = 0
+            for row in range(8):
+                for column in range(8):
+                    left = pixels[row * 9 + column]
+                    right = pixels[row * 9 + column + 1]
+                    value = (value << 1) | (1 if left > right else 0)
+            return f"{value:016x}"
+        except Exception as e:
+            logger.error(f"Perceptual hash error: {str(e)}")
+            return None
+
+    @staticmethod
+    def perceptual_hash_file(filepath: str) -> Optional[str]:
+        """Perceptual hash of an image file"""
+        try:
+            with open(filepath, 'rb') as f:
+                return ImageProcessor.perceptual_hash(f.read())
+        except Exception as e:
+            logger.error(f"Perceptual hash error for {filepath}: {str(e)}")
+            return None
+
+    @staticmethod
+    def same_pixels(first: Union[bytes, BinaryIO], second: Union[bytes, BinaryIO]) -> bool:
+        """Check that two images decode to identical pixels (different encodings of one picture)"""
+        try:
+            with Image.open(io.BytesIO(first) if isinstance(first, bytes) else first) as a, \
+                    Image.open(io.BytesIO(second) if isinstance(second, bytes) else second) as b:
+                if a.size != b.size:
+                    return False
+                return ImageChops.difference(a.convert('RGB'), b.convert('RGB')).getbbox() is None
+        except Exception as e:
+            logger.error(f"Pixel comparison error: {str(e)}")
+            return False
+
+    @staticmethod
+    def hash_distance(first: str, second: str) -> int:
+        """Hamming distance between two perceptual hashes"""
+        return bin(int(first, 16) ^ int(second, 16)).count('1')
@@ -0,0 +1,412 @@
+"""
+End-to-end load test of the bot against a local fake Telegram Bot API.
+
+    python loadtest.py --users 50 --rate 5 --iterations 2
+    python loadtest.py --users 200 --rate 20 --steps start browse --no-rate-limit --output loadtest.json
+
+The production dispatcher (bot.create_dispatcher + handlers.router) runs in
+this process with a Bot whose session talks HTTP to an in-process fake Bot
+API. The fake API answers like Telegram and keeps every message the bot
+sends, so simulated users find the buttons they press in what the bot
+actually sent them. Captures use FakeCaptureProvider (CAPTURE_PROVIDER=fake)
+and the archive lives in a temporary working directory.
+
+Each user runs the scripted flow start -> screenshot -> preset -> archive ->
+browse -> delete; users arrive at --rate per second. The report gives
+throughput, p50/p95/p99 latency per step and errors: exceptions, missing
+buttons, Bot API errors and error replies shown to the user.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+LOADTEST_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Load test bot", "username": "loadtest_bot"}
+FIRST_USER_ID = 10_000_000  # вне диапазона реальных пользователей архива
+PRESETS = ["high_contrast", "bright", "sharp", "balanced", "none"]
+STEPS = ["start", "screenshot", "preset", "archive", "browse", "delete"]
+ERROR_MARKERS = ("❌", "Произошла ошибка")
+
+
+class FakeBotAPI:
+    """Bot API stand-in: answers the methods the bot uses and keeps its messages per chat"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.messages: Dict[int, Dict[int, Dict]] = defaultdict(dict)
+        self.next_message_id: Dict[int, int] = defaultdict(int)
+        self.calls: Counter = Counter()
+        self.api_errors: Counter = Counter()
+        self.error_replies: Counter = Counter()  # per chat
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _error(self, method: str, description: str) -> web.Response:
+        self.api_errors[method] += 1
+        return web.json_response({"ok": False, "error_code": 400, "description": f"Bad Request: {description}"})
+
+    def _note_reply(self, chat_id: int, text: Optional[str]) -> None:
+        if text and any(marker in text for marker in ERROR_MARKERS):
+            self.error_replies[chat_id] += 1
+
+    def _new_message(self, chat_id: int, form) -> Dict:
+        self.next_message_id[chat_id] += 1
+        message = {
+            "message_id": self.next_message_id[chat_id],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "reply_markup" in form:
+            message["reply_markup"] = json.loads(form["reply_markup"])
+        self.messages[chat_id][message["message_id"]] = message
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        chat_id = int(form["chat_id"]) if "chat_id" in form else None
+        if method == "getMe":
+            result: Any = BOT_USER
+        elif method == "sendMessage":
+            result = self._new_message(chat_id, form)
+            result["text"] = form["text"]
+            self._note_reply(chat_id, form["text"])
+        elif method == "sendPhoto":
+            result = self._new_message(chat_id, form)
+            file_id = f"photo{chat_id}_{result['message_id']}"
+            result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1220, "height": 1000}]
+            result["caption"] = form.get("caption", "")
+        elif method == "sendDocument":
+            result = self._new_message(chat_id, form)
+            document = form["document"]
+            file_id = f"document{chat_id}_{result['message_id']}"
+            result["document"] = {"file_id": file_id, "file_unique_id": file_id,
+                                  "file_name": getattr(document, "filename", "document")}
+            result["caption"] = form.get("caption", "")
+        elif method in ("editMessageText", "editMessageReplyMarkup"):
+            message = self.messages[chat_id].get(int(form["message_id"]))
+            if message is None:
+                return self._error(method, "message to edit not found")
+            if method == "editMessageText":
+                if "text" not in message:
+                    return self._error(method, "there is no text in the message to edit")
+                message["text"] = form["text"]
+                self._note_reply(chat_id, form["text"])
+            if "reply_markup" in form:
+                message["reply_markup"] = json.loads(form["reply_markup"])
+            else:
+                message.pop("reply_markup", None)
+            result = message
+        elif method == "deleteMessage":
+            if self.messages[chat_id].pop(int(form["message_id"]), None) is None:
+                return self._error(method, "message to delete not found")
+            result = True
+        elif method == "answerCallbackQuery":
+            # Всплывающее уведомление не сообщение, но ошибки в нём видит пользователь
+            if "text" in form:
+                self._note_reply(int(form["callback_query_id"].split("_")[0]), form["text"])
+            result = True
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FlowError(Exception):
+    """The bot did not send what the next step of the flow needs"""
+
+
+class SimulatedUser:
+    """One private chat driving the dispatcher the way a person presses buttons"""
+
+    def __init__(self, number: int, harness: "LoadTest"):
+        self.harness = harness
+        self.user_id = FIRST_USER_ID + number
+        self.user = {"id": self.user_id, "is_bot": False, "first_name": f"User{number}"}
+        self.shown_filename: Optional[str] = None
+
+    @property
+    def messages(self) -> Dict[int, Dict]:
+        return self.harness.api.messages[self.user_id]
+
+    def find_button(self, prefix: str, pick_random: bool = False) -> Tuple[Dict, str]:
+        """Newest bot message with a button whose callback data starts with prefix"""
+        for message in reversed(list(self.messages.values())):
+            buttons = [
+                button["callback_data"]
+                for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                for button in row
+                if button.get("callback_data", "").startswith(prefix)
+            ]
+            if buttons:
+                return message, random.choice(buttons) if pick_random else buttons[0]
+        last = next(reversed(self.messages.values()), {})
+        reply = (last.get("text") or last.get("caption") or "").splitlines()
+        raise FlowError(f"no '{prefix}' button, last reply: {reply[0][:60] if reply else '-'}")
+
+    async def send_text(self, text: str) -> None:
+        await self.harness.feed({
+            "message": {
+                "message_id": random.randrange(1, 2 ** 31),
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private", "first_name": self.user["first_name"]},
+                "from": self.user,
+                "text": text,
+                **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+                   if text.startswith("/") else {}),
+            }
+        })
+
+    async def press(self, prefix: str, pick_random: bool = False) -> str:
+        message, data = self.find_button(prefix, pick_random)
+        await self.harness.feed({
+            "callback_query": {
+                "id": f"{self.user_id}_{random.getrandbits(32)}",
+                "from": self.user,
+                "chat_instance": str(self.user_id),
+                "message": message,
+                "data": data,
+            }
+        })
+        return data
+
+    # Шаги сценария
+    async def start(self) -> None:
+        await self.send_text("/start")
+        self.find_button("take_screenshot")
+
+    async def screenshot(self) -> None:
+        await self.press("take_screenshot")
+        self.find_button("archive_")
+
+    async def preset(self) -> None:
+        await self.press("presets_menu")
+        await self.press("preset_" + random.choice(PRESETS))
+        self.find_button("archive_")
+
+    async def archive(self) -> None:
+        await self.press("archive_")
+        await self.press("autosave_")
+
+    async def browse(self) -> None:
+        await self.press("view_archive")
+        await self.press("label_", pick_random=True)
+        data = await self.press("show_screenshot_", pick_random=True)
+        self.shown_filename = data[len("show_screenshot_"):]
+
+    async def delete(self) -> None:
+        if not self.shown_filename:
+            raise FlowError("nothing browsed to delete")
+        await self.press(f"delete_{self.shown_filename}")
+        self.shown_filename = None
+
+
+class LoadTest:
+    """Fake API, bot, dispatcher and the latency/error bookkeeping of a run"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.api = FakeBotAPI(args.api_latency)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+        self.update_id = 0
+        self.updates = 0
+        self.flows_completed = 0
+        self.bot = None
+        self.dp = None
+
+    async def feed(self, update: Dict) -> None:
+        self.update_id += 1
+        self.updates += 1
+        response = await self.dp.feed_raw_update(self.bot, {"update_id": self.update_id, **update})
+        from aiogram.dispatcher.event.bases import UNHANDLED
+        if response is UNHANDLED:
+            raise FlowError("update not handled")
+
+    async def run_step(self, user: SimulatedUser, name: str) -> bool:
+        step: Callable[[], Awaitable[None]] = getattr(user, name)
+        replies_before = self.api.error_replies[user.user_id]
+        started = time.perf_counter()
+        try:
+            await step()
+            ok = True
+        except FlowError as e:
+            self.errors[name][str(e)] += 1
+            ok = False
+        except Exception as e:
+            self.errors[name][type(e).__name__] += 1
+            ok = False
+        self.latencies[name].append((time.perf_counter() - started) * 1000)
+        if self.api.error_replies[user.user_id] > replies_before:
+            self.errors[name]["error reply"] += 1
+        return ok
+
+    async def run_user(self, number: int) -> None:
+        user = SimulatedUser(number, self)
+        for _ in range(self.args.iterations):
+            completed = True
+            for name in self.args.steps:
+                if not await self.run_step(user, name):
+                    completed = False
+                    break
+                if self.args.think:
+                    await asyncio.sleep(random.expovariate(1 / self.args.think))
+            self.flows_completed += completed
+
+    async def run(self) -> Dict:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        from application import create_bot, create_dispatcher
+        from handlers import register_handlers
+        from capture_queue import capture_queue
+        from tracing import span_exporter
+
+        runner = web.AppRunner(self.api.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host="127.0.0.1", port=self.args.api_port)
+        await site.start()
+        port = runner.addresses[0][1]
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+        self.bot = create_bot(LOADTEST_TOKEN, session, rate_limit=not self.args.no_rate_limit)
+        self.dp = create_dispatcher()
+        register_handlers(self.dp)
+        capture_queue.start()
+
+        started = time.perf_counter()
+        try:
+            tasks = []
+            for number in range(self.args.users):
+                tasks.append(asyncio.create_task(self.run_user(number)))
+                if self.args.rate:
+                    await asyncio.sleep(1 / self.args.rate)
+            await asyncio.gather(*tasks)
+        finally:
+            elapsed = time.perf_counter() - started
+            await capture_queue.stop()
+            await self.bot.session.close()
+            await self.dp.storage.close()
+            await runner.cleanup()
+            span_exporter.shutdown()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict:
+        steps = {}
+        for name in self.args.steps:
+            latencies = sorted(self.latencies[name])
+            steps[name] = {
+                "count": len(latencies),
+                "errors": sum(self.errors[name].values()),
+                "error_kinds": dict(self.errors[name]),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "p99_ms": percentile(latencies, 99),
+                "max_ms": round(latencies[-1], 1) if latencies else None,
+            }
+        return {
+            "config": {key: value for key, value in vars(self.args).items() if key not in ("output", "workdir")},
+            "elapsed_s": round(elapsed, 2),
+            "throughput": {
+                "updates_per_s": round(self.updates / elapsed, 2),
+                "steps_per_s": round(sum(step["count"] for step in steps.values()) / elapsed, 2),
+                "flows_per_s": round(self.flows_completed / elapsed, 3),
+            },
+            "flows_completed": self.flows_completed,
+            "flows_started": self.args.users * self.args.iterations,
+            "steps": steps,
+            "bot_api_calls": dict(self.api.calls),
+            "bot_api_errors": dict(self.api.api_errors),
+        }
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return round(values[int(rank) - 1], 1)
+
+
+def print_report(report: Dict) -> None:
+    throughput = report["throughput"]
+    print(f"\n{report['flows_completed']}/{report['flows_started']} flows completed in {report['elapsed_s']} s")
+    print(f"Throughput: {throughput['updates_per_s']} updates/s, {throughput['steps_per_s']} steps/s, "
+          f"{throughput['flows_per_s']} flows/s\n")
+    print(f"  {'step':<12}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, step in report["steps"].items():
+        values = [step[key] if step[key] is not None else "-" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(f"  {name:<12}{step['count']:>7}{step['errors']:>8}" + "".join(f"{value:>10}" for value in values))
+    for name, step in report["steps"].items():
+        for kind, count in step["error_kinds"].items():
+            print(f"  ! {name}: {kind} x{count}")
+    if report["bot_api_errors"]:
+        print(f"  Bot API errors: {report['bot_api_errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake Bot API")
+    parser.add_argument("--users", type=int, default=20, help="simulated users")
+    parser.add_argument("--rate", type=float, default=5, help="new users per second, 0 = all at once")
+    parser.add_argument("--iterations", type=int, default=1, help="flows per user")
+    parser.add_argument("--steps", nargs="+", choices=STEPS, default=STEPS, help="steps of the flow, in order")
+    parser.add_argument("--think", type=float, default=0.5, help="mean pause between steps, seconds")
+    parser.add_argument("--capture-latency", type=float, default=0.5, help="fake capture seconds")
+    parser.add_argument("--capture-error-rate", type=float, default=0.0, help="share of failing captures")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Bot API seconds per call")
+    parser.add_argument("--api-port", type=int, default=0, help="fake Bot API port, 0 = any free port")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="drop the Telegram rate limiter to measure the process alone")
+    parser.add_argument("--workdir", help="archive directory (default: a temporary one, removed afterwards)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the report JSON here")
+    args = parser.parse_args()
+
+    # Конфигурация читается при импорте модулей бота, поэтому окружение задаётся до него
+    os.environ["CAPTURE_PROVIDER"] = "fake"
+    os.environ["FAKE_CAPTURE_LATENCY"] = str(args.capture_latency)
+    os.environ["FAKE_CAPTURE_ERROR_RATE"] = str(args.capture_error_rate)
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("TRACE_SINK", "none")
+    os.environ.setdefault("FSM_STORAGE", "memory")
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bot-loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    from logging_setup import setup_logging, stop_logging
+    setup_logging(level=args.log_level, log_file=None)
+    try:
+        report = asyncio.run(LoadTest(args).run())
+    finally:
+        stop_logging()
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
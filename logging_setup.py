@@ -0,0 +1,108 @@
+"""
+Central logging setup.
+
+Records are put on a queue by a QueueHandler and written to the console and
+a rotating file by a QueueListener thread, so handlers on the event loop
+never wait on disk. Per-record debug lines in hot paths go through
+debug_sampled(), which keeps only the first and every LOG_SAMPLE_EVERY-th
+line of each message.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional, Tuple
+
+from config import LOG_FILE, LOG_FORMAT, LOG_LEVEL, LOG_LEVELS, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_SAMPLE_EVERY
+
+logger = logging.getLogger(__name__)
+
+_listener: Optional[QueueListener] = None
+
+
+def parse_levels(text: str) -> Dict[str, int]:
+    """'storage=DEBUG,aiogram=WARNING' -> {'storage': 10, 'aiogram': 30}"""
+    levels = {}
+    for item in text.split(","):
+        name, _, level = item.strip().partition("=")
+        if not name or not level:
+            continue
+        value = logging.getLevelName(level.strip().upper())
+        if isinstance(value, int):
+            levels[name.strip()] = value
+        else:
+            logger.warning(f"Unknown log level {level} for {name}")
+    return levels
+
+
+def setup_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, log_file: Optional[str] = LOG_FILE,
+                  console: bool = True) -> QueueListener:
+    """Route all records through a queue to the console and a rotating file; safe to call twice"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handlers.append(RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                            encoding="utf-8"))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level.upper())
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging() -> None:
+    """Write records still in the queue and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LogSampler:
+    """Counts repeated debug messages and lets through the first and every `every`-th one"""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        self.every = max(1, every)
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def debug(self, target: logging.Logger, message: str, *args) -> None:
+        # Аргументы форматируются только для записей, которые действительно пишутся
+        if not target.isEnabledFor(logging.DEBUG):
+            return
+        key = (target.name, message)
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+        if self.every == 1 or count % self.every == 1:
+            target.debug(f"{message} [sampled: #%d, 1 of %d]", *args, count, self.every, stacklevel=3)
+
+
+log_sampler = LogSampler()
+
+
+def debug_sampled(target: logging.Logger, message: str, *args) -> None:
+    """Sampled debug line for per-record logging in hot paths; `message` uses %-style args"""
+    log_sampler.debug(target, message, *args)
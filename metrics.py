@@ -0,0 +1,342 @@
+"""
+Process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms live in one registry; modules that own
+state (capture queue, breakers, quota ledger) add collectors that are read
+on every scrape. start_metrics_server() serves the registry on
+METRICS_HOST:METRICS_PORT/metrics. Metrics are updated from worker threads
+too, so every metric has its own lock.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Dict[str, str]
+Sample = Tuple[Labels, float]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of labelled metrics: one child value per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels: Any):
+        key = self._key(labels)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _items(self) -> List[Tuple[Labels, Any]]:
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), child) for key, child in self._children.items()]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self, lock: threading.Lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        self.labels(**labels).inc(amount)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {_format_value(child.value)}" for labels, child in self._items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float], lock: threading.Lock):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = lock
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets, self._lock)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels: Any):
+        return self.labels(**labels).time()
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, child in self._items():
+            with self._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = {**labels, "le": _format_value(bound)}
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """All metrics of the process plus collectors evaluated at scrape time"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Tuple[str, str, str, Callable[[], List[Sample]]]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, name: str, kind: str, documentation: str, collect: Callable[[], List[Sample]]) -> None:
+        """Metric whose samples `collect()` returns on every scrape, e.g. a queue depth"""
+        self._collectors.append((name, kind, documentation, collect))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for name, kind, documentation, collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.warning(f"Metrics collector {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Обработчики обновлений
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Time spent in update handlers", ["event", "handler"])
+handler_errors = registry.counter(
+    "bot_handler_errors_total", "Update handlers that raised", ["event", "handler"])
+
+# Снимки и обработка изображений
+capture_seconds = registry.histogram(
+    "bot_capture_seconds", "Capture time by provider and stage (render, download, total)", ["provider", "stage"])
+captures_total = registry.counter(
+    "bot_captures_total", "Capture requests by outcome", ["provider", "outcome"])
+capture_queue_wait_seconds = registry.histogram(
+    "bot_capture_queue_wait_seconds", "Time capture jobs wait for a worker", ["priority"])
+capture_fallbacks = registry.counter(
+    "bot_capture_fallbacks_total", "Captures served from an older image", ["source", "reason"])
+image_process_seconds = registry.histogram(
+    "bot_image_process_seconds", "Image enhancement time per preset, encoding included", ["preset"])
+image_encode_seconds = registry.histogram(
+    "bot_image_encode_seconds", "Image encoding time", ["format"])
+
+# Архив
+storage_seconds = registry.histogram(
+    "bot_storage_operation_seconds", "Screenshot storage operation time", ["operation"])
+cache_requests = registry.counter(
+    "bot_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"])
+
+# Bot API
+telegram_requests = registry.counter(
+    "bot_telegram_requests_total", "Bot API calls sent", ["method"])
+telegram_errors = registry.counter(
+    "bot_telegram_errors_total", "Bot API calls that failed", ["method", "error"])
+telegram_seconds = registry.histogram(
+    "bot_telegram_request_seconds", "Bot API call latency", ["method"])
+
+
+def timed(histogram: Histogram, **labels: Any):
+    """Decorator observing the run time of a sync or async function"""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: latency and errors of the handler chosen for a message or callback"""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(event=self.event, handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, event=self.event, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Session middleware counting Bot API calls; register it after the rate limiter to time real requests"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        name = type(method).__name__
+        telegram_requests.inc(method=name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_errors.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - started, method=name)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """Serve GET /metrics; returns the runner to clean up, or None when METRICS_PORT is 0"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
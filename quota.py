@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import pytz
+
+from config import APIFLASH_MONTHLY_LIMIT, APIFLASH_RESERVE_MARGIN, QUOTA_FILE, SCHEDULE_TIMEZONE
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceededError(Exception):
+    """Raised when an APIFlash call would eat into the budget it is not allowed to use"""
+
+
+def _local_now(now: Optional[datetime] = None) -> datetime:
+    """`now` (current time by default) in SCHEDULE_TIMEZONE, the days and months the scheduler fires in"""
+    tz = pytz.timezone(SCHEDULE_TIMEZONE)
+    if now is None:
+        return datetime.now(tz)
+    return now.astimezone(tz) if now.tzinfo else now
+
+
+def _last_day_of_month(now: datetime) -> int:
+    next_month = now.replace(day=28) + timedelta(days=4)
+    return (next_month - timedelta(days=next_month.day)).day
+
+
+def scheduled_reserve(now: Optional[datetime] = None) -> int:
+    """
+    Calls still needed by the scheduler this month.
+
+    One daily report per remaining day (today included) plus the
+    start/middle/end of month reports that have not fired yet.
+    """
+    now = _local_now(now)
+    last_day = _last_day_of_month(now)
+    reserve = last_day - now.day + 1
+    reserve += sum(1 for day in (1, 15, last_day) if day >= now.day)
+    return reserve
+
+
+class QuotaLedger:
+    """
+    Persistent per-month count of real APIFlash calls.
+
+    Months are counted in SCHEDULE_TIMEZONE, like the scheduler's reports
+    the reserve is kept for.
+
+    A call is recorded before the request is sent, so failed requests are
+    counted too. Interactive captures may not use the part of the budget
+    reserved for scheduled reports.
+    """
+
+    def __init__(self, path: str = QUOTA_FILE, monthly_limit: int = APIFLASH_MONTHLY_LIMIT,
+                 reserve_margin: int = APIFLASH_RESERVE_MARGIN):
+        self.path = path
+        self.monthly_limit = monthly_limit
+        self.reserve_margin = reserve_margin
+        # Вызовы идут из потоков воркеров очереди
+        self._lock = threading.Lock()
+        self.months: Dict[str, Dict[str, int]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, int]]:
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f).get("months", {})
+            except Exception as e:
+                logger.error(f"Error loading quota ledger: {e}")
+        return {}
+
+    def _save(self) -> None:
+        """Write ledger atomically so a crash never loses recorded calls"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"months": self.months}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving quota ledger: {e}")
+
+    @staticmethod
+    def _month_key(now: Optional[datetime] = None) -> str:
+        return _local_now(now).strftime("%Y-%m")
+
+    def _month(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        return self.months.setdefault(
+            self._month_key(now), {"calls": 0, "failures": 0, "scheduled": 0, "interactive": 0}
+        )
+
+    def used(self, now: Optional[datetime] = None) -> int:
+        return self.months.get(self._month_key(now), {}).get("calls", 0)
+
+    def remaining(self, now: Optional[datetime] = None) -> int:
+        return max(0, self.monthly_limit - self.used(now))
+
+    def interactive_available(self, now: Optional[datetime] = None) -> int:
+        """Calls left for interactive captures after the scheduled reserve"""
+        reserve = scheduled_reserve(now) + self.reserve_margin
+        return max(0, self.remaining(now) - reserve)
+
+    def can_spend(self, scheduled: bool = False, now: Optional[datetime] = None) -> bool:
+        if scheduled:
+            return self.remaining(now) > 0
+        return self.interactive_available(now) > 0
+
+    def acquire(self, scheduled: bool = False) -> None:
+        """Record a call that is about to be sent, or raise QuotaExceededError"""
+        with self._lock:
+            now = _local_now()
+            if not self.can_spend(scheduled, now):
+                kind = "scheduled" if scheduled else "interactive"
+                logger.warning(
+                    f"APIFlash quota denied {kind} call: used {self.used(now)} of {self.monthly_limit}"
+                )
+                raise QuotaExceededError(f"APIFlash monthly quota reached for {kind} captures")
+            month = self._month(now)
+            month["calls"] += 1
+            month["scheduled" if scheduled else "interactive"] += 1
+            self._save()
+            logger.info(f"APIFlash call recorded: {month['calls']} of {self.monthly_limit} this month")
+
+    def record_failure(self) -> None:
+        """Mark the last acquired call as failed (it still counts against the quota)"""
+        with self._lock:
+            self._month()["failures"] += 1
+            self._save()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            month = dict(self._month())
+        used = month["calls"]
+        return {
+            **month,
+            "monthly_limit": self.monthly_limit,
+            "remaining_limit": max(0, self.monthly_limit - used),
+            "interactive_available": self.interactive_available(),
+            "usage_percent": min(100, used / self.monthly_limit * 100) if self.monthly_limit else 100,
+        }
+
+
+quota_ledger = QuotaLedger()
+
+registry.add_collector(
+    "bot_apiflash_quota", "gauge", "APIFlash quota this month by kind (calls, failures, limit, remaining, ...)",
+    lambda: [({"kind": kind}, quota_ledger.stats()[kind])
+             for kind in ("calls", "failures", "scheduled", "interactive", "monthly_limit",
+                          "remaining_limit", "interactive_available")])
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_GROUP_RATE_PER_MINUTE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_BURST,
+    TELEGRAM_MAX_RETRIES,
+    TELEGRAM_MAX_TRACKED_CHATS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Asyncio token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def block(self, seconds: float) -> None:
+        """Stop issuing tokens for `seconds` (used for Telegram flood-wait)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def wait_unblocked(self) -> None:
+        """Wait out a flood-wait pause without taking a token"""
+        while (delay := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    @property
+    def idle(self) -> bool:
+        """Bucket is full and not blocked, so it can be recreated without losing state"""
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until and not self._lock.locked()
+
+
+class _PendingEdit:
+    """Latest edit_text payload waiting for a token and the task that will send it"""
+
+    def __init__(self, method: EditMessageText):
+        self.method = method
+        self.task: Optional[asyncio.Task] = None
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """
+    Outbound scheduler for Bot API calls.
+
+    New messages (send*, forward, copy) take a token from the global bucket and
+    from the bucket of their chat; edits and deletes take a token from the chat
+    bucket only. A chat may send a short burst before its rate applies. Other
+    calls (callback answers, getters) only wait while their chat is paused by a
+    flood-wait. An edit_text waiting for a token is replaced by a newer edit of
+    the same message: only the latest text is sent and all callers get its
+    result. On 429 the affected bucket is paused for `retry_after` and the call
+    is retried.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        group_rate_per_minute: float = TELEGRAM_GROUP_RATE_PER_MINUTE,
+        max_retries: int = TELEGRAM_MAX_RETRIES,
+        max_tracked_chats: int = TELEGRAM_MAX_TRACKED_CHATS,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        group_burst: float = TELEGRAM_GROUP_BURST,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.chat_burst = chat_burst
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.pending_edits: Dict[Tuple[int, int], _PendingEdit] = {}
+        self.coalesced_edits = 0
+        logger.info(
+            f"Telegram rate limiter initialized: global {global_rate}/s, "
+            f"chat {chat_rate}/s (burst {chat_burst}), group {group_rate_per_minute}/min (burst {group_burst})"
+        )
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        """Get bucket for chat, evicting idle buckets when too many chats are tracked"""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID - группы и каналы, для них лимит строже
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        self.chat_buckets.move_to_end(chat_id)
+
+        if len(self.chat_buckets) > self.max_tracked_chats:
+            for old_chat_id, old_bucket in list(self.chat_buckets.items()):
+                if len(self.chat_buckets) <= self.max_tracked_chats:
+                    break
+                if old_chat_id != chat_id and old_bucket.idle:
+                    del self.chat_buckets[old_chat_id]
+        return bucket
+
+    @staticmethod
+    def _get_chat_id(method: TelegramMethod) -> Optional[int]:
+        chat_id = getattr(method, "chat_id", None)
+        return chat_id if isinstance(chat_id, int) else None
+
+    @staticmethod
+    def _is_new_message(method: TelegramMethod) -> bool:
+        """Calls that post a new message and count against Telegram's message limits"""
+        name = method.__api_method__
+        return (name.startswith("send") and name != "sendChatAction") or name in ("forwardMessage", "copyMessage")
+
+    @classmethod
+    def _takes_chat_token(cls, method: TelegramMethod) -> bool:
+        """Calls that change the chat's messages: new messages, edits and deletes"""
+        name = method.__api_method__
+        return cls._is_new_message(method) or name.startswith("editMessage") or name == "deleteMessage"
+
+    async def _send(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        chat_id: Optional[int],
+        chat_token_taken: bool = False,
+    ):
+        """Take tokens and perform request, honouring flood-wait"""
+        attempt = 0
+        new_message = self._is_new_message(method)
+        chat_token = self._takes_chat_token(method)
+        while True:
+            if chat_id is not None:
+                bucket = self._chat_bucket(chat_id)
+                if chat_token_taken:
+                    # Токен уже взят в _flush_edit, пока изменение ждало своей очереди
+                    chat_token_taken = False
+                elif chat_token:
+                    await bucket.acquire()
+                else:
+                    await bucket.wait_unblocked()
+            if new_message:
+                await self.global_bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"Flood-wait retries exhausted for {type(method).__name__} in chat {chat_id}")
+                    raise
+                logger.warning(
+                    f"Flood-wait {e.retry_after}s for {type(method).__name__} in chat {chat_id} "
+                    f"(attempt {attempt}/{self.max_retries})"
+                )
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    async def _flush_edit(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        key: Tuple[int, int],
+        pending: _PendingEdit,
+    ):
+        """Wait for a chat token, then send whatever edit is the latest by now"""
+        chat_id = key[0]
+        try:
+            await self._chat_bucket(chat_id).acquire()
+        finally:
+            # Новые изменения после этого момента ждут уже следующий токен
+            self.pending_edits.pop(key, None)
+        return await self._send(make_request, bot, pending.method, chat_id, chat_token_taken=True)
+
+    async def _send_edit(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: EditMessageText,
+        chat_id: int,
+    ):
+        """Coalesce edit_text calls on the same message into the latest one"""
+        key = (chat_id, method.message_id)
+        pending = self.pending_edits.get(key)
+        if pending is None:
+            pending = _PendingEdit(method)
+            self.pending_edits[key] = pending
+            pending.task = asyncio.create_task(self._flush_edit(make_request, bot, key, pending))
+        else:
+            # Ещё не отправленное изменение заменяется новым текстом
+            pending.method = method
+            self.coalesced_edits += 1
+        # shield: отмена одного вызывающего не должна отменять отправку для остальных
+        return await asyncio.shield(pending.task)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        chat_id = self._get_chat_id(method)
+        if isinstance(method, EditMessageText) and chat_id is not None and method.message_id:
+            return await self._send_edit(make_request, bot, method, chat_id)
+        return await self._send(make_request, bot, method, chat_id)
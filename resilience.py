@@ -0,0 +1,194 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, TypeVar
+
+import requests
+
+from config import (
+    CAPTURE_RETRY_ATTEMPTS,
+    CAPTURE_RETRY_BASE_DELAY,
+    CAPTURE_RETRY_MAX_DELAY,
+    CAPTURE_RETRY_DEADLINE,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the backend while the circuit is open"""
+
+
+def is_transient(error: Exception) -> bool:
+    """Network errors, timeouts, 429 and 5xx are worth retrying; other errors are not"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds from the Retry-After header of a 429 response, None if there is none"""
+    if not isinstance(error, requests.HTTPError) or error.response is None or error.response.status_code != 429:
+        return None
+    value = error.response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        # Второй допустимый формат - HTTP-дата
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+
+    After `failure_threshold` consecutive failures calls are rejected for
+    `reset_timeout` seconds, then a single trial call decides whether to close.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        # Счётчики для метрик
+        self.successes_total = 0
+        self.failures_total = 0
+        self.rejected_total = 0
+        self.opened_total = 0
+        # Вызовы идут из потоков воркеров очереди
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit '{self.name}' {self.state} -> {state}")
+            self.state = state
+
+    def allow(self) -> bool:
+        """Check whether a call may go to the backend now"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.successes_total += 1
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures_total += 1
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened_total += 1
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self) -> None:
+        """Finish an allowed call that neither succeeded nor failed transiently"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def metrics(self) -> Dict:
+        """Snapshot of breaker state and counters"""
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {
+                "name": self.name,
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "successes_total": self.successes_total,
+                "failures_total": self.failures_total,
+                "rejected_total": self.rejected_total,
+                "opened_total": self.opened_total,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+def call_with_retry(
+    func: Callable[[float], T],
+    breaker: Optional[CircuitBreaker] = None,
+    attempts: int = CAPTURE_RETRY_ATTEMPTS,
+    base_delay: float = CAPTURE_RETRY_BASE_DELAY,
+    max_delay: float = CAPTURE_RETRY_MAX_DELAY,
+    deadline: float = CAPTURE_RETRY_DEADLINE,
+    can_retry: Optional[Callable[[], bool]] = None,
+) -> T:
+    """
+    Call `func(remaining_seconds)` in the current thread, retrying transient errors.
+
+    Each attempt gets the time left before `deadline` as its timeout. Delays use
+    exponential backoff with full jitter, or the server's Retry-After on 429, and
+    never run past the deadline. `can_retry` is asked before every retry (e.g. is
+    there quota left). Raises CircuitOpenError when the breaker rejects the call
+    and re-raises the last error when retrying is no longer possible.
+    """
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Circuit '{breaker.name}' is open")
+        try:
+            result = func(deadline - (time.monotonic() - started))
+        except Exception as e:
+            transient = is_transient(e)
+            if breaker is not None:
+                if transient:
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+            if not transient or attempt >= attempts:
+                raise
+
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            if time.monotonic() - started + delay >= deadline:
+                logger.warning(f"Retry deadline reached after {attempt} attempts: {e}")
+                raise
+            if can_retry is not None and not can_retry():
+                logger.warning(f"Not retrying after {attempt} attempts, no budget left: {e}")
+                raise
+            logger.warning(f"Transient error on attempt {attempt}/{attempts}, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
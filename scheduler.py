@@ -1,38 +1,284 @@
 import asyncio
-import aioschedule
+import heapq
+import itertools
+import json
+import os
 import pytz
-from datetime import datetime, timedelta
-from utils import take_screenshot
-from config import SHEET_URL
-from storage import ScreenshotStorage
-from typing import Optional
+import zlib
+from datetime import datetime, time, timedelta
+from functools import partial
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+from config import (
+    SHEET_URL,
+    SCHEDULE_CAPTURE_ENGINE,
+    SCHEDULE_TIMEZONE,
+    DAILY_CHECK_TIME,
+    DAILY_REPORT_TIME,
+    SCHEDULER_STATE_FILE,
+    SCHEDULER_RESTART_DELAY,
+    SCHEDULER_MAX_SLEEP,
+    CHAT_SCHEDULE_JITTER,
+    SEGMENT_PACK_TIME,
+    TIERING_TIME,
+)
+from capture_queue import capture_queue, QueueFullError, PRIORITY_SCHEDULED, PRIORITY_BACKGROUND
+from chat_schedules import ChatSchedule, chat_schedule_store
+from cron import CronExpression
+from storage import screenshot_storage
+from typing import Awaitable, Callable, Dict, List, Optional, Set
 import logging
 
 logger = logging.getLogger(__name__)
 
-screenshot_storage = ScreenshotStorage()
+MAX_CATCHUP_SCAN = 10000  # occurrences scanned per job when looking for missed runs
 
-async def take_scheduled_screenshot(label: str = None) -> None:
-    """Take a screenshot and save it with a label"""
+
+class ScheduledJob:
+    """Recurring job; subclasses define when it fires next"""
+
+    persistent = True  # keep last-run marker and replay missed runs after downtime
+
+    def __init__(self, name: str, callback: Callable[[datetime], Awaitable[None]]):
+        self.name = name
+        self.callback = callback  # async callback(fire_time)
+        self.cancelled = False
+
+    def next_after(self, moment: datetime) -> datetime:
+        """First occurrence strictly after `moment`"""
+        raise NotImplementedError
+
+
+class DailyJob(ScheduledJob):
+    """Fires every day at hour:minute in the scheduler time zone"""
+
+    def __init__(self, name: str, at: str, callback: Callable[[datetime], Awaitable[None]],
+                 tz: str = SCHEDULE_TIMEZONE):
+        super().__init__(name, callback)
+        hour, minute = at.split(":")
+        self.at = time(int(hour), int(minute))
+        self.tz = pytz.timezone(tz)
+
+    def next_after(self, moment: datetime) -> datetime:
+        day = moment.astimezone(self.tz).date()
+        while True:
+            candidate = self.tz.localize(datetime.combine(day, self.at))
+            if candidate > moment:
+                return candidate
+            day += timedelta(days=1)
+
+
+class CronJob(ScheduledJob):
+    """
+    Fires on a cron expression, shifted by a fixed jitter.
+
+    Chats tend to pick round times, so each job gets its own offset
+    to spread captures instead of starting them all at once.
+    """
+
+    persistent = False  # пропущенные запуски расписаний чатов не догоняем
+
+    def __init__(self, name: str, expression: str, callback: Callable[[datetime], Awaitable[None]],
+                 jitter: int = 0, tz: str = SCHEDULE_TIMEZONE):
+        super().__init__(name, callback)
+        self.cron = CronExpression(expression)
+        self.jitter = timedelta(seconds=jitter)
+        self.tz = pytz.timezone(tz)
+
+    def next_after(self, moment: datetime) -> datetime:
+        local = (moment - self.jitter).astimezone(self.tz).replace(tzinfo=None)
+        return self.tz.localize(self.cron.next_after(local)) + self.jitter
+
+
+class HeapScheduler:
+    """
+    Timer heap of recurring jobs.
+
+    The loop sleeps exactly until the earliest occurrence instead of polling.
+    The last occurrence of every job is persisted. If runs were missed while
+    the bot was down, only the latest is replayed on start, and its callback
+    gets the real time of the run: a capture of the sheet as it is now must not
+    be labelled with a past date.
+    """
+
+    def __init__(self, state_path: str = SCHEDULER_STATE_FILE):
+        self.state_path = state_path
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._heap: List = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running: Set[asyncio.Task] = set()
+        self._fired: Dict[str, datetime] = {}  # latest occurrence started per job
+        self._markers = self._load_markers()
+
+    def _load_markers(self) -> Dict[str, str]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("last_run", {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading scheduler state: {e}")
+            return {}
+
+    def _save_markers(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"last_run": self._markers}, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def last_run(self, name: str) -> Optional[datetime]:
+        marker = self._markers.get(name)
+        return datetime.fromisoformat(marker) if marker else None
+
+    def add_job(self, job: ScheduledJob, now: Optional[datetime] = None) -> None:
+        """Register a job (also while running) and schedule its next occurrence"""
+        old = self.jobs.get(job.name)
+        if old is not None:
+            old.cancelled = True
+        self.jobs[job.name] = job
+        fire_time = job.next_after(now or datetime.now(pytz.UTC))
+        self._push(job, fire_time)
+        logger.debug(f"Scheduled job '{job.name}', next run at {fire_time}")
+
+    def remove_job(self, name: str) -> bool:
+        job = self.jobs.pop(name, None)
+        if job is None:
+            return False
+        self._fired.pop(name, None)
+        # Запись остаётся в куче и пропускается при извлечении
+        job.cancelled = True
+        if self._markers.pop(name, None) is not None:
+            self._save_markers()
+        self._wakeup.set()
+        return True
+
+    def _push(self, job: ScheduledJob, fire_time: datetime) -> None:
+        heapq.heappush(self._heap, (fire_time, next(self._counter), job))
+        self._wakeup.set()
+
+    def latest_missed_run(self, job: ScheduledJob, now: datetime) -> Optional[datetime]:
+        """Latest occurrence after the persisted marker that is already due"""
+        marker = self.last_run(job.name)
+        if marker is None:
+            return None
+        missed = None
+        occurrence = job.next_after(marker)
+        for _ in range(MAX_CATCHUP_SCAN):
+            if occurrence > now:
+                break
+            missed = occurrence
+            occurrence = job.next_after(occurrence)
+        return missed
+
+    def catch_up(self, now: Optional[datetime] = None) -> None:
+        """Fire the latest missed occurrence at the current time; jobs without a marker just start from now"""
+        now = now or datetime.now(pytz.UTC)
+        for job in list(self.jobs.values()):
+            if not job.persistent:
+                continue
+            missed = self.latest_missed_run(job, now)
+            if missed:
+                logger.info(f"Catching up missed run of '{job.name}' due at {missed}")
+                # Снимок отражает таблицу сейчас, поэтому колбэк получает реальное время запуска
+                self._fire(job, missed, run_time=now.astimezone(missed.tzinfo))
+            if job.name not in self._markers:
+                self._markers[job.name] = now.isoformat()
+        self._save_markers()
+
+    def _fire(self, job: ScheduledJob, fire_time: datetime, run_time: Optional[datetime] = None) -> None:
+        fired = self._fired.get(job.name)
+        if fired is not None and fire_time <= fired:
+            # Уже запущено догоняющим запуском
+            return
+        self._fired[job.name] = fire_time
+        task = asyncio.create_task(self._run_job(job, fire_time, run_time or fire_time))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_job(self, job: ScheduledJob, fire_time: datetime, run_time: datetime) -> None:
+        """Run the callback with `run_time`; the marker records the occurrence `fire_time`"""
+        logger.info(f"Running job '{job.name}' for {fire_time}")
+        try:
+            await job.callback(run_time)
+        except Exception as e:
+            logger.error(f"Job '{job.name}' failed for {fire_time}: {e}", exc_info=True)
+        if job.cancelled or not job.persistent:
+            return
+        # Отметка только растёт: догоняющие запуски могут завершиться не по порядку
+        last = self.last_run(job.name)
+        if last is None or fire_time > last:
+            self._markers[job.name] = fire_time.isoformat()
+            try:
+                self._save_markers()
+            except OSError as e:
+                logger.error(f"Error saving scheduler state: {e}")
+
+    async def run(self) -> None:
+        """Sleep until the earliest occurrence, fire it and schedule the next one"""
+        self.catch_up()
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+
+            now = datetime.now(pytz.UTC)
+            if self._heap and self._heap[0][0] <= now:
+                fire_time, _, job = heapq.heappop(self._heap)
+                self._fire(job, fire_time)
+                self._push(job, job.next_after(max(fire_time, now)))
+                continue
+
+            delay = SCHEDULER_MAX_SLEEP
+            if self._heap:
+                delay = min(delay, (self._heap[0][0] - now).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+
+async def take_scheduled_screenshot(label: str = None, engine: Optional[str] = SCHEDULE_CAPTURE_ENGINE or None) -> None:
+    """Take a screenshot with the given capture engine and save it with a label"""
     try:
         if not label:
             logger.warning("No label provided for scheduled screenshot")
             return
 
         logger.info(f"Starting scheduled screenshot with label: {label}")
-        screenshot_data = take_screenshot(SHEET_URL)
+        # Плановые снимки идут вне лимита очереди и впереди интерактивных
+        job = capture_queue.submit(SHEET_URL, PRIORITY_SCHEDULED, engine)
+        screenshot_data = await job.wait()
+        if job.fallback_reason:
+            logger.error(f"Scheduled screenshot '{label}' skipped: APIFlash {job.fallback_reason}")
+            return
 
         if screenshot_data:
             # Используем system user ID и chat ID для автоматических скриншотов
             system_user_id = 0
             system_chat_id = 0
 
+            # Хэш считается вне event loop: нужно декодировать изображение
+            from image_processor import ImageProcessor
+            phash = await asyncio.to_thread(ImageProcessor.perceptual_hash, screenshot_data)
+
             logger.info(f"Saving scheduled screenshot with label: {label}")
             filepath = screenshot_storage.save_screenshot(
-                screenshot_data, 
-                label, 
-                system_user_id, 
-                system_chat_id
+                screenshot_data,
+                label,
+                system_user_id,
+                system_chat_id,
+                sha256=job.sha256,
+                phash=phash,
+                sheet_url=SHEET_URL
             )
 
             if filepath:
@@ -45,10 +291,10 @@ async def take_scheduled_screenshot(label: str = None) -> None:
     except Exception as e:
         logger.error(f"Error taking scheduled screenshot: {e}")
 
-async def check_and_take_screenshot() -> None:
-    """Check current date and take screenshot with appropriate label"""
+async def check_and_take_screenshot(now: Optional[datetime] = None) -> None:
+    """Check the date of the run and take screenshot with appropriate label"""
     try:
-        now = datetime.now(pytz.UTC)
+        now = now or datetime.now(pytz.timezone(SCHEDULE_TIMEZONE))
         logger.info(f"Running scheduled check at: {now}")
 
         # Проверяем, был ли уже сделан скриншот сегодня
@@ -81,31 +327,120 @@ async def check_and_take_screenshot() -> None:
     except Exception as e:
         logger.error(f"Error in check_and_take_screenshot: {e}")
 
-async def scheduler() -> None:
-    """Setup and run the scheduler"""
+async def take_daily_report(fire_time: datetime) -> None:
+    """Daily report labelled with the date of the run, not of the scheduler start"""
+    label = f"Ежедневный отчет {fire_time.strftime('%Y-%m-%d')}"
+    # Догоняющий запуск после простоя мог уже снять отчёт за этот день
+    if screenshot_storage.get_screenshots_by_label(label, 0, 0):
+        logger.info(f"Daily report already exists for {fire_time.strftime('%Y-%m-%d')}")
+        return
+    await take_scheduled_screenshot(label)
+
+async def run_chat_schedule(schedule: ChatSchedule, fire_time: datetime) -> None:
+    """Capture the chat's sheet, archive it under the chat and send it there"""
+    engine = schedule.engine or SCHEDULE_CAPTURE_ENGINE or None
     try:
-        logger.info("Starting scheduler...")
+        job = capture_queue.submit(schedule.sheet_url, PRIORITY_BACKGROUND, engine)
+    except QueueFullError:
+        logger.warning(f"Schedule {schedule.id} of chat {schedule.chat_id} skipped: capture queue is full")
+        return
 
-        # Планируем ежедневную проверку в полночь
-        aioschedule.every().day.at("00:01").do(check_and_take_screenshot)
-        logger.info("Scheduled daily check for 00:01")
+    screenshot_data = await job.wait()
+    if job.fallback_reason or not screenshot_data:
+        logger.error(f"Schedule {schedule.id} of chat {schedule.chat_id} got no capture: "
+                     f"{job.fallback_reason or 'capture failed'}")
+        return
 
-        # Планируем ежедневный скриншот в 23:00
-        aioschedule.every().day.at("23:00").do(
-            take_scheduled_screenshot,
-            f"Ежедневный отчет {datetime.now(pytz.UTC).strftime('%Y-%m-%d')}"
+    label = schedule.label or f"По расписанию {fire_time.strftime('%Y-%m-%d')}"
+    from image_processor import ImageProcessor
+    phash = await asyncio.to_thread(ImageProcessor.perceptual_hash, screenshot_data)
+    filepath = screenshot_storage.save_screenshot(
+        screenshot_data,
+        label,
+        schedule.user_id,
+        schedule.chat_id,
+        sha256=job.sha256,
+        phash=phash,
+        sheet_url=schedule.sheet_url
+    )
+    if not filepath:
+        logger.error(f"Failed to save capture of schedule {schedule.id}")
+
+    if chat_bot is not None:
+        photo = BufferedInputFile(screenshot_data, filename=f"schedule_{schedule.id}.png")
+        await chat_bot.send_photo(
+            schedule.chat_id,
+            photo,
+            caption=f"🕒 {label}\nРасписание: {schedule.cron}"
         )
-        logger.info("Scheduled daily screenshot for 23:00")
 
-        logger.info("Scheduler started successfully")
+async def pack_archive(fire_time: datetime) -> None:
+    """Pack closed months of the archive into segment files"""
+    async with archive_maintenance_lock:
+        await _pack_archive()
 
-        while True:
-            await aioschedule.run_pending()
-            await asyncio.sleep(60)
+async def _pack_archive() -> None:
+    # Файлы пишутся в потоке, метаданные меняются только в event loop
+    total = 0
+    for segment, records in screenshot_storage.closed_month_batches():
+        rewrite, member_of = await asyncio.to_thread(screenshot_storage.write_month_segment, segment, records)
+        packed = screenshot_storage.apply_segment_rewrite(rewrite, member_of)
+        await asyncio.to_thread(screenshot_storage.remove_packed_files, packed)
+        if rewrite.base:
+            await asyncio.to_thread(screenshot_storage.remove_segment, rewrite.base)
+        total += len(packed)
+    if total:
+        logger.info(f"Packed {total} screenshots of closed months")
 
-    except Exception as e:
-        logger.error(f"Error in scheduler: {e}")
-        # Пытаемся перезапустить scheduler после ошибки
-        logger.info("Attempting to restart scheduler in 60 seconds...")
-        await asyncio.sleep(60)
-        await scheduler()
\ No newline at end of file
+async def tier_archive(fire_time: datetime) -> None:
+    """Recompress cold screenshots to save disk space"""
+    # Pillow и пул процессов нужны только этой ежедневной задаче
+    from tiering import run_tiering
+    async with archive_maintenance_lock:
+        await run_tiering(screenshot_storage)
+
+def schedule_chat_job(schedule: ChatSchedule) -> None:
+    """Add (or replace) the heap job of a chat schedule"""
+    jitter = zlib.crc32(schedule.job_name.encode()) % (CHAT_SCHEDULE_JITTER + 1)
+    job_scheduler.add_job(CronJob(schedule.job_name, schedule.cron, partial(run_chat_schedule, schedule), jitter))
+
+def unschedule_chat_job(schedule: ChatSchedule) -> None:
+    job_scheduler.remove_job(schedule.job_name)
+
+def load_chat_schedules(bot: Bot) -> None:
+    """Register stored chat schedules; captures are sent to chats through `bot`"""
+    global chat_bot
+    chat_bot = bot
+    schedules = chat_schedule_store.all()
+    for schedule in schedules:
+        try:
+            schedule_chat_job(schedule)
+        except ValueError as e:
+            logger.error(f"Skipping schedule {schedule.id} of chat {schedule.chat_id}: {e}")
+    logger.info(f"Registered {len(schedules)} chat schedules")
+
+chat_bot: Optional[Bot] = None
+# Упаковка и tiering переписывают одни и те же сегменты
+archive_maintenance_lock = asyncio.Lock()
+job_scheduler = HeapScheduler()
+job_scheduler.add_job(DailyJob("daily_check", DAILY_CHECK_TIME, check_and_take_screenshot))
+job_scheduler.add_job(DailyJob("daily_report", DAILY_REPORT_TIME, take_daily_report))
+job_scheduler.add_job(DailyJob("pack_archive", SEGMENT_PACK_TIME, pack_archive))
+job_scheduler.add_job(DailyJob("tier_archive", TIERING_TIME, tier_archive))
+
+async def scheduler() -> None:
+    """Run the job scheduler, restarting the loop after unexpected errors"""
+    logger.info(f"Starting scheduler: daily check at {DAILY_CHECK_TIME}, "
+                f"daily screenshot at {DAILY_REPORT_TIME} ({SCHEDULE_TIMEZONE})")
+    try:
+        while True:
+            try:
+                await job_scheduler.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in scheduler: {e}", exc_info=True)
+                logger.info(f"Restarting scheduler in {SCHEDULER_RESTART_DELAY} seconds...")
+                await asyncio.sleep(SCHEDULER_RESTART_DELAY)
+    finally:
+        await job_scheduler.stop()
@@ -0,0 +1,171 @@
+"""
+Segment files: one uncompressed ZIP per user, chat and closed month.
+
+A rewrite (packing more files, replacing members) produces the next
+generation, 2025-01.zip -> 2025-01.1.zip, and the old one is removed once
+the metadata points at the new file.
+
+PNG and WebP data is already compressed, so members are stored as is
+(ZIP_STORED) and each screenshot is a contiguous byte range. The archive
+metadata keeps (offset, size) of every member, so reads are a slice of the
+memory-mapped segment; the ZIP central directory is the index on disk and
+can rebuild offsets with read_index().
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from config import SEGMENT_READER_CACHE
+from metrics import cache_requests
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".zip"
+LOCAL_HEADER = struct.Struct("<4s22xHH")  # signature, name length, extra length
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+Offsets = Dict[str, Tuple[int, int]]  # member name -> (data offset, size)
+
+
+def _data_offsets(path: str) -> Offsets:
+    """Offsets of member data, read from the central directory and local headers"""
+    offsets: Offsets = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Segment member {info.filename} is compressed")
+            f.seek(info.header_offset)
+            signature, name_length, extra_length = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+            if signature != LOCAL_HEADER_SIGNATURE:
+                raise ValueError(f"Bad local header for {info.filename} in {path}")
+            offsets[info.filename] = (info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                                      info.file_size)
+    return offsets
+
+
+def read_index(path: str) -> Offsets:
+    """Rebuild the offset index of an existing segment"""
+    return _data_offsets(path)
+
+
+class SegmentRewrite:
+    """Result of writing a segment generation: where every member ended up"""
+
+    def __init__(self, path: str, base: Optional[str], offsets: Offsets, base_names: Dict[int, str],
+                 renamed: Dict[str, str]):
+        self.path = path  # new segment file
+        self.base = base  # previous generation or None
+        self.offsets = offsets  # member name -> (offset, size) in the new segment
+        self.base_names = base_names  # data offset in the previous generation -> member name
+        self.renamed = renamed  # replaced member name -> its new name
+
+    def locate(self, base_offset: int) -> Tuple[int, int]:
+        """New (offset, size) of the member found at `base_offset` in the previous generation"""
+        name = self.base_names[base_offset]
+        return self.offsets[self.renamed.get(name, name)]
+
+
+def next_generation(path: str) -> str:
+    """'2025-01.zip' -> '2025-01.1.zip' -> '2025-01.2.zip'"""
+    stem = path[:-len(SEGMENT_SUFFIX)]
+    root, _, generation = stem.rpartition(".")
+    if root and generation.isdigit():
+        return f"{root}.{int(generation) + 1}{SEGMENT_SUFFIX}"
+    return f"{stem}.1{SEGMENT_SUFFIX}"
+
+
+def write_segment(path: str, members: Iterable[Tuple[str, str]] = (), base: Optional[str] = None,
+                  replace: Optional[Dict[str, Tuple[str, bytes]]] = None) -> SegmentRewrite:
+    """
+    Write a segment generation at `path`.
+
+    Members of `base` are carried over, `replace` maps a base member name to
+    (new name, data), and `members` adds (name, source file) pairs. Segments
+    are never rewritten in place: records keep reading the old generation
+    until they are switched to the new one, then the base can be removed.
+    """
+    replace = replace or {}
+    base_names: Dict[int, str] = {}
+    renamed: Dict[str, str] = {}
+    tmp_path = f"{path}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        written = set()
+        if base:
+            base_names = {offset: name for name, (offset, _) in _data_offsets(base).items()}
+            with zipfile.ZipFile(base) as old:
+                for info in old.infolist():
+                    if info.filename in replace:
+                        new_name, data = replace[info.filename]
+                        archive.writestr(new_name, data)
+                        renamed[info.filename] = new_name
+                        written.add(new_name)
+                        continue
+                    with old.open(info) as source, archive.open(info.filename, "w", force_zip64=True) as target:
+                        while chunk := source.read(1024 * 1024):
+                            target.write(chunk)
+                    written.add(info.filename)
+        for name, source_path in members:
+            if name in written:
+                continue
+            archive.write(source_path, name)
+            written.add(name)
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return SegmentRewrite(path, base, _data_offsets(path), base_names, renamed)
+
+
+class SegmentReader:
+    """Keeps a few segments memory-mapped and serves byte ranges from them"""
+
+    def __init__(self, max_open: int = SEGMENT_READER_CACHE):
+        self.max_open = max_open
+        self._maps: "OrderedDict[str, Tuple[int, mmap.mmap]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _map(self, path: str) -> mmap.mmap:
+        # Inode меняется, когда сегмент перепаковали: старое отображение выбрасываем
+        inode = os.stat(path).st_ino
+        cached = self._maps.get(path)
+        if cached and cached[0] == inode:
+            self._maps.move_to_end(path)
+            cache_requests.inc(cache="segment_map", result="hit")
+            return cached[1]
+        cache_requests.inc(cache="segment_map", result="miss" if cached is None else "stale")
+        if cached:
+            cached[1].close()
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = (inode, mapped)
+        while len(self._maps) > self.max_open:
+            _, (_, oldest) = self._maps.popitem(last=False)
+            oldest.close()
+        return mapped
+
+    def read(self, path: str, offset: int, size: int) -> bytes:
+        with self._lock:
+            mapped = self._map(path)
+            if offset + size > len(mapped):
+                raise ValueError(f"Range {offset}+{size} is outside segment {path}")
+            return mapped[offset:offset + size]
+
+    def forget(self, path: str) -> None:
+        """Drop the mapping of a segment that is about to be deleted"""
+        with self._lock:
+            cached = self._maps.pop(path, None)
+            if cached:
+                cached[1].close()
+
+    def close(self) -> None:
+        with self._lock:
+            for _, mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+
+segment_reader = SegmentReader()
@@ -0,0 +1,245 @@
+"""
+Local capture engine: downloads the sheet export (CSV or XLSX) and draws it as a table.
+
+    python sheet_renderer.py export.csv out.png
+"""
+import csv
+import io
+import logging
+import re
+import sys
+import zipfile
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from xml.etree import ElementTree
+
+import requests
+from PIL import Image, ImageDraw, ImageFont
+
+from capture_providers import CaptureProvider, CaptureResult, attempt_timeout, read_stream
+from config import (
+    CAPTURE_CONNECT_TIMEOUT,
+    CAPTURE_READ_TIMEOUT,
+    LOCAL_RENDER_EXPORT_FORMAT,
+    LOCAL_RENDER_SOURCE,
+    LOCAL_RENDER_FONT,
+    LOCAL_RENDER_BOLD_FONT,
+    LOCAL_RENDER_FONT_SIZE,
+    LOCAL_RENDER_MAX_ROWS,
+    LOCAL_RENDER_MAX_COLUMNS,
+    LOCAL_RENDER_MAX_COLUMN_WIDTH,
+)
+
+logger = logging.getLogger(__name__)
+
+XLSX_NS = {"x": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+FONT_DIRS = ["", "/usr/share/fonts/truetype/dejavu/"]
+
+CELL_PADDING = 8
+HEADER_COLOR = (232, 240, 254)
+GRID_COLOR = (218, 220, 224)
+TEXT_COLOR = (32, 33, 36)
+
+
+def export_url(sheet_url: str, export_format: str = LOCAL_RENDER_EXPORT_FORMAT) -> str:
+    """Build Google Sheets export URL from a regular sheet URL"""
+    sheet_id = sheet_url.split('/d/')[1].split('/')[0]
+    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format={export_format}"
+    gid = re.search(r"gid=(\d+)", sheet_url)
+    if gid and export_format == "csv":
+        url += f"&gid={gid.group(1)}"
+    return url
+
+
+def parse_csv(data: bytes) -> List[List[str]]:
+    text = data.decode("utf-8-sig", errors="replace")
+    return [row for row in csv.reader(io.StringIO(text))]
+
+
+def _column_index(cell_ref: str) -> int:
+    """'C12' -> 2"""
+    index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord("A") + 1
+    return index - 1
+
+
+def parse_xlsx(data: bytes) -> List[List[str]]:
+    """Read cell values of the first worksheet (formatting and formulas are ignored)"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        shared_strings = []
+        if "xl/sharedStrings.xml" in archive.namelist():
+            root = ElementTree.fromstring(archive.read("xl/sharedStrings.xml"))
+            for item in root.findall("x:si", XLSX_NS):
+                shared_strings.append("".join(t.text or "" for t in item.iter(f"{{{XLSX_NS['x']}}}t")))
+
+        sheets = sorted(name for name in archive.namelist() if re.match(r"xl/worksheets/sheet\d+\.xml$", name))
+        if not sheets:
+            raise ValueError("XLSX export has no worksheets")
+        root = ElementTree.fromstring(archive.read(sheets[0]))
+
+    rows: List[List[str]] = []
+    for row in root.iter(f"{{{XLSX_NS['x']}}}row"):
+        values: List[str] = []
+        for cell in row.findall("x:c", XLSX_NS):
+            cell_type = cell.get("t")
+            if cell_type == "inlineStr":
+                value = "".join(t.text or "" for t in cell.iter(f"{{{XLSX_NS['x']}}}t"))
+            else:
+                raw = cell.find("x:v", XLSX_NS)
+                value = raw.text if raw is not None and raw.text is not None else ""
+                if cell_type == "s" and value:
+                    value = shared_strings[int(value)]
+            column = _column_index(cell.get("r", "")) if cell.get("r") else len(values)
+            values.extend([""] * (column - len(values) + 1))
+            values[column] = value
+        rows.append(values)
+    return rows
+
+
+@lru_cache(maxsize=8)
+def get_font(name: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load font once per name and size"""
+    for directory in FONT_DIRS:
+        try:
+            return ImageFont.truetype(directory + name, size)
+        except OSError:
+            continue
+    logger.warning(f"Font {name} not found, falling back to the default font")
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=4096)
+def _glyph(font_name: str, size: int, char: str) -> Tuple[Optional[Image.Image], int, int, float]:
+    """Rendered glyph mask with its offset and advance; tables reuse a small set of characters"""
+    font = get_font(font_name, size)
+    left, top, right, bottom = font.getbbox(char)
+    advance = font.getlength(char)
+    if right <= left or bottom <= top:
+        return None, 0, 0, advance
+    mask = Image.new("L", (right - left, bottom - top), 0)
+    ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+    return mask, left, top, advance
+
+
+def _text_width(text: str, font_name: str, size: int) -> float:
+    return sum(_glyph(font_name, size, char)[3] for char in text)
+
+
+def _draw_text(image: Image.Image, x: float, y: int, text: str, font_name: str, size: int) -> None:
+    # Вставка закэшированных глифов в разы быстрее, чем draw.text на каждую ячейку
+    for char in text:
+        mask, left, top, advance = _glyph(font_name, size, char)
+        if mask is not None:
+            image.paste(TEXT_COLOR, (int(x) + left, y + top), mask)
+        x += advance
+
+
+def _fit_text(text: str, font_name: str, size: int, max_width: int) -> str:
+    if _text_width(text, font_name, size) <= max_width:
+        return text
+    while text and _text_width(text + "…", font_name, size) > max_width:
+        text = text[:-1]
+    return text + "…"
+
+
+def render_table(rows: List[List[str]], font_size: int = LOCAL_RENDER_FONT_SIZE,
+                 max_rows: int = LOCAL_RENDER_MAX_ROWS, max_columns: int = LOCAL_RENDER_MAX_COLUMNS,
+                 max_column_width: int = LOCAL_RENDER_MAX_COLUMN_WIDTH) -> bytes:
+    """Draw rows as a grid PNG; the first row is the header, columns fit their content"""
+    rows = [row[:max_columns] for row in rows[:max_rows]]
+    # Пустые хвосты строк и столбцов не рисуем
+    while rows and not any(cell.strip() for cell in rows[-1]):
+        rows.pop()
+    column_count = max((len(row) for row in rows), default=0)
+    while column_count and not any(len(row) >= column_count and row[column_count - 1].strip() for row in rows):
+        column_count -= 1
+    if not rows or not column_count:
+        rows, column_count = [["Таблица пуста"]], 1
+
+    widths = [0] * column_count
+    for row_index, row in enumerate(rows):
+        font_name = LOCAL_RENDER_BOLD_FONT if row_index == 0 else LOCAL_RENDER_FONT
+        for column, text in enumerate(row[:column_count]):
+            widths[column] = max(widths[column], int(_text_width(text, font_name, font_size)))
+    widths = [min(width, max_column_width) + 2 * CELL_PADDING for width in widths]
+
+    ascent, descent = get_font(LOCAL_RENDER_FONT, font_size).getmetrics()
+    row_height = ascent + descent + CELL_PADDING
+    width = sum(widths) + 1
+    height = row_height * len(rows) + 1
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, width, row_height], fill=HEADER_COLOR)
+
+    y = 0
+    for row_index, row in enumerate(rows):
+        font_name = LOCAL_RENDER_BOLD_FONT if row_index == 0 else LOCAL_RENDER_FONT
+        x = 0
+        for column in range(column_count):
+            text = row[column] if column < len(row) else ""
+            if text:
+                fitted = _fit_text(text, font_name, font_size, widths[column] - 2 * CELL_PADDING)
+                _draw_text(image, x + CELL_PADDING, y + CELL_PADDING // 2, fitted, font_name, font_size)
+            x += widths[column]
+        y += row_height
+
+    x = 0
+    for column_width in widths:
+        draw.line([(x, 0), (x, height)], fill=GRID_COLOR)
+        x += column_width
+    draw.line([(x - 1, 0), (x - 1, height)], fill=GRID_COLOR)
+    for y in range(0, height, row_height):
+        draw.line([(0, y), (width, y)], fill=GRID_COLOR)
+
+    buffer = io.BytesIO()
+    # Быстрое сжатие: кодирование PNG иначе занимает больше, чем сама отрисовка
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def parse_export(data: bytes, export_format: str) -> List[List[str]]:
+    if export_format == "xlsx":
+        return parse_xlsx(data)
+    if export_format == "csv":
+        return parse_csv(data)
+    raise ValueError(f"Unknown export format: {export_format}")
+
+
+class LocalSheetProvider(CaptureProvider):
+    """Renders the sheet export locally: no APIFlash call and no quota"""
+
+    name = "local"
+    counts_quota = False
+
+    def __init__(self, export_format: str = LOCAL_RENDER_EXPORT_FORMAT, source: Optional[str] = LOCAL_RENDER_SOURCE):
+        self.export_format = export_format
+        self.source = source or None
+        self.timeout = (CAPTURE_CONNECT_TIMEOUT, CAPTURE_READ_TIMEOUT)
+
+    def _download(self, url: str, timeout: Optional[float] = None) -> bytes:
+        if self.source:
+            with open(self.source, "rb") as f:
+                return f.read()
+        with requests.get(export_url(url, self.export_format), timeout=attempt_timeout(self.timeout, timeout),
+                          stream=True) as response:
+            response.raise_for_status()
+            return read_stream(response).data
+
+    def capture(self, url: str, timeout: Optional[float] = None) -> CaptureResult:
+        rows = parse_export(self._download(url, timeout), self.export_format)
+        logger.info(f"Rendering {len(rows)} rows from {self.export_format} export")
+        return CaptureResult.from_bytes(render_table(rows))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python sheet_renderer.py <export.csv|export.xlsx> <output.png>")
+        sys.exit(1)
+    source_path, output_path = sys.argv[1], sys.argv[2]
+    provider = LocalSheetProvider(export_format=source_path.rsplit(".", 1)[-1].lower(), source=source_path)
+    with open(output_path, "wb") as output:
+        output.write(provider.capture("").data)
@@ -0,0 +1,88 @@
+import logging
+from typing import Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K")
+V = TypeVar("V", bound=Hashable)
+
+
+class _Node(Generic[K, V]):
+    __slots__ = ("key", "values", "children")
+
+    def __init__(self, key: K, value: V):
+        self.key = key
+        self.values: List[V] = [value]
+        self.children: Dict[int, "_Node[K, V]"] = {}
+
+
+class BKTree(Generic[K, V]):
+    """
+    Burkhard-Keller tree for a metric `distance` (Hamming distance for image hashes).
+
+    Range queries only visit children whose edge distance lies within
+    [d - radius, d + radius], so most of the tree is skipped for small radii.
+    """
+
+    def __init__(self, distance: Callable[[K, K], int]):
+        self.distance = distance
+        self.root: Optional[_Node[K, V]] = None
+        self.size = 0
+
+    def add(self, key: K, value: V) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = _Node(key, value)
+            return
+        node = self.root
+        while True:
+            d = self.distance(key, node.key)
+            if d == 0:
+                node.values.append(value)
+                return
+            child = node.children.get(d)
+            if child is None:
+                node.children[d] = _Node(key, value)
+                return
+            node = child
+
+    def remove(self, key: K, value: V) -> bool:
+        """Remove one value stored under `key`; an emptied node stays in the tree as a routing node"""
+        node = self.root
+        while node is not None:
+            d = self.distance(key, node.key)
+            if d == 0:
+                if value not in node.values:
+                    return False
+                node.values.remove(value)
+                self.size -= 1
+                return True
+            node = node.children.get(d)
+        return False
+
+    def search(self, key: K, radius: int) -> List[Tuple[int, V]]:
+        """All values within `radius` of `key`, nearest first"""
+        if self.root is None:
+            return []
+        found: List[Tuple[int, V]] = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(key, node.key)
+            if d <= radius:
+                found.extend((d, value) for value in node.values)
+            for edge, child in node.children.items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, key: K, count: int, max_radius: int = 64,
+                accept: Optional[Callable[[V], bool]] = None) -> List[Tuple[int, V]]:
+        """Up to `count` accepted values closest to `key`, widening the radius as needed"""
+        radius = 2
+        while True:
+            found = [item for item in self.search(key, radius) if accept is None or accept(item[1])]
+            if len(found) >= count or radius >= max_radius:
+                return found[:count]
+            radius = min(max_radius, radius * 2)
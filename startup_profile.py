@@ -0,0 +1,114 @@
+"""
+Start-up profile of the bot: import time per module and init time per step.
+
+    python bot.py --profile-startup
+
+Imports are measured in a fresh interpreter with CPython's -X importtime,
+so every module is loaded cold exactly as on a deploy restart. Init steps
+are the ones main() runs before it starts serving updates, timed in this
+process without connecting to Telegram, plus the first use of the archive
+that now happens in the background.
+"""
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_PACKAGES = 10  # third-party packages shown in the report
+
+
+class ImportTiming:
+    """One line of -X importtime: own and cumulative microseconds, nesting depth"""
+
+    def __init__(self, name: str, self_us: int, total_us: int, depth: int):
+        self.name = name
+        self.self_us = self_us
+        self.total_us = total_us
+        self.depth = depth
+
+    @property
+    def is_project(self) -> bool:
+        return "." not in self.name and os.path.exists(os.path.join(PROJECT_DIR, f"{self.name}.py"))
+
+
+def parse_importtime(output: str) -> List[ImportTiming]:
+    """'import time:      1091 |    3343329 |   aiogram' lines -> timings; other lines are skipped"""
+    timings = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            self_us, total_us, name = line[len("import time:"):].split("|")
+            depth = (len(name) - len(name.lstrip())) // 2
+            timings.append(ImportTiming(name.strip(), int(self_us), int(total_us), depth))
+        except ValueError:
+            continue  # заголовок таблицы
+    return timings
+
+
+def profile_imports(module: str = "application") -> Tuple[List[ImportTiming], float]:
+    """Import `module` in a new interpreter; returns its import timings and wall time in seconds"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.getcwd(),
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [PROJECT_DIR, os.getenv("PYTHONPATH")]))},
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr), elapsed
+
+
+class StartupTimer:
+    """Collects named init steps"""
+
+    def __init__(self):
+        self.steps: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started))
+
+
+def format_report(timings: List[ImportTiming], import_wall: float, timer: StartupTimer,
+                  background: Optional[Tuple[str, float]] = None, module: str = "application") -> str:
+    lines = [f"Imports (cold interpreter, {import_wall:.2f}s wall including interpreter start)"]
+    total = next((t.total_us for t in timings if t.name == module and t.depth == 0), 0)
+    lines.append(f"  {'module':<28}{'self ms':>10}{'total ms':>10}")
+    project = sorted((t for t in timings if t.is_project), key=lambda t: t.total_us, reverse=True)
+    for timing in project:
+        lines.append(f"  {timing.name:<28}{timing.self_us / 1000:>10.1f}{timing.total_us / 1000:>10.1f}")
+
+    # Сторонние пакеты: время с вложенными импортами, первый импорт пакета
+    packages = {}
+    for timing in timings:
+        root = timing.name.split(".")[0]
+        if not timing.is_project and root == timing.name and root not in packages:
+            packages[root] = timing
+    lines.append(f"  {'third-party packages':<28}")
+    for timing in sorted(packages.values(), key=lambda t: t.total_us, reverse=True)[:TOP_PACKAGES]:
+        lines.append(f"  {timing.name:<28}{timing.self_us / 1000:>10.1f}{timing.total_us / 1000:>10.1f}")
+    lines.append(f"  import {module} total: {total / 1000:.1f} ms")
+
+    lines.append("")
+    lines.append("Init before serving updates")
+    init_total = 0.0
+    for name, seconds in timer.steps:
+        init_total += seconds
+        lines.append(f"  {name:<38}{seconds * 1000:>10.1f} ms")
+    lines.append(f"  {'total':<38}{init_total * 1000:>10.1f} ms")
+    lines.append(f"Time to serving updates: {(total / 1e6 + init_total):.2f}s")
+    if background:
+        name, seconds = background
+        lines.append(f"In the background after start: {name} {seconds * 1000:.1f} ms")
+    return "\n".join(lines)
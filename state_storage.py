@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from config import FSM_STORAGE, FSM_SQLITE_PATH, FSM_STATE_TTL, REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+def _key_string(key: StorageKey) -> str:
+    """Serialize storage key the same way for every backend"""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+class TTLMemoryStorage(BaseStorage):
+    """In-process FSM storage where every key expires `ttl` seconds after its last write"""
+
+    def __init__(self, ttl: int = FSM_STATE_TTL):
+        self.ttl = ttl
+        self.records: Dict[str, Tuple[Optional[str], Dict[str, Any], float]] = {}
+        self.expiry_heap: List[Tuple[float, str]] = []
+
+    def _prune(self) -> None:
+        """Drop expired records; heap entries of rewritten keys are skipped"""
+        now = time.time()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.expiry_heap)
+            record = self.records.get(key)
+            if record and record[2] <= now:
+                del self.records[key]
+
+    def _get(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        self._prune()
+        record = self.records.get(_key_string(key))
+        if record is None:
+            return None, {}
+        return record[0], record[1]
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        key_string = _key_string(key)
+        if state is None and not data:
+            self.records.pop(key_string, None)
+            return
+        expires_at = time.time() + self.ttl
+        self.records[key_string] = (state, data, expires_at)
+        heapq.heappush(self.expiry_heap, (expires_at, key_string))
+        self._prune()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = self._get(key)
+        self._put(key, _state_name(state), data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._get(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = self._get(key)
+        self._put(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._get(key)[1].copy()
+
+    async def close(self) -> None:
+        pass
+
+
+_UNCHANGED = object()  # column that SQLiteStorage._update keeps as it is
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite file.
+
+    WAL mode lets several bot workers on one host share the file.
+    Records expire `ttl` seconds after the last write.
+    """
+
+    def __init__(self, path: str = FSM_SQLITE_PATH, ttl: int = FSM_STATE_TTL):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS fsm_expires_at ON fsm (expires_at)")
+        self._conn.commit()
+        logger.info(f"SQLite FSM storage opened: {path}")
+
+    def _select(self, key: str, now: float) -> Tuple[Optional[str], Dict[str, Any]]:
+        row = self._conn.execute(
+            "SELECT state, data FROM fsm WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def _read(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        with self._lock:
+            return self._select(key, time.time())
+
+    def _update(self, key: str, state: Any = _UNCHANGED, data: Any = _UNCHANGED) -> None:
+        """Replace state and/or data of `key` in one transaction, keeping the other column"""
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE берёт блокировку записи сразу: другой процесс не вклинится между чтением и записью
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                current_state, current_data = self._select(key, now)
+                state = current_state if state is _UNCHANGED else state
+                data = current_data if data is _UNCHANGED else data
+                if state is None and not data:
+                    self._conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                        (key, state, json.dumps(data, ensure_ascii=False), now + self.ttl),
+                    )
+                self._conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await asyncio.to_thread(self._update, _key_string(key), state=_state_name(state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await asyncio.to_thread(self._read, _key_string(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._update, _key_string(key), data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await asyncio.to_thread(self._read, _key_string(key))
+        return data
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _create_redis_storage(url: str, ttl: int) -> BaseStorage:
+    """Redis storage from aiogram; fakeredis:// gives an in-process stand-in"""
+    try:
+        from aiogram.fsm.storage.redis import RedisStorage
+    except ImportError:
+        raise RuntimeError("FSM_STORAGE=redis requires the 'redis' package")
+
+    if url.startswith("fakeredis://"):
+        try:
+            from fakeredis import aioredis as fake_aioredis
+        except ImportError:
+            raise RuntimeError("REDIS_URL=fakeredis:// requires the 'fakeredis' package")
+        return RedisStorage(redis=fake_aioredis.FakeRedis(), state_ttl=ttl, data_ttl=ttl)
+
+    return RedisStorage.from_url(url, state_ttl=ttl, data_ttl=ttl)
+
+
+def create_fsm_storage(backend: str = FSM_STORAGE) -> BaseStorage:
+    """Create FSM storage for the dispatcher: memory, sqlite or redis"""
+    logger.info(f"Creating FSM storage: {backend}")
+    if backend == "memory":
+        return TTLMemoryStorage(FSM_STATE_TTL)
+    if backend == "sqlite":
+        return SQLiteStorage(FSM_SQLITE_PATH, FSM_STATE_TTL)
+    if backend == "redis":
+        return _create_redis_storage(REDIS_URL, FSM_STATE_TTL)
+    raise ValueError(f"Unknown FSM storage backend: {backend}")
@@ -1,9 +1,20 @@
+import io
 import os
+import re
 import json
+import shutil
+import threading
+import time
 from datetime import datetime
 import pytz
 import logging
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple, BinaryIO
+
+from config import PHASH_DUPLICATE_THRESHOLD, SHEET_URL
+from similarity_index import BKTree
+from segments import SEGMENT_SUFFIX, SegmentRewrite, next_generation, segment_reader, write_segment
+from metrics import storage_seconds, timed
+from logging_setup import debug_sampled
 
 logger = logging.getLogger(__name__)
 
@@ -11,8 +22,38 @@ class ScreenshotStorage:
     def __init__(self):
         self.storage_dir = "screenshots"
         self.metadata_file = os.path.join(self.storage_dir, "metadata.json")
-        self._ensure_storage_exists()
-        self.metadata = self._load_metadata()
+        # Метаданные читаются при первом обращении, а не при импорте: старт бота не ждёт разбора большого архива
+        self._metadata: Optional[Dict] = None
+        self._open_lock = threading.Lock()
+        # BK-дерево по perceptual hash строится при первом поиске похожих
+        self._phash_index: Optional[BKTree[int, str]] = None
+        self._phash_records: Dict[str, Dict] = {}
+
+    @property
+    def metadata(self) -> Dict:
+        if self._metadata is None:
+            self.open()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value: Dict) -> None:
+        self._metadata = value
+
+    @property
+    def is_open(self) -> bool:
+        return self._metadata is not None
+
+    def open(self) -> None:
+        """Create the storage directory and load metadata once; call from a thread to warm up off the event loop"""
+        with self._open_lock:
+            if self._metadata is not None:
+                return
+            started = time.perf_counter()
+            self._ensure_storage_exists()
+            metadata = self._load_metadata()
+            logger.info(f"Loaded metadata of {sum(len(entries) for entries in metadata.values())} screenshots "
+                        f"in {time.perf_counter() - started:.2f}s")
+            self._metadata = metadata
 
     def _ensure_storage_exists(self):
         """Create storage directory if it doesn't exist"""
@@ -31,25 +72,76 @@ class ScreenshotStorage:
                 return {}
         return {}
 
+    @timed(storage_seconds, operation="save_metadata")
     def _save_metadata(self):
-        """Save metadata to file"""
+        """Save metadata to file atomically: readers never see a half-written file"""
+        tmp_path = f"{self.metadata_file}.tmp"
         try:
-            with open(self.metadata_file, 'w') as f:
+            with open(tmp_path, 'w') as f:
                 json.dump(self.metadata, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.metadata_file)
         except Exception as e:
             logger.error(f"Error saving metadata: {e}")
 
-    def _get_user_dir(self, user_id: int, chat_id: int) -> str:
-        """Get directory for specific user and chat"""
+    def _get_user_dir(self, user_id: int, chat_id: int, month: Optional[str] = None) -> str:
+        """Get directory for specific user and chat, optionally the YYYY-MM partition inside it"""
         dir_path = os.path.join(self.storage_dir, f"user_{user_id}", f"chat_{chat_id}")
+        if month:
+            dir_path = os.path.join(dir_path, month)
         os.makedirs(dir_path, exist_ok=True)
         return dir_path
 
+    @staticmethod
+    def _month_of(info: Dict) -> str:
+        """'20250131_235900' -> '2025-01'"""
+        return f"{info['timestamp'][:4]}-{info['timestamp'][4:6]}"
+
+    @staticmethod
+    def data_path(info: Dict) -> str:
+        """Loose file with the screenshot data; differs from 'filepath' after tiering"""
+        return info.get("data_path") or info["filepath"]
+
+    def screenshot_exists(self, info: Dict) -> bool:
+        """Check that the screenshot data is available (loose file or segment)"""
+        if info.get("segment"):
+            return os.path.exists(info["segment"])
+        return os.path.exists(self.data_path(info))
+
+    @timed(storage_seconds, operation="read")
+    def read_screenshot(self, info: Dict) -> Optional[bytes]:
+        """Get screenshot bytes from its file or from the packed segment"""
+        try:
+            if info.get("segment"):
+                return segment_reader.read(info["segment"], info["offset"], info["size"])
+            with open(self.data_path(info), 'rb') as f:
+                return f.read()
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading screenshot {info['filepath']}: {e}")
+            return None
+
+    def open_screenshot(self, info: Dict) -> BinaryIO:
+        """Binary file object with the screenshot (e.g. for PIL); raises if it is missing"""
+        if info.get("segment"):
+            return io.BytesIO(segment_reader.read(info["segment"], info["offset"], info["size"]))
+        return open(self.data_path(info), 'rb')
+
+    def same_file(self, first: Dict, second: Dict) -> bool:
+        """Check that two records point to the same stored data (hard link or segment member)"""
+        if first.get("segment") or second.get("segment"):
+            return (first.get("segment"), first.get("offset")) == (second.get("segment"), second.get("offset"))
+        try:
+            return os.path.samefile(self.data_path(first), self.data_path(second))
+        except OSError:
+            return False
+
     def _has_access(self, user_id: int, chat_id: int, screenshot_info: Dict) -> bool:
         """Check if user has access to the screenshot"""
         # Отключаем проверку прав доступа
         return True
 
+    @timed(storage_seconds, operation="delete")
     def delete_screenshot(self, filename: str, user_id: int, chat_id: int) -> bool:
         """Delete screenshot and its metadata for specific user and chat"""
         try:
@@ -57,7 +149,6 @@ class ScreenshotStorage:
             system_key = "user_0_chat_0"  # Системные скриншоты
 
             logger.info(f"[DELETE] Starting deletion process for file {filename}")
-            logger.info(f"[DELETE] Current metadata keys: {list(self.metadata.keys())}")
 
             # Remove 'category_' prefix if it exists
             if filename.startswith('category_'):
@@ -72,7 +163,7 @@ class ScreenshotStorage:
             if user_key in self.metadata:
                 for info in self.metadata[user_key]:
                     current_filename = os.path.basename(info["filepath"])
-                    logger.info(f"[DELETE] Comparing {current_filename} with {filename}")
+                    debug_sampled(logger, "[DELETE] Comparing %s with %s", current_filename, filename)
                     if current_filename == filename:
                         screenshot_info = info
                         logger.info(f"[DELETE] Found screenshot in user storage: {filename}")
@@ -82,7 +173,7 @@ class ScreenshotStorage:
             if not screenshot_info and system_key in self.metadata:
                 for info in self.metadata[system_key]:
                     current_filename = os.path.basename(info["filepath"])
-                    logger.info(f"[DELETE] Comparing {current_filename} with {filename} in system storage")
+                    debug_sampled(logger, "[DELETE] Comparing %s with %s in system storage", current_filename, filename)
                     if current_filename == filename:
                         screenshot_info = info
                         is_system = True
@@ -90,8 +181,20 @@ class ScreenshotStorage:
                         break
 
             if screenshot_info:
-                filepath = screenshot_info["filepath"]
-                logger.info(f"[DELETE] Found screenshot info: {screenshot_info}")
+                filepath = self.data_path(screenshot_info)
+                logger.debug("[DELETE] Found screenshot info: %s", screenshot_info)
+
+                # Запакованный снимок: удаляем запись, сегмент - когда на него не останется ссылок
+                if screenshot_info.get("segment"):
+                    if is_system:
+                        self.metadata[system_key].remove(screenshot_info)
+                    else:
+                        self.metadata[user_key].remove(screenshot_info)
+                    self._unindex_phash(screenshot_info)
+                    self._save_metadata()
+                    self._remove_unused_segment(screenshot_info["segment"])
+                    logger.info(f"[DELETE] Deleted packed screenshot: {filename}")
+                    return True
 
                 # Проверяем существование файла
                 if not os.path.exists(filepath):
@@ -101,6 +204,7 @@ class ScreenshotStorage:
                         self.metadata[system_key].remove(screenshot_info)
                     else:
                         self.metadata[user_key].remove(screenshot_info)
+                    self._unindex_phash(screenshot_info)
                     self._save_metadata()
                     return True
 
@@ -118,6 +222,7 @@ class ScreenshotStorage:
                         self.metadata[system_key].remove(screenshot_info)
                     else:
                         self.metadata[user_key].remove(screenshot_info)
+                    self._unindex_phash(screenshot_info)
                     self._save_metadata()
                     logger.info(f"[DELETE] Successfully deleted metadata for: {filename}")
                     return True
@@ -126,13 +231,13 @@ class ScreenshotStorage:
                     return False
             else:
                 logger.error(f"[DELETE] Screenshot info not found for file: {filename}")
-                logger.info(f"[DELETE] Available metadata: {self.metadata}")
                 return False
 
         except Exception as e:
             logger.error(f"[DELETE] Error in delete_screenshot: {e}", exc_info=True)
             return False
 
+    @timed(storage_seconds, operation="get_by_label")
     def get_screenshots_by_label(self, label: str, user_id: int, chat_id: int) -> List[Dict]:
         """Get all screenshots with specific label for user and chat"""
         try:
@@ -142,40 +247,36 @@ class ScreenshotStorage:
             # Remove 'category_' prefix if it exists
             if label.startswith('category_'):
                 label = label.replace('category_', '')
-                logger.info(f"[GET_BY_LABEL] Removed category_ prefix, new label: {label}")
-
-            logger.info(f"[GET_BY_LABEL] Searching for label: {label}")
-            logger.info(f"[GET_BY_LABEL] User key: {user_key}")
-            logger.info(f"[GET_BY_LABEL] System key: {system_key}")
+                logger.debug("[GET_BY_LABEL] Removed category_ prefix, new label: %s", label)
 
             # Нормализуем метку для сравнения
             normalized_label = label.strip().lower().replace('ё', 'е')
-            logger.info(f"[GET_BY_LABEL] Normalized label: {normalized_label}")
+            logger.debug("[GET_BY_LABEL] Searching for label %s (%s) in %s and %s",
+                         label, normalized_label, user_key, system_key)
 
             # Получаем пользовательские скриншоты с данной меткой
             user_screenshots = [
                 info for info in self.metadata.get(user_key, [])
                 if info["label"].strip().lower().replace('ё', 'е') == normalized_label
             ]
-            logger.info(f"[GET_BY_LABEL] Found {len(user_screenshots)} user screenshots")
 
             # Получаем системные скриншоты с данной меткой
             system_screenshots = [
                 info for info in self.metadata.get(system_key, [])
                 if info["label"].strip().lower().replace('ё', 'е') == normalized_label
             ]
-            logger.info(f"[GET_BY_LABEL] Found {len(system_screenshots)} system screenshots")
 
             # Объединяем списки
             all_screenshots = user_screenshots + system_screenshots
 
-            logger.info(f"[GET_BY_LABEL] Total screenshots found: {len(all_screenshots)}")
-            if all_screenshots:
-                logger.info("Found screenshots:")
+            logger.debug("[GET_BY_LABEL] Found %d user and %d system screenshots",
+                         len(user_screenshots), len(system_screenshots))
+            if logger.isEnabledFor(logging.DEBUG):
                 for screenshot in all_screenshots:
-                    logger.info(f"[GET_BY_LABEL] - {os.path.basename(screenshot['filepath'])}, Label: {screenshot['label']}")
-            else:
-                logger.warning(f"[GET_BY_LABEL] No screenshots found with label '{label}'")
+                    debug_sampled(logger, "[GET_BY_LABEL] - %s, Label: %s",
+                                  os.path.basename(screenshot['filepath']), screenshot['label'])
+            if not all_screenshots:
+                logger.info(f"[GET_BY_LABEL] No screenshots found with label '{label}'")
 
             return sorted(all_screenshots, key=lambda x: x["timestamp"], reverse=True)
 
@@ -183,6 +284,7 @@ class ScreenshotStorage:
             logger.error(f"[GET_BY_LABEL] Error getting screenshots by label: {e}", exc_info=True)
             return []
 
+    @timed(storage_seconds, operation="get_all")
     def get_all_screenshots(self, user_id: int, chat_id: int) -> List[Dict]:
         """Get all screenshots metadata for specific user and chat"""
         user_key = f"user_{user_id}_chat_{chat_id}"
@@ -205,44 +307,208 @@ class ScreenshotStorage:
             reverse=True
         )
 
-    def save_screenshot(self, data: bytes, label: str, user_id: int, chat_id: int) -> str:
-        """Save screenshot with metadata for specific user and chat"""
-        timestamp = datetime.now(pytz.UTC).strftime("%Y%m%d_%H%M%S")
-        filename = f"screenshot_{timestamp}.png"
+    def _new_filepath(self, user_id: int, chat_id: int) -> Tuple[str, str]:
+        """Get timestamp and a free file path for a new screenshot in the current month directory"""
+        now = datetime.now(pytz.UTC)
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
+        user_dir = self._get_user_dir(user_id, chat_id, now.strftime("%Y-%m"))
+        filepath = os.path.join(user_dir, f"screenshot_{timestamp}.png")
+        suffix = 1
+        # Два сохранения в одну секунду не должны перезаписывать друг друга
+        while os.path.exists(filepath):
+            filepath = os.path.join(user_dir, f"screenshot_{timestamp}_{suffix}.png")
+            suffix += 1
+        return timestamp, filepath
+
+    def _add_metadata(self, label: str, timestamp: str, filepath: str, user_id: int, chat_id: int,
+                      extra: Optional[Dict[str, Any]] = None) -> None:
+        """Register saved screenshot file in metadata"""
+        user_key = f"user_{user_id}_chat_{chat_id}"
+        if user_key not in self.metadata:
+            self.metadata[user_key] = []
+
+        screenshot_info = {
+            "label": label,
+            "timestamp": timestamp,
+            "filepath": filepath,
+            "user_id": user_id,
+            "chat_id": chat_id
+        }
+        if extra:
+            screenshot_info.update(extra)
+
+        self.metadata[user_key].append(screenshot_info)
+        self._index_phash(screenshot_info)
+        self._save_metadata()
+
+    def _phash_tree(self) -> BKTree:
+        """Get BK-tree over all records with a perceptual hash, building it if needed"""
+        if self._phash_index is None:
+            self._phash_index = BKTree(lambda a, b: (a ^ b).bit_count())
+            self._phash_records = {}
+            for entries in self.metadata.values():
+                for info in entries:
+                    self._index_phash(info)
+            logger.info(f"Built perceptual hash index with {self._phash_index.size} records")
+        return self._phash_index
+
+    def _index_phash(self, info: Dict) -> None:
+        if self._phash_index is not None and info.get("phash"):
+            self._phash_index.add(int(info["phash"], 16), info["filepath"])
+            self._phash_records[info["filepath"]] = info
+
+    def _unindex_phash(self, info: Dict) -> None:
+        if self._phash_index is not None and info.get("phash"):
+            self._phash_index.remove(int(info["phash"], 16), info["filepath"])
+            self._phash_records.pop(info["filepath"], None)
+
+    @timed(storage_seconds, operation="find_similar")
+    def find_similar(self, filepath: str, user_id: int, chat_id: int, count: int = 5) -> List[Tuple[int, Dict]]:
+        """
+        Get up to `count` screenshots visible to user and chat that look most like `filepath`.
+
+        Returns (hamming distance, screenshot info) pairs, nearest first.
+        """
+        tree = self._phash_tree()
+        source = self._phash_records.get(filepath)
+        if source is None:
+            return []
+
+        visible_keys = {f"user_{user_id}_chat_{chat_id}", "user_0_chat_0"}
 
-        # Get user-specific directory
-        user_dir = self._get_user_dir(user_id, chat_id)
-        filepath = os.path.join(user_dir, filename)
+        def accept(candidate_path: str) -> bool:
+            info = self._phash_records[candidate_path]
+            return (candidate_path != filepath
+                    and f"user_{info['user_id']}_chat_{info['chat_id']}" in visible_keys)
 
+        matches = tree.nearest(int(source["phash"], 16), count, accept=accept)
+        return [(distance, self._phash_records[path]) for distance, path in matches]
+
+    def missing_phashes(self) -> List[Dict]:
+        """Records saved before perceptual hashes were stored"""
+        return [
+            info
+            for entries in self.metadata.values()
+            for info in entries
+            if not info.get("phash") and self.screenshot_exists(info)
+        ]
+
+    def set_phashes(self, phashes: Dict[str, str]) -> None:
+        """Store computed perceptual hashes by file path"""
+        for entries in self.metadata.values():
+            for info in entries:
+                if info["filepath"] in phashes:
+                    info["phash"] = phashes[info["filepath"]]
+        self._phash_index = None
+        self._save_metadata()
+
+    def _find_by_sha256(self, sha256: str) -> Optional[str]:
+        """Get path of an archived file with the same content digest"""
+        for entries in self.metadata.values():
+            for info in entries:
+                if info.get("sha256") == sha256 and os.path.exists(info["filepath"]):
+                    return info["filepath"]
+        return None
+
+    def _previous_capture(self, user_id: int, chat_id: int) -> Optional[Dict]:
+        """Latest record with a perceptual hash in the same user and chat"""
+        # Записи добавляются в порядке снимков, поэтому достаточно пройти список с конца
+        for info in reversed(self.metadata.get(f"user_{user_id}_chat_{chat_id}", [])):
+            if info.get("phash") and self.screenshot_exists(info):
+                return info
+        return None
+
+    def _same_image(self, data: bytes, info: Dict) -> bool:
+        """Check that an archived screenshot has exactly the pixels of `data`"""
+        from image_processor import ImageProcessor
         try:
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with self.open_screenshot(info) as f:
+                return ImageProcessor.same_pixels(data, f)
+        except (OSError, ValueError):
+            return False
 
-            with open(filepath, 'wb') as f:
-                f.write(data)
+    @timed(storage_seconds, operation="save")
+    def save_screenshot(self, data: bytes, label: str, user_id: int, chat_id: int,
+                        sha256: Optional[str] = None, phash: Optional[str] = None,
+                        sheet_url: Optional[str] = None) -> str:
+        """
+        Save screenshot with metadata for specific user and chat.
 
-            # Create or update user metadata
-            user_key = f"user_{user_id}_chat_{chat_id}"
-            if user_key not in self.metadata:
-                self.metadata[user_key] = []
-
-            screenshot_info = {
-                "label": label,
-                "timestamp": timestamp,
-                "filepath": filepath,
-                "user_id": user_id,
-                "chat_id": chat_id
-            }
-
-            self.metadata[user_key].append(screenshot_info)
-            self._save_metadata()
+        `sheet_url` is the captured sheet; the capture queue falls back only
+        to archived screenshots of the same sheet.
+
+        An identical archived file (same sha256) is hard-linked instead of
+        writing a new file; the match goes to 'duplicate_of'. The perceptual
+        hash only picks the previous capture as a candidate (distance within
+        PHASH_DUPLICATE_THRESHOLD): it is linked only when its pixels are
+        identical, since a small edit in a large sheet may not change the hash.
+        """
+        timestamp, filepath = self._new_filepath(user_id, chat_id)
 
-            logger.info(f"Saved screenshot: {filename} with label: {label} for user {user_id} in chat {chat_id}")
+        try:
+            extra: Dict[str, Any] = {}
+            if sha256:
+                extra["sha256"] = sha256
+            if phash:
+                extra["phash"] = phash
+            if sheet_url:
+                extra["sheet_url"] = sheet_url
+
+            existing = self._find_by_sha256(sha256) if sha256 else None
+            if not existing and phash:
+                previous = self._previous_capture(user_id, chat_id)
+                # Сегменты и перекодированные (tier) файлы ссылкой не подменить
+                if previous and not previous.get("segment") and not previous.get("tier"):
+                    from image_processor import ImageProcessor
+                    distance = ImageProcessor.hash_distance(phash, previous["phash"])
+                    if distance <= PHASH_DUPLICATE_THRESHOLD and self._same_image(data, previous):
+                        existing = previous["filepath"]
+                        extra["phash_distance"] = distance
+
+            linked = False
+            if existing:
+                try:
+                    os.link(existing, filepath)
+                    linked = True
+                    extra["duplicate_of"] = existing
+                    logger.info(f"Screenshot matches {existing}, stored as a hard link")
+                except OSError:
+                    extra.pop("phash_distance", None)
+            if not linked:
+                with open(filepath, 'xb') as f:
+                    f.write(data)
+
+            self._add_metadata(label, timestamp, filepath, user_id, chat_id, extra)
+
+            logger.info(f"Saved screenshot: {os.path.basename(filepath)} with label: {label} for user {user_id} in chat {chat_id}")
             return filepath
         except Exception as e:
             logger.error(f"Error saving screenshot: {e}")
             return None
 
+    @timed(storage_seconds, operation="save_file")
+    def save_screenshot_file(self, source_path: str, label: str, user_id: int, chat_id: int,
+                             phash: Optional[str] = None, sheet_url: Optional[str] = None) -> str:
+        """Archive an existing file (e.g. a temp capture) without reading it into memory"""
+        timestamp, filepath = self._new_filepath(user_id, chat_id)
+
+        try:
+            try:
+                # Жёсткая ссылка: ни чтения, ни записи данных
+                os.link(source_path, filepath)
+            except OSError:
+                shutil.copyfile(source_path, filepath)
+
+            extra = {key: value for key, value in (("phash", phash), ("sheet_url", sheet_url)) if value}
+            self._add_metadata(label, timestamp, filepath, user_id, chat_id, extra or None)
+
+            logger.info(f"Archived file {source_path} as {os.path.basename(filepath)} with label: {label} for user {user_id} in chat {chat_id}")
+            return filepath
+        except Exception as e:
+            logger.error(f"Error archiving screenshot file {source_path}: {e}")
+            return None
+
+    @timed(storage_seconds, operation="get_by_date")
     def get_screenshots_by_date(self, date: str, user_id: int, chat_id: int) -> List[Dict]:
         """Get screenshots for specific date for user and chat"""
         user_key = f"user_{user_id}_chat_{chat_id}"
@@ -267,6 +533,15 @@ class ScreenshotStorage:
 
         return sorted(all_screenshots, key=lambda x: x["timestamp"], reverse=True)
 
+    @timed(storage_seconds, operation="get_in_period")
+    def get_screenshots_in_period(self, start: str, end: str, user_id: int, chat_id: int) -> List[Dict]:
+        """Get screenshots whose timestamp prefix lies in [start, end], e.g. '20250101'..'20250131' or '202501'"""
+        return [
+            info for info in self.get_all_screenshots(user_id, chat_id)
+            if start <= info["timestamp"][:len(start)] and info["timestamp"][:len(end)] <= end
+        ]
+
+    @timed(storage_seconds, operation="search_by_label")
     def search_by_label(self, query: str, user_id: int, chat_id: int) -> List[Dict]:
         """Search screenshots by custom label for user and chat"""
         user_key = f"user_{user_id}_chat_{chat_id}"
@@ -276,6 +551,7 @@ class ScreenshotStorage:
             if query in info["label"].lower() and self._has_access(user_id, chat_id, info)
         ]
 
+    @timed(storage_seconds, operation="get_all_labels")
     def get_all_labels(self, user_id: int, chat_id: int) -> List[str]:
         """Get all unique labels for user and chat"""
         user_key = f"user_{user_id}_chat_{chat_id}"
@@ -295,4 +571,172 @@ class ScreenshotStorage:
 
         return sorted(list(labels))
 
+    @staticmethod
+    def record_sheet_url(key: str, info: Dict) -> Optional[str]:
+        """Sheet a record was captured from; old system reports were always of SHEET_URL"""
+        return info.get("sheet_url") or (SHEET_URL if key == "user_0_chat_0" else None)
+
+    def get_latest_screenshot(self, sheet_url: str) -> Optional[Dict]:
+        """Get the most recent archived screenshot of `sheet_url` whose file still exists"""
+        screenshots = [
+            info for key, entries in self.metadata.items() for info in entries
+            if self.record_sheet_url(key, info) == sheet_url
+        ]
+        latest = max(screenshots, key=lambda x: x["timestamp"], default=None)
+        if latest is None or self.screenshot_exists(latest):
+            return latest
+        # Файл последней записи пропал - только тогда перебираем остальные по убыванию
+        for info in sorted(screenshots, key=lambda x: x["timestamp"], reverse=True):
+            if self.screenshot_exists(info):
+                return info
+        return None
+
+    def _remove_unused_segment(self, segment: str) -> None:
+        if any(info.get("segment") == segment for entries in self.metadata.values() for info in entries):
+            return
+        self.remove_segment(segment)
+
+    @staticmethod
+    def remove_segment(segment: str) -> None:
+        """Delete a segment file nothing points at any more"""
+        segment_reader.forget(segment)
+        try:
+            os.remove(segment)
+            logger.info(f"Removed segment {segment}")
+        except OSError as e:
+            logger.error(f"Error removing segment {segment}: {e}")
+
+    def closed_month_batches(self, now: Optional[datetime] = None) -> List[Tuple[str, List[Dict]]]:
+        """
+        Loose screenshots of months before the current one, grouped by segment file.
+
+        Returns (segment path, records) pairs. The path is the current segment
+        of that user, chat and month, or screenshots/user_X/chat_Y/YYYY-MM.zip
+        if the month has not been packed yet.
+        """
+        current_month = (now or datetime.now(pytz.UTC)).strftime("%Y-%m")
+        segments: Dict[Tuple[int, int, str], str] = {}
+        loose: List[Dict] = []
+        for entries in self.metadata.values():
+            for info in entries:
+                month = self._month_of(info)
+                if info.get("segment"):
+                    segments[(info["user_id"], info["chat_id"], month)] = info["segment"]
+                elif month < current_month and os.path.exists(self.data_path(info)):
+                    loose.append(info)
+
+        batches: Dict[str, List[Dict]] = {}
+        for info in loose:
+            month = self._month_of(info)
+            segment = segments.get((info["user_id"], info["chat_id"], month))
+            if segment is None:
+                user_dir = os.path.join(self.storage_dir, f"user_{info['user_id']}", f"chat_{info['chat_id']}")
+                segment = os.path.join(user_dir, f"{month}{SEGMENT_SUFFIX}")
+            batches.setdefault(segment, []).append(info)
+        return sorted(batches.items())
+
+    @classmethod
+    def write_month_segment(cls, segment: str, records: List[Dict]) -> Tuple[SegmentRewrite, Dict[str, str]]:
+        """
+        Pack record files into the next generation of the segment; safe to run in a worker thread.
+
+        Hard-linked duplicates are stored once. Returns the rewrite and filepath -> member name.
+        """
+        members: List[Tuple[str, str]] = []
+        member_of: Dict[str, str] = {}
+        by_inode: Dict[Tuple[int, int], str] = {}
+        for info in records:
+            data_path = cls.data_path(info)
+            stat = os.stat(data_path)
+            name = by_inode.get((stat.st_dev, stat.st_ino))
+            if name is None:
+                name = os.path.basename(data_path)
+                by_inode[(stat.st_dev, stat.st_ino)] = name
+                members.append((name, data_path))
+            member_of[info["filepath"]] = name
+        if os.path.exists(segment):
+            rewrite = write_segment(next_generation(segment), members, base=segment)
+        else:
+            rewrite = write_segment(segment, members)
+        return rewrite, member_of
+
+    def apply_segment_rewrite(self, rewrite: SegmentRewrite, member_of: Optional[Dict[str, str]] = None,
+                              extra: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        """
+        Switch records to a new segment generation and save metadata.
+
+        Records of the previous generation follow their members, records in
+        `member_of` (filepath -> member name) are attached, `extra` holds more
+        fields per filepath. Returns loose files that can be removed now.
+        """
+        member_of = member_of or {}
+        extra = extra or {}
+        packed = []
+        for entries in self.metadata.values():
+            for info in entries:
+                if rewrite.base and info.get("segment") == rewrite.base:
+                    info["offset"], info["size"] = rewrite.locate(info["offset"])
+                elif info["filepath"] in member_of and not info.get("segment"):
+                    packed.append(self.data_path(info))
+                    info.pop("data_path", None)
+                    info["offset"], info["size"] = rewrite.offsets[member_of[info["filepath"]]]
+                else:
+                    continue
+                info["segment"] = rewrite.path
+                info.update(extra.get(info["filepath"], {}))
+        self._save_metadata()
+        logger.info(f"Segment {rewrite.path} written, {len(packed)} screenshots packed")
+        return packed
+
+    @staticmethod
+    def remove_packed_files(filepaths: List[str]) -> None:
+        """Delete loose files after their records point at a segment"""
+        for filepath in filepaths:
+            try:
+                os.remove(filepath)
+            except OSError as e:
+                logger.warning(f"Error removing packed file {filepath}: {e}")
+            # Пустые каталоги месяцев тоже убираем
+            directory = os.path.dirname(filepath)
+            if re.fullmatch(r"\d{4}-\d{2}", os.path.basename(directory)):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    def update_records(self, updates: Dict[str, Dict[str, Any]]) -> List[Dict]:
+        """
+        Apply field updates to records by filepath and save metadata once.
+
+        A None value removes the field. Records deleted meanwhile are skipped.
+        """
+        updated = []
+        for entries in self.metadata.values():
+            for info in entries:
+                fields = updates.get(info["filepath"])
+                if fields is None:
+                    continue
+                for key, value in fields.items():
+                    if value is None:
+                        info.pop(key, None)
+                    else:
+                        info[key] = value
+                updated.append(info)
+        if updated:
+            self._save_metadata()
+        return updated
+
+    @timed(storage_seconds, operation="pack_closed_months")
+    def pack_closed_months(self, now: Optional[datetime] = None) -> int:
+        """Pack every closed month into segment files; returns the number of packed screenshots"""
+        total = 0
+        for segment, records in self.closed_month_batches(now):
+            rewrite, member_of = self.write_month_segment(segment, records)
+            packed = self.apply_segment_rewrite(rewrite, member_of)
+            self.remove_packed_files(packed)
+            if rewrite.base:
+                self.remove_segment(rewrite.base)
+            total += len(packed)
+        return total
+
 screenshot_storage = ScreenshotStorage()
\ No newline at end of file
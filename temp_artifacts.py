@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import logging
+import os
+import secrets
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import TEMP_DIR, TEMP_FILE_TTL, TEMP_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class TempArtifactManager:
+    """
+    Issues collision-free IDs for temporary screenshots and removes them after `ttl`.
+
+    Expiry is tracked in a heap, so the request path never lists the directory.
+    Files are named after their ID, which lets any worker on the same host
+    resolve an ID it did not create.
+    """
+
+    PREFIX = "screenshot_"
+
+    def __init__(self, directory: str = TEMP_DIR, ttl: int = TEMP_FILE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.artifacts: Dict[str, float] = {}  # artifact_id -> expires_at
+        self.expiry_heap: List[Tuple[float, str]] = []
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, artifact_id: str, suffix: str = ".png") -> str:
+        return os.path.join(self.directory, f"{self.PREFIX}{artifact_id}{suffix}")
+
+    def _new_id(self) -> str:
+        while True:
+            artifact_id = secrets.token_hex(6)
+            if artifact_id not in self.artifacts:
+                return artifact_id
+
+    def create(self, data: bytes, suffix: str = ".png") -> Tuple[str, str]:
+        """Write data to a new temporary file and return (artifact_id, path)"""
+        artifact_id = self._new_id()
+        filepath = self._path(artifact_id, suffix)
+        with open(filepath, "xb") as f:
+            f.write(data)
+        expires_at = time.time() + self.ttl
+        self.artifacts[artifact_id] = expires_at
+        heapq.heappush(self.expiry_heap, (expires_at, artifact_id))
+        logger.info(f"Created temp artifact {artifact_id}: {filepath}")
+        return artifact_id, filepath
+
+    def get(self, artifact_id: str, suffix: str = ".png") -> Optional[str]:
+        """Get path of a live artifact or None"""
+        expires_at = self.artifacts.get(artifact_id)
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        filepath = self._path(artifact_id, suffix)
+        return filepath if os.path.exists(filepath) else None
+
+    def discard(self, artifact_id: str, suffix: str = ".png") -> None:
+        """Remove artifact before it expires"""
+        self.artifacts.pop(artifact_id, None)
+        try:
+            os.unlink(self._path(artifact_id, suffix))
+            logger.info(f"Removed temp artifact {artifact_id}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to remove temp artifact {artifact_id}: {e}")
+
+    def sweep(self) -> int:
+        """Remove expired artifacts, return how many were removed"""
+        now = time.time()
+        removed = 0
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, artifact_id = heapq.heappop(self.expiry_heap)
+            if artifact_id in self.artifacts:
+                self.discard(artifact_id)
+                removed += 1
+        return removed
+
+    def purge_orphans(self) -> int:
+        """Remove expired files left by previous runs (one directory scan)"""
+        removed = 0
+        deadline = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith(self.PREFIX):
+                continue
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.unlink(entry.path)
+                    removed += 1
+            except Exception as e:
+                logger.warning(f"Failed to cleanup temp file {entry.name}: {e}")
+        return removed
+
+    async def run_sweeper(self, interval: int = TEMP_SWEEP_INTERVAL) -> None:
+        """Background task: purge leftovers once, then sweep expired artifacts"""
+        try:
+            removed = await asyncio.to_thread(self.purge_orphans)
+            logger.info(f"Temp sweeper started, removed {removed} leftover files")
+        except Exception as e:
+            logger.error(f"Error purging leftover temp files: {e}")
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.info(f"Temp sweeper removed {removed} expired files")
+            except Exception as e:
+                logger.error(f"Error in temp sweeper: {e}")
+
+
+temp_artifacts = TempArtifactManager()
@@ -0,0 +1,263 @@
+"""
+Tiering of cold screenshots: lossy recompression of old archive images.
+
+Screenshots older than TIERING_AGE_DAYS are re-encoded to WebP (or AVIF) in
+a process pool. A result replaces the original only if it is at least
+TIERING_MIN_SAVING smaller, keeps the dimensions and differs from the
+original by at most TIERING_MAX_MEAN_ERROR per pixel. When the archive is over
+ARCHIVE_DISK_BUDGET_MB, screenshots from TIERING_PRESSURE_AGE_DAYS on are
+tiered at TIERING_PRESSURE_QUALITY, oldest first, until it fits.
+
+Records keep their 'filepath', so archive buttons and labels do not change.
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+from PIL import Image, ImageChops, ImageStat
+
+from config import (
+    TIERING_FORMAT,
+    TIERING_AGE_DAYS,
+    TIERING_QUALITY,
+    TIERING_WORKERS,
+    TIERING_BATCH_SIZE,
+    TIERING_MIN_SAVING,
+    TIERING_MAX_MEAN_ERROR,
+    ARCHIVE_DISK_BUDGET_MB,
+    TIERING_PRESSURE_AGE_DAYS,
+    TIERING_PRESSURE_QUALITY,
+)
+from segments import next_generation, read_index, write_segment
+
+logger = logging.getLogger(__name__)
+
+TIER_FORMATS = {"webp": "WEBP", "avif": "AVIF"}
+
+
+def tier_format(requested: str = TIERING_FORMAT) -> str:
+    """Requested format if this Pillow build can write it, otherwise WebP"""
+    Image.init()
+    if TIER_FORMATS.get(requested) in Image.SAVE:
+        return requested
+    logger.warning(f"Pillow cannot write {requested}, tiering to webp")
+    return "webp"
+
+
+def recompress(data: bytes, fmt: str, quality: int) -> Tuple[Optional[bytes], str]:
+    """
+    Re-encode and verify one image; runs in a worker process.
+
+    Returns (result, "") or (None, reason the original is kept).
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            original = image.convert("RGB")
+        buffer = io.BytesIO()
+        original.save(buffer, format=TIER_FORMATS[fmt], quality=quality)
+        result = buffer.getvalue()
+        if len(result) > len(data) * (1 - TIERING_MIN_SAVING):
+            return None, f"only {len(data) - len(result)} bytes smaller"
+
+        # Проверяем, что результат декодируется и совпадает с оригиналом по размеру и содержимому
+        with Image.open(io.BytesIO(result)) as check:
+            decoded = check.convert("RGB")
+        if decoded.size != original.size:
+            return None, f"size changed to {decoded.size}"
+        error = ImageStat.Stat(ImageChops.difference(original.convert("L"), decoded.convert("L"))).mean[0]
+        if error > TIERING_MAX_MEAN_ERROR:
+            return None, f"mean pixel error {error:.2f}"
+        return result, ""
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def archive_usage(storage_dir: str) -> int:
+    """Bytes used by the archive; hard links are counted once"""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(storage_dir):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def _group_loose(storage, records: List[Dict]) -> List[List[Dict]]:
+    """Loose records sharing one file (hard links) are recompressed once"""
+    groups: Dict[Tuple[int, int], List[Dict]] = {}
+    for info in records:
+        try:
+            stat = os.stat(storage.data_path(info))
+        except OSError:
+            continue
+        groups.setdefault((stat.st_dev, stat.st_ino), []).append(info)
+    return list(groups.values())
+
+
+class TieringRun:
+    """One pass over the archive; `budget_left` is the excess still to free under pressure"""
+
+    def __init__(self, storage, pool: ProcessPoolExecutor, fmt: str, quality: int, budget_left: Optional[int]):
+        self.storage = storage
+        self.pool = pool
+        self.fmt = fmt
+        self.quality = quality
+        self.budget_left = budget_left
+        self.tiered = 0
+        self.saved = 0
+
+    @property
+    def done(self) -> bool:
+        return self.budget_left is not None and self.budget_left <= 0
+
+    def _account(self, original: int, result: int) -> None:
+        self.tiered += 1
+        self.saved += original - result
+        if self.budget_left is not None:
+            self.budget_left -= original - result
+
+    def _fields(self, original_size: int) -> Dict:
+        return {"tier": self.fmt, "tier_quality": self.quality, "original_size": original_size}
+
+    async def _recompress(self, datas: List[Optional[bytes]]) -> List[Tuple[Optional[bytes], str]]:
+        loop = asyncio.get_running_loop()
+        futures = [
+            loop.run_in_executor(self.pool, recompress, data, self.fmt, self.quality) if data else None
+            for data in datas
+        ]
+        return [await future if future else (None, "unreadable") for future in futures]
+
+    async def tier_loose(self, groups: List[List[Dict]]) -> None:
+        for start in range(0, len(groups), TIERING_BATCH_SIZE):
+            if self.done:
+                return
+            batch = groups[start:start + TIERING_BATCH_SIZE]
+            datas = await asyncio.to_thread(lambda: [self.storage.read_screenshot(group[0]) for group in batch])
+            results = await self._recompress(datas)
+
+            updates: Dict[str, Dict] = {}
+            old_paths: Dict[str, str] = {}
+            for group, data, (result, reason) in zip(batch, datas, results):
+                if result is None:
+                    logger.info(f"Keeping {group[0]['filepath']}: {reason}")
+                    continue
+                new_paths = await asyncio.to_thread(self._write_loose, group, result)
+                for info, new_path in zip(group, new_paths):
+                    updates[info["filepath"]] = {"data_path": new_path, **self._fields(len(data))}
+                    old_paths[info["filepath"]] = self.storage.data_path(info)
+                self._account(len(data), len(result))
+
+            # Метаданные обновляются одной атомарной записью, старые файлы удаляются после неё
+            updated = {info["filepath"] for info in self.storage.update_records(updates)}
+            stale = [old_paths[path] if path in updated else updates[path]["data_path"] for path in updates]
+            await asyncio.to_thread(self.storage.remove_packed_files, stale)
+
+    def _write_loose(self, group: List[Dict], result: bytes) -> List[str]:
+        """Write the result next to each original, hard-linked like the originals were"""
+        new_paths = []
+        for info in group:
+            new_path = f"{os.path.splitext(self.storage.data_path(info))[0]}.{self.fmt}"
+            if new_paths:
+                try:
+                    os.link(new_paths[0], new_path)
+                    new_paths.append(new_path)
+                    continue
+                except OSError:
+                    pass
+            with open(new_path, "wb") as f:
+                f.write(result)
+                f.flush()
+                os.fsync(f.fileno())
+            new_paths.append(new_path)
+        return new_paths
+
+    async def tier_segment(self, segment: str, records: List[Dict]) -> None:
+        """Replace members of one segment, writing its next generation"""
+        by_offset: Dict[int, Dict] = {}
+        for info in records:
+            by_offset.setdefault(info["offset"], info)
+        candidates = sorted(by_offset.values(), key=lambda info: info["timestamp"])
+        datas = await asyncio.to_thread(lambda: [self.storage.read_screenshot(info) for info in candidates])
+        results = await self._recompress(datas)
+
+        replace_at: Dict[int, Tuple[bytes, int]] = {}
+        for info, data, (result, reason) in zip(candidates, datas, results):
+            if result is None:
+                logger.info(f"Keeping {info['filepath']}: {reason}")
+                continue
+            replace_at[info["offset"]] = (result, len(data))
+            self._account(len(data), len(result))
+        if not replace_at:
+            return
+
+        def rewrite_segment():
+            names = {offset: name for name, (offset, _) in read_index(segment).items()}
+            replace = {
+                names[offset]: (f"{os.path.splitext(names[offset])[0]}.{self.fmt}", result)
+                for offset, (result, _) in replace_at.items()
+            }
+            return write_segment(next_generation(segment), base=segment, replace=replace)
+
+        rewrite = await asyncio.to_thread(rewrite_segment)
+        # Все записи на перезаписанном смещении, а не только кандидаты: у свежих копий те же байты
+        extra = {
+            info["filepath"]: self._fields(replace_at[info["offset"]][1])
+            for entries in self.storage.metadata.values() for info in entries
+            if info.get("segment") == segment and info["offset"] in replace_at
+        }
+        self.storage.apply_segment_rewrite(rewrite, extra=extra)
+        await asyncio.to_thread(self.storage.remove_segment, segment)
+
+
+async def run_tiering(storage, now: Optional[datetime] = None) -> int:
+    """Recompress cold screenshots of `storage`; returns the number of tiered images"""
+    now = now or datetime.now(pytz.UTC)
+    budget = ARCHIVE_DISK_BUDGET_MB * 1024 * 1024
+    usage = await asyncio.to_thread(archive_usage, storage.storage_dir)
+    pressure = bool(budget) and usage > budget
+    age_days = TIERING_PRESSURE_AGE_DAYS if pressure else TIERING_AGE_DAYS
+    quality = TIERING_PRESSURE_QUALITY if pressure else TIERING_QUALITY
+    if pressure:
+        logger.warning(f"Archive uses {usage // 2 ** 20} MB of {ARCHIVE_DISK_BUDGET_MB} MB, tiering from {age_days} days")
+
+    cutoff = (now - timedelta(days=age_days)).strftime("%Y%m%d_%H%M%S")
+    # Снимок списка кандидатов: дальше метаданные меняются только через storage
+    candidates = sorted(
+        (info for entries in storage.metadata.values() for info in entries
+         if not info.get("tier") and info["timestamp"] < cutoff and storage.screenshot_exists(info)),
+        key=lambda info: info["timestamp"]
+    )
+    if not candidates:
+        return 0
+
+    loose = [info for info in candidates if not info.get("segment")]
+    segments: Dict[str, List[Dict]] = {}
+    for info in candidates:
+        if info.get("segment"):
+            segments.setdefault(info["segment"], []).append(info)
+
+    # spawn: дочерние процессы не наследуют потоки и event loop бота
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=TIERING_WORKERS, mp_context=context) as pool:
+        run = TieringRun(storage, pool, tier_format(), quality, usage - budget if pressure else None)
+        # Сегменты - закрытые месяцы, поэтому идут раньше незапакованных файлов; самые старые первыми
+        for segment, records in sorted(segments.items(), key=lambda item: item[1][0]["timestamp"]):
+            if run.done:
+                break
+            await run.tier_segment(segment, records)
+        await run.tier_loose(await asyncio.to_thread(_group_loose, storage, loose))
+
+    logger.info(f"Tiered {run.tiered} screenshots to {run.fmt}, saved {run.saved // 1024} KB")
+    return run.tiered
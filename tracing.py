@@ -0,0 +1,396 @@
+"""
+Lightweight tracing of updates.
+
+Every incoming update starts a trace; span() nests timed spans under the
+current one through a context variable, so they follow the update across
+awaits and asyncio.to_thread(). Capture jobs carry the span that submitted
+them, so work done by queue workers lands in the same trace. Finished spans
+are handed to an exporter thread that writes them to a JSONL file
+(TRACE_SINK=jsonl) or posts them as OTLP/HTTP JSON (TRACE_SINK=otlp).
+
+    python tracing.py waterfall --min-ms 5000      # slow traces from logs/traces.jsonl
+    python tracing.py collect --port 4318          # OTLP stand-in that appends to the JSONL file
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import requests
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+
+from config import (
+    TRACE_SINK,
+    TRACE_FILE,
+    TRACE_OTLP_ENDPOINT,
+    TRACE_SAMPLE_RATE,
+    TRACE_SERVICE_NAME,
+    TRACE_EXPORT_INTERVAL,
+    TRACE_EXPORT_BATCH,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """One timed operation; unsampled spans are only kept to propagate the decision"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.status = "ok"
+        self.start = time.time()
+        self.end: Optional[float] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_INHERIT = object()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Dict]) -> Dict:
+    """OTLP/HTTP JSON body for finished spans (as produced by Span.to_dict)"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "bot"},
+            "spans": [{
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "parentSpanId": span["parent_id"] or "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                "endTimeUnixNano": str(int(span["end"] * 1e9)),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span["attributes"].items()],
+                "status": {"code": 2 if span["status"] == "error" else 1},
+            } for span in spans],
+        }],
+    }]}
+
+
+def from_otlp(body: Dict) -> List[Dict]:
+    """Spans of an OTLP/HTTP JSON body in the JSONL format"""
+    spans = []
+    for resource_spans in body.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                start = int(span["startTimeUnixNano"]) / 1e9
+                end = int(span["endTimeUnixNano"]) / 1e9
+                attributes = {item["key"]: next(iter(item["value"].values()), None) for item in span.get("attributes", [])}
+                spans.append({
+                    "trace_id": span["traceId"],
+                    "span_id": span["spanId"],
+                    "parent_id": span.get("parentSpanId") or None,
+                    "name": span["name"],
+                    "start": start,
+                    "end": end,
+                    "duration_ms": round((end - start) * 1000, 3),
+                    "status": "error" if span.get("status", {}).get("code") == 2 else "ok",
+                    "attributes": attributes,
+                })
+    return spans
+
+
+class SpanExporter:
+    """Writes finished spans from a background thread, so the event loop never waits on disk or network"""
+
+    def __init__(self, sink: str = TRACE_SINK, path: str = TRACE_FILE, endpoint: str = TRACE_OTLP_ENDPOINT):
+        self.sink = sink
+        self.path = path
+        self.endpoint = endpoint
+        self._queue: "queue.SimpleQueue[Optional[Dict]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def export(self, span: Span) -> None:
+        if self.sink == "none":
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+        self._queue.put(span.to_dict())
+
+    def _write(self, batch: List[Dict]) -> None:
+        try:
+            if self.sink == "otlp":
+                requests.post(self.endpoint, json=to_otlp(batch), timeout=5).raise_for_status()
+            else:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(span, ensure_ascii=False) + "\n" for span in batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.warning(f"Dropped {len(batch)} spans: {e}")
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch: List[Dict] = []
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+            while len(batch) < TRACE_EXPORT_BATCH:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if batch:
+                self._write(batch)
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Write spans still in the queue and stop the thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+span_exporter = SpanExporter()
+
+
+@contextmanager
+def span(name: str, parent: Any = _INHERIT, **attributes: Any) -> Iterator[Span]:
+    """
+    Time a block as a child of the current span (or of `parent`).
+
+    Without a parent the span starts a new trace, sampled at TRACE_SAMPLE_RATE.
+    """
+    parent_span = current_span() if parent is _INHERIT else parent
+    if parent_span is None:
+        current = Span(name, secrets.token_hex(16), None, random.random() < TRACE_SAMPLE_RATE, attributes)
+    else:
+        current = Span(name, parent_span.trace_id, parent_span.span_id, parent_span.sampled, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set_attribute("error", type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end = time.time()
+        if current.sampled:
+            span_exporter.export(current)
+
+
+def traced(name: Optional[str] = None):
+    """Decorator wrapping every call of a sync or async function in a span"""
+
+    def decorator(func):
+        span_name = name or func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Outer update middleware: one trace per incoming update"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        attributes: Dict[str, Any] = {}
+        if isinstance(event, Update):
+            attributes = {"update_id": event.update_id, "event_type": event.event_type}
+            user = data.get("event_from_user")
+            if user:
+                attributes["user_id"] = user.id
+            if event.callback_query:
+                attributes["callback_data"] = event.callback_query.data
+        with span("update", parent=None, **attributes):
+            return await handler(event, data)
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """Inner middleware: span named after the handler chosen for the update"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        with span(f"handler {name}"):
+            return await handler(event, data)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Session middleware: span per Bot API call (answer_photo, edit_message_text, ...)"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        with span(f"bot.{type(method).__name__}", chat_id=getattr(method, "chat_id", None) or ""):
+            return await make_request(bot, method)
+
+
+def load_traces(path: str) -> Dict[str, List[Dict]]:
+    traces: Dict[str, List[Dict]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                traces[record["trace_id"]].append(record)
+    return traces
+
+
+def render_waterfall(spans: List[Dict], width: int = 40) -> List[str]:
+    """Text waterfall of one trace: spans in start order, indented by depth, with time bars"""
+    ids = {record["span_id"] for record in spans}
+    children: Dict[Optional[str], List[Dict]] = defaultdict(list)
+    for record in spans:
+        parent = record["parent_id"] if record["parent_id"] in ids else None
+        children[parent].append(record)
+    start = min(record["start"] for record in spans)
+    total = max(record["end"] for record in spans) - start or 1e-9
+
+    lines = []
+
+    def walk(parent: Optional[str], depth: int) -> None:
+        for record in sorted(children.get(parent, []), key=lambda item: item["start"]):
+            offset = int((record["start"] - start) / total * width)
+            length = max(1, round(record["duration_ms"] / 1000 / total * width))
+            bar = " " * offset + "█" * min(length, width - offset)
+            marker = " !" if record["status"] == "error" else ""
+            label = ("  " * depth + record["name"])[:48]
+            lines.append(f"{label:<48} |{bar:<{width}}| {record['duration_ms']:>9.1f} ms{marker}")
+            walk(record["span_id"], depth + 1)
+
+    walk(None, 0)
+    return lines
+
+
+def waterfall(path: str, min_ms: float, limit: int) -> None:
+    traces = load_traces(path)
+    slow = []
+    for trace_id, spans in traces.items():
+        duration = (max(s["end"] for s in spans) - min(s["start"] for s in spans)) * 1000
+        if duration >= min_ms:
+            slow.append((duration, trace_id, spans))
+    slow.sort(key=lambda item: item[0], reverse=True)
+    print(f"{len(slow)} of {len(traces)} traces took at least {min_ms:.0f} ms")
+    for duration, trace_id, spans in slow[:limit]:
+        root = min(spans, key=lambda s: s["start"])
+        started = datetime.fromtimestamp(root["start"]).strftime("%Y-%m-%d %H:%M:%S")
+        details = ", ".join(f"{key}={value}" for key, value in root["attributes"].items())
+        print(f"\ntrace {trace_id}  {started}  {duration:.0f} ms  {details}")
+        for line in render_waterfall(spans):
+            print(line)
+
+
+def create_collector_app(path: str) -> web.Application:
+    """OTLP/HTTP JSON receiver that appends spans to a JSONL file"""
+
+    async def receive(request: web.Request) -> web.Response:
+        spans = from_otlp(await request.json())
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in spans)
+        return web.json_response({"partialSuccess": {}})
+
+    app = web.Application()
+    app.router.add_post("/v1/traces", receive)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Trace tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("waterfall", help="print slow traces from a JSONL file")
+    show.add_argument("--file", default=TRACE_FILE)
+    show.add_argument("--min-ms", type=float, default=1000, help="only traces at least this long")
+    show.add_argument("--limit", type=int, default=10, help="slowest traces to print")
+    collect = commands.add_parser("collect", help="OTLP/HTTP JSON collector stand-in")
+    collect.add_argument("--host", default="127.0.0.1")
+    collect.add_argument("--port", type=int, default=4318)
+    collect.add_argument("--file", default=TRACE_FILE)
+    args = parser.parse_args()
+
+    if args.command == "waterfall":
+        waterfall(args.file, args.min_ms, args.limit)
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        logger.info(f"Collecting spans on http://{args.host}:{args.port}/v1/traces into {args.file}")
+        web.run_app(create_collector_app(args.file), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,46 @@
 import requests
 import time
 from typing import Optional, Tuple, List, Dict
+import functools
 import logging
 from urllib.parse import quote_plus
-from config import APIFLASH_KEY, SHEET_URL, SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT, SCREENSHOT_QUALITY
+from config import SHEET_URL, APIFLASH_MONTHLY_LIMIT
+from capture_providers import CaptureProvider, CaptureResult, get_capture_provider
+from quota import quota_ledger, QuotaExceededError
+from resilience import CircuitBreaker, CircuitOpenError, call_with_retry
+from metrics import registry, cache_requests, capture_seconds, captures_total
+from tracing import traced
 import json
 from datetime import datetime, timedelta
 import pytz
-import os
-
-# Create logs directory if it doesn't exist
-os.makedirs('logs', exist_ok=True)
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('logs/telegram_bot.log'),
-        logging.StreamHandler()
-    ]
-)
+
 logger = logging.getLogger(__name__)
 
 class ScreenshotStats:
     def __init__(self):
-        self.monthly_limit = 100
+        self.monthly_limit = APIFLASH_MONTHLY_LIMIT
 
     def get_total_monthly_stats(self, screenshots: List[Dict]) -> Dict:
-        """Get total statistics for all users and system screenshots in the current month"""
+        """Get APIFlash usage for the current month plus the number of archived screenshots"""
+        # Метки архива - 'YYYYmmdd_HHMMSS' в UTC
         now = datetime.now(pytz.UTC)
-        current_month = now.strftime("%Y-%m")
-
-        # Фильтруем все скриншоты (включая системные) за текущий месяц
-        month_screenshots = [
-            s for s in screenshots
-            if s["timestamp"].startswith(current_month)
-        ]
+        current_month = now.strftime("%Y%m")
 
-        total_monthly = len(month_screenshots)
-        usage_percent = min(100, (total_monthly / self.monthly_limit) * 100)
+        # Архив считаем отдельно: расход квоты берётся из журнала реальных вызовов APIFlash
+        archived_monthly = sum(1 for s in screenshots if s["timestamp"].startswith(current_month))
+        quota = quota_ledger.stats()
 
-        logger.info(f"Total screenshots this month: {total_monthly}")
-        logger.info(f"Monthly limit: {self.monthly_limit}")
-        logger.info(f"Usage percent: {usage_percent}%")
+        logger.info(f"APIFlash calls this month: {quota['calls']} of {quota['monthly_limit']}")
+        logger.info(f"Archived screenshots this month: {archived_monthly}")
 
         return {
-            "total_this_month": total_monthly,
-            "remaining_limit": max(0, self.monthly_limit - total_monthly),
-            "usage_percent": usage_percent
+            "total_this_month": quota["calls"],
+            "archived_this_month": archived_monthly,
+            "failed_this_month": quota["failures"],
+            "monthly_limit": quota["monthly_limit"],
+            "remaining_limit": quota["remaining_limit"],
+            "interactive_available": quota["interactive_available"],
+            "usage_percent": quota["usage_percent"]
         }
 
     def get_monthly_stats(self, screenshots: List[Dict]) -> Dict:
@@ -56,15 +48,13 @@ class ScreenshotStats:
         return self.get_total_monthly_stats(screenshots)
 
     def filter_by_period(self, screenshots: List[Dict], start_date: str, end_date: str) -> List[Dict]:
-        """Filter screenshots by date period"""
+        """Filter screenshots by date period (inclusive 'YYYY-MM-DD' bounds)"""
         try:
-            start = datetime.strptime(start_date, "%Y-%m-%d")
-            end = datetime.strptime(end_date, "%Y-%m-%d")
+            # Метки архива - 'YYYYmmdd_HHMMSS', их дату можно сравнивать как строку
+            start = datetime.strptime(start_date, "%Y-%m-%d").strftime("%Y%m%d")
+            end = datetime.strptime(end_date, "%Y-%m-%d").strftime("%Y%m%d")
 
-            return [
-                s for s in screenshots
-                if start <= datetime.strptime(s["timestamp"].split()[0], "%Y-%m-%d") <= end
-            ]
+            return [s for s in screenshots if start <= s["timestamp"][:8] <= end]
         except Exception as e:
             logger.error(f"Error filtering screenshots by period: {e}")
             return []
@@ -114,15 +104,18 @@ class ScreenshotCache:
             if last_modified and last_modified == self.last_modified_times.get(key):
                 if time.time() - timestamp < 3600:  # 1 час кэша
                     logger.info(f"Cache hit for key: {key}")
+                    cache_requests.inc(cache="screenshot", result="hit")
                     return data
 
             logger.info(f"Cache expired or sheet modified for key: {key}")
+            cache_requests.inc(cache="screenshot", result="stale")
             del self.cache[key]
             if key in self.last_modified_times:
                 del self.last_modified_times[key]
                 logger.info(f"Removed expired cache entry for key: {key}")
         else:
             logger.info(f"No cache entry found for key: {key}")
+            cache_requests.inc(cache="screenshot", result="miss")
         return None
 
     def set(self, key: str, data: bytes) -> None:
@@ -139,34 +132,96 @@ class ScreenshotCache:
 
 screenshot_cache = ScreenshotCache()
 
-def take_screenshot(url: str = SHEET_URL) -> bytes:
-    """Take a screenshot of the specified URL using APIFlash"""
-    try:
-        params = {
-            'access_key': APIFLASH_KEY,
-            'url': url,
-            'width': SCREENSHOT_WIDTH,
-            'height': SCREENSHOT_HEIGHT,
-            'quality': SCREENSHOT_QUALITY,
-            'full_page': True,
-            'response_type': 'json'
-        }
+capture_provider = get_capture_provider()
+capture_providers: Dict[str, CaptureProvider] = {capture_provider.name: capture_provider}
+capture_breakers: Dict[str, CircuitBreaker] = {}
 
-        response = requests.get('https://api.apiflash.com/v1/urltoimage', params=params)
-        response.raise_for_status()
 
-        # Get the screenshot URL from the JSON response
-        screenshot_url = response.json().get('url')
-        if not screenshot_url:
-            logger.error("No screenshot URL in response")
-            return None
+def get_provider(name: Optional[str] = None) -> CaptureProvider:
+    """Shared provider instance by engine name; None means the default CAPTURE_PROVIDER"""
+    if not name:
+        return capture_provider
+    if name not in capture_providers:
+        capture_providers[name] = get_capture_provider(name)
+    return capture_providers[name]
+
+
+def get_capture_breaker(provider_name: str) -> CircuitBreaker:
+    """Circuit breaker of a provider: one provider going down does not block the others"""
+    if provider_name not in capture_breakers:
+        capture_breakers[provider_name] = CircuitBreaker(provider_name)
+    return capture_breakers[provider_name]
+
+
+capture_breaker = get_capture_breaker(capture_provider.name)
+
 
-        # Download the actual screenshot
-        screenshot_response = requests.get(screenshot_url)
-        screenshot_response.raise_for_status()
+def _breaker_samples(field: str) -> List[Tuple[Dict[str, str], float]]:
+    """Samples of one field of breaker.metrics() for every provider; 'open' is 1 unless the circuit is closed"""
+    samples = []
+    for breaker in list(capture_breakers.values()):
+        snapshot = breaker.metrics()
+        value = int(snapshot["state"] != CircuitBreaker.CLOSED) if field == "open" else snapshot[field]
+        samples.append(({"provider": snapshot["name"]}, value))
+    return samples
 
-        return screenshot_response.content
 
+registry.add_collector("bot_breaker_open", "gauge", "1 while the capture circuit of a provider is not closed",
+                       functools.partial(_breaker_samples, "open"))
+for _field in ("successes_total", "failures_total", "rejected_total", "opened_total"):
+    registry.add_collector(f"bot_breaker_{_field}", "counter", f"Circuit breaker {_field[:-len('_total')]} count",
+                           functools.partial(_breaker_samples, _field))
+
+
+def _request_screenshot(provider: CaptureProvider, url: str, scheduled: bool, timeout: float) -> CaptureResult:
+    """Single capture attempt limited to `timeout` seconds; raises on any error"""
+    if not provider.counts_quota:
+        return provider.capture(url, timeout)
+
+    quota_ledger.acquire(scheduled)
+    try:
+        return provider.capture(url, timeout)
+    except Exception:
+        quota_ledger.record_failure()
+        raise
+
+
+@traced()
+def take_screenshot(url: str = SHEET_URL, scheduled: bool = False,
+                    engine: Optional[str] = None) -> Optional[CaptureResult]:
+    """
+    Take a screenshot of the specified URL with the given capture engine
+    ('apiflash', 'fake' or 'local'; CAPTURE_PROVIDER by default).
+
+    Transient errors are retried with backoff behind a circuit breaker.
+    Returns None on failure; raises QuotaExceededError when the monthly budget
+    does not allow the call and CircuitOpenError while the provider is considered down.
+    """
+    try:
+        provider = get_provider(engine)
     except Exception as e:
         logger.error(f"Error taking screenshot: {e}")
-        return None
\ No newline at end of file
+        return None
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        # Повтор тоже тратит квоту: без запаса отдаём ошибку сразу, не дожидаясь QuotaExceededError
+        can_retry = (lambda: quota_ledger.can_spend(scheduled)) if provider.counts_quota else None
+        return call_with_retry(
+            lambda timeout: _request_screenshot(provider, url, scheduled, timeout),
+            get_capture_breaker(provider.name),
+            can_retry=can_retry,
+        )
+    except QuotaExceededError:
+        outcome = "quota"
+        raise
+    except CircuitOpenError:
+        outcome = "circuit_open"
+        raise
+    except Exception as e:
+        outcome = "failed"
+        logger.error(f"Error taking screenshot: {e}")
+        return None
+    finally:
+        captures_total.inc(provider=provider.name, outcome=outcome)
+        capture_seconds.observe(time.perf_counter() - started, provider=provider.name, stage="total")